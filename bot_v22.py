@@ -52,15 +52,25 @@ import os
 import time
 import json
 import threading
+import queue
+import atexit
 import sqlite3
 import logging
 import random
 import re
+from collections import OrderedDict, deque
+from functools import lru_cache, partial, wraps
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 import io
 import zipfile
 import tempfile
 import base64
-from datetime import datetime
+import zlib
+import gzip
+import hashlib
+import copy
+from datetime import datetime, timedelta
 from io import BytesIO
 
 try:
@@ -104,6 +114,18 @@ try:
 except ImportError:
     HAS_ASCII = False
 
+try:
+    import aiohttp
+    HAS_AIOHTTP = True
+except ImportError:
+    HAS_AIOHTTP = False
+
+try:
+    sqlite3.connect(":memory:").execute("CREATE VIRTUAL TABLE t USING fts5(x)")
+    HAS_FTS5 = True
+except sqlite3.OperationalError:
+    HAS_FTS5 = False
+
 # ══════════════════════════════════════════════════════════════════════════════════
 # 🛡️  SECTION 1 : LOGGING & CONFIGURATION
 # ══════════════════════════════════════════════════════════════════════════════════
@@ -127,6 +149,14 @@ GOOGLE_API_KEY   = os.environ.get("GOOGLE_API_KEY",   "")   # optional Google se
 GOOGLE_CX        = os.environ.get("GOOGLE_CX",        "")   # optional Google CX
 ADMIN_ID         = int(os.environ.get("ADMIN_ID",     "0"))
 
+# ─── PROVIDER ENDPOINTS ────────────────────────────────────────────────────────
+# Base URLs of the AI providers. Point all four at titan_emulator.py to
+# benchmark or load-test the AI paths without spending real quota.
+GEMINI_BASE_URL       = os.environ.get("GEMINI_BASE_URL",       "https://generativelanguage.googleapis.com").rstrip("/")
+GROQ_BASE_URL         = os.environ.get("GROQ_BASE_URL",         "https://api.groq.com").rstrip("/")
+OPENROUTER_BASE_URL   = os.environ.get("OPENROUTER_BASE_URL",   "https://openrouter.ai").rstrip("/")
+POLLINATIONS_BASE_URL = os.environ.get("POLLINATIONS_BASE_URL", "https://image.pollinations.ai").rstrip("/")
+
 # ─── BOT IDENTITY ─────────────────────────────────────────────────────────────
 BOT_NAME         = "MI AI TITAN V22"
 BOT_VERSION      = "22.0 — THE VOICE & VISION AWAKENING"
@@ -153,6 +183,129 @@ SIGNAL_FRAMES = [
 RATE_LIMIT_SECONDS = 3
 _last_msg_time: dict = {}
 
+# ─── HEDGED ENGINE RACING ──────────────────────────────────────────────────────
+# get_response starts the first engine in the chain; if it hasn't answered
+# within the hedge delay, the next engine is started alongside it and the
+# first good answer wins. TITAN_HEDGE_DELAY_MS=0 means "that engine's recent
+# p95 latency", clamped to [HEDGE_MIN_MS, HEDGE_MAX_MS].
+HEDGE_ENABLED    = os.environ.get("TITAN_HEDGE", "1") == "1"
+HEDGE_DELAY_MS   = int(os.environ.get("TITAN_HEDGE_DELAY_MS", "0"))
+HEDGE_MIN_MS     = 1500
+HEDGE_MAX_MS     = 8000
+HEDGE_DEFAULT_MS = 4000    # until an engine has HEDGE_MIN_SAMPLES latencies
+HEDGE_MIN_SAMPLES = 20
+
+# ─── PROVIDER CIRCUIT BREAKERS ─────────────────────────────────────────────────
+# A provider that fails CIRCUIT_FAILS times in a row (or whose EWMA error rate
+# passes CIRCUIT_ERROR_RATE) is skipped for CIRCUIT_COOLDOWN seconds, then
+# gets a single trial request; each failed trial doubles the cooldown.
+CIRCUIT_FAILS        = int(os.environ.get("TITAN_CIRCUIT_FAILS", "5"))
+CIRCUIT_ERROR_RATE   = 0.5
+CIRCUIT_COOLDOWN     = int(os.environ.get("TITAN_CIRCUIT_COOLDOWN", "30"))
+CIRCUIT_MAX_COOLDOWN = 600
+
+# ─── PROVIDER QUOTAS ───────────────────────────────────────────────────────────
+# Client-side token buckets per provider: (requests/minute, tokens/minute),
+# 0 = no limit. Defaults are the free-tier quotas; raise them on paid plans.
+# Group chatter must leave 30% of each bucket untouched and background
+# document generation 50%, so they can't starve private chats and mentions.
+PROVIDER_QUOTAS = {
+    "gemini"     : (int(os.environ.get("TITAN_RPM_GEMINI", "15")),
+                    int(os.environ.get("TITAN_TPM_GEMINI", "1000000"))),
+    "groq"       : (int(os.environ.get("TITAN_RPM_GROQ", "30")),
+                    int(os.environ.get("TITAN_TPM_GROQ", "8000"))),
+    "openrouter" : (int(os.environ.get("TITAN_RPM_OPENROUTER", "20")),
+                    int(os.environ.get("TITAN_TPM_OPENROUTER", "0"))),
+}
+
+# ─── LOAD GOVERNOR ─────────────────────────────────────────────────────────────
+# Load is the worst of three ratios: AI requests in flight / LOAD_INFLIGHT_HIGH,
+# queued work (io pool backlog + quota waiters) / LOAD_QUEUE_HIGH, and the
+# fastest text provider's EWMA latency / LOAD_LATENCY_HIGH. At >= 1 the bot
+# is "busy": Deep Think answers come from the fast model, answers are capped
+# at LOAD_MAX_TOKENS[1], no hedging, no group chatter. At >= 2 it is
+# "overloaded": also voice replies off and the tighter token cap. A level is
+# left only after load stays clearly below it for LOAD_COOLDOWN_SECONDS.
+LOAD_GOVERNOR        = os.environ.get("TITAN_LOAD_GOVERNOR", "1") == "1"
+LOAD_INFLIGHT_HIGH   = int(os.environ.get("TITAN_LOAD_INFLIGHT", "200"))
+LOAD_QUEUE_HIGH      = int(os.environ.get("TITAN_LOAD_QUEUE", "64"))
+LOAD_LATENCY_HIGH    = float(os.environ.get("TITAN_LOAD_LATENCY_SECONDS", "12"))
+LOAD_COOLDOWN_SECONDS = int(os.environ.get("TITAN_LOAD_COOLDOWN_SECONDS", "30"))
+LOAD_MAX_TOKENS      = {1: int(os.environ.get("TITAN_LOAD_BUSY_TOKENS", "1024")),
+                        2: int(os.environ.get("TITAN_LOAD_OVERLOAD_TOKENS", "400"))}
+LOAD_NOTICE_SECONDS  = 600    # one "bot is busy" notice per user per this long
+
+# ─── GROUP CHATTER ─────────────────────────────────────────────────────────────
+# Group messages that don't address the bot are collected per group and
+# answered together: a window closes CHATTER_DEBOUNCE_SECONDS after the
+# last message (or CHATTER_MAX_WAIT_SECONDS after the first, in a group
+# that never pauses), then gets at most one reply — and only if the group
+# still has budget (CHATTER_PER_MINUTE replies, 0 = never reply). Every
+# message is still stored in group_memory, in one write per window.
+CHATTER_DEBOUNCE_SECONDS = float(os.environ.get("TITAN_CHATTER_DEBOUNCE_SECONDS", "4"))
+CHATTER_MAX_WAIT_SECONDS = float(os.environ.get("TITAN_CHATTER_MAX_WAIT_SECONDS", "12"))
+CHATTER_PER_MINUTE       = float(os.environ.get("TITAN_CHATTER_PER_MINUTE", "2"))
+CHATTER_BATCH_LINES      = 30     # newest messages of a window shown to the model
+
+# ─── STREAMING REPLIES ─────────────────────────────────────────────────────────
+# Private-chat answers are streamed from the provider and shown as they
+# arrive, editing one Telegram message at most every STREAM_EDIT_INTERVAL s
+# (Telegram rate-limits edits; ~1/s per chat is safe).
+STREAM_REPLIES       = os.environ.get("TITAN_STREAM", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.environ.get("TITAN_STREAM_EDIT_SECONDS", "1.0"))
+
+# ─── CONTEXT BUDGETS ───────────────────────────────────────────────────────────
+# get_response packs the newest history turns that fit the engine's input
+# budget (system prompt + history + prompt, in estimated tokens), instead of a
+# fixed 8/12 rows. Modes that need long context (code, study, build) and Deep
+# Think get a larger budget; one pasted turn can't take more than
+# CONTEXT_TURN_MAX_TOKENS of it.
+CONTEXT_BUDGETS = {
+    "gemini"     : int(os.environ.get("TITAN_CONTEXT_TOKENS_GEMINI", "12000")),
+    "groq"       : int(os.environ.get("TITAN_CONTEXT_TOKENS_GROQ", "6000")),
+    "openrouter" : int(os.environ.get("TITAN_CONTEXT_TOKENS_OPENROUTER", "8000")),
+}
+CONTEXT_MODE_FACTOR     = {"code": 1.5, "study": 1.5, "build": 1.5}
+CONTEXT_DEEP_FACTOR     = 1.5
+CONTEXT_TURN_MAX_TOKENS = int(os.environ.get("TITAN_CONTEXT_TURN_TOKENS", "1500"))
+CONTEXT_PROMPT_MAX_TOKENS = int(os.environ.get("TITAN_CONTEXT_PROMPT_TOKENS", "8000"))
+CONTEXT_MAX_TURNS       = 40     # rows fetched per request; the budget picks from these
+
+# ─── AUTOMATIC DEPTH ───────────────────────────────────────────────────────────
+# get_response picks the fast (gpt-oss-20b) or deep (gpt-oss-120b) model per
+# message from a local complexity score (length, code, question keywords,
+# mode) instead of only the Deep Think toggle. Deep Think still matters: it
+# adds DEPTH_TOGGLE_BIAS to the score, so "salam" is answered fast either
+# way but borderline questions go deep for users who asked for depth.
+# titan_bench.py route evaluates the classifier on a labeled prompt set.
+AUTO_DEPTH        = os.environ.get("TITAN_AUTO_DEPTH", "1") == "1"
+DEPTH_THRESHOLD   = float(os.environ.get("TITAN_DEPTH_THRESHOLD", "2.0"))
+DEPTH_TOGGLE_BIAS = 1.5
+
+# ─── ROLLING SUMMARIES ─────────────────────────────────────────────────────────
+# Turns older than the window are not simply forgotten: a background job
+# folds them into one running summary per uid / group chat (old summary +
+# newly evicted turns -> new summary, on the fast gpt-oss-20b model), and
+# get_response sends that summary plus only the turns it hasn't absorbed
+# yet. Once a conversation has SUMMARY_TRIGGER_TURNS unsummarized turns,
+# all but the newest SUMMARY_KEEP_TURNS are summarized.
+SUMMARY_ENABLED       = os.environ.get("TITAN_SUMMARIES", "1") == "1"
+SUMMARY_KEEP_TURNS    = int(os.environ.get("TITAN_SUMMARY_KEEP_TURNS", "12"))
+SUMMARY_TRIGGER_TURNS = int(os.environ.get("TITAN_SUMMARY_TRIGGER_TURNS", "24"))
+SUMMARY_MAX_TOKENS    = int(os.environ.get("TITAN_SUMMARY_TOKENS", "400"))
+SUMMARY_INTERVAL      = int(os.environ.get("TITAN_SUMMARY_SECONDS", "30"))
+SUMMARY_MAX_ROWS      = 120    # evicted turns folded in per summarizer call
+
+# ─── LONG-TERM RECALL ──────────────────────────────────────────────────────────
+# Every stored turn is also indexed in SQLite FTS5 (kept in sync by triggers,
+# and kept when compaction archives the row). get_response looks up the
+# RECALL_TOP_K older turns that best match the new message (BM25) and sends
+# those that fit in RECALL_TOKENS along with the summary.
+RECALL_ENABLED   = os.environ.get("TITAN_RECALL", "1") == "1"
+RECALL_TOP_K     = int(os.environ.get("TITAN_RECALL_TOP_K", "5"))
+RECALL_TOKENS    = int(os.environ.get("TITAN_RECALL_TOKENS", "600"))
+RECALL_TURN_TOKENS = 200   # one recalled turn is cut to head+tail beyond this
+
 # ─── CINEMATIC LOADING SEQUENCES ───────────────────────────────────────────────
 LOADING_FRAMES = [
     "🌑 Neural Boot Sequence Initiating...",
@@ -214,39 +367,592 @@ ICONS = {
 session = requests.Session()
 session.headers.update({"User-Agent": "MI-Titan-Bot/22.0"})
 
+# ─── ASYNC RUNTIME ─────────────────────────────────────────────────────────────
+# AI replies run as coroutines on one event loop (AsyncRuntime), so TeleBot's
+# worker threads only do the quick part of each update and hand the rest
+# off. Blocking calls made from a coroutine (Telegram API, SQLite) use the
+# io pool; PDF/Word/ZIP building and PIL work use the cpu pool. Offloaded
+# handlers (voice, photo, /search, /code...) run on their own job pool:
+# they block on AsyncRuntime.run() while the coroutine they wait for needs
+# io threads, so sharing one pool could deadlock under a burst.
+BOT_THREADS      = int(os.environ.get("TITAN_BOT_THREADS", "16"))
+ASYNC_IO_THREADS = int(os.environ.get("TITAN_IO_THREADS", "32"))
+JOB_THREADS      = int(os.environ.get("TITAN_JOB_THREADS", "32"))
+RESPONSE_TIMEOUT = float(os.environ.get("TITAN_RESPONSE_TIMEOUT", "180"))  # get_response() gives up after this
+CPU_WORKERS      = int(os.environ.get("TITAN_CPU_WORKERS", str(max(2, os.cpu_count() or 1))))
+
+# ─── TELEGRAM API ──────────────────────────────────────────────────────────────
+# Empty = api.telegram.org. Point it at titan_telegram.py (a fake Bot API
+# server) to drive the bot with recorded or synthetic updates — see
+# titan_replay.py.
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "").rstrip("/")
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL  = TELEGRAM_API_URL + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+
 # Global bot instance
-bot = telebot.TeleBot(BOT_TOKEN, threaded=True, num_threads=100)
+bot = telebot.TeleBot(BOT_TOKEN, threaded=True, num_threads=BOT_THREADS)
 
 # ══════════════════════════════════════════════════════════════════════════════════
 # 🗄️  SECTION 2 : TITAN ENTERPRISE DATABASE
 # ══════════════════════════════════════════════════════════════════════════════════
 
-class TitanDB:
-    def __init__(self):
+# ─── STORAGE ───────────────────────────────────────────────────────────────────
+# Write-behind: instead of every write taking the lock and paying its own
+# commit (fsync), writes are queued and a single writer thread commits them
+# in one transaction every DB_FLUSH_INTERVAL_MS or DB_FLUSH_MAX_ROWS
+# statements, whichever comes first. Set TITAN_DB_WRITE_BEHIND=0 to get the
+# old commit-per-write behavior back.
+DB_PATH              = os.environ.get("TITAN_DB_PATH", "mi_titan_v22.db")
+DB_WRITE_BEHIND      = os.environ.get("TITAN_DB_WRITE_BEHIND", "1") == "1"
+DB_FLUSH_INTERVAL_MS = int(os.environ.get("TITAN_DB_FLUSH_MS", "5"))
+DB_FLUSH_MAX_ROWS    = int(os.environ.get("TITAN_DB_FLUSH_ROWS", "256"))
+# WAL lets readers run alongside the writer instead of queueing behind it;
+# each worker thread gets its own read-only connection (see _reader()).
+DB_WAL               = os.environ.get("TITAN_DB_WAL", "1") == "1"
+DB_BUSY_TIMEOUT_MS   = int(os.environ.get("TITAN_DB_BUSY_TIMEOUT_MS", "5000"))
+# Users/memory are split across this many SQLite files by uid, group memory
+# by chat_id (shard = key % DB_SHARDS). Several bot processes can share the
+# same set of files — SQLite's file locks serialize their writers. Fixed for
+# the life of a DB: the count is recorded in shard 0 and checked at startup.
+DB_SHARDS            = int(os.environ.get("TITAN_DB_SHARDS", "1"))
+# One private message used to read the same users row 4-5 times (handler,
+# get_response, _voice_is_on, main_kb). Rows are cached in-process; every
+# TitanDB method that changes a users row updates or drops its cache entry.
+USER_CACHE_SIZE      = int(os.environ.get("TITAN_USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL       = int(os.environ.get("TITAN_USER_CACHE_TTL", "60"))
+# With several worker processes, settings / role / login changes bump a
+# per-shard users_epoch in titan_meta; each process re-reads it at most this
+# often and drops cached rows older than it, so another worker's /setadmin
+# or /settings toggle shows up within this many seconds.
+USER_EPOCH_CHECK     = float(os.environ.get("TITAN_USER_EPOCH_CHECK_SECONDS", "1"))
+# Retention: get_response only ever reads the last CONTEXT_MAX_TURNS (40) unsummarized
+# turns, so each uid / chat_id keeps its newest N rows in memory /
+# group_memory and older ones are moved into memory_archive as zlib'd JSON
+# batches (or deleted outright with TITAN_MEMORY_ARCHIVE=0). 0 = keep all.
+MEMORY_KEEP_TURNS       = int(os.environ.get("TITAN_MEMORY_KEEP_TURNS", "200"))
+GROUP_MEMORY_KEEP_TURNS = int(os.environ.get("TITAN_GROUP_MEMORY_KEEP_TURNS", "300"))
+MEMORY_ARCHIVE          = os.environ.get("TITAN_MEMORY_ARCHIVE", "1") == "1"
+COMPACT_INTERVAL        = int(os.environ.get("TITAN_COMPACT_SECONDS", "300"))
+COMPACT_BATCH_ROWS      = 200    # rows moved per write-lock hold (~1-3 ms)
+COMPACT_MAX_BATCHES     = 50     # per job run; the rest waits for the next run
+COMPACT_VACUUM_PAGES    = 256    # pages handed back to the OS per job run
+# Per-message bookkeeping: last_seen is written at most once per interval
+# per user, and chat msg_count increments are summed in memory and written
+# as one UPSERT per chat every TITAN_CHAT_COUNT_FLUSH_SECONDS.
+USER_SEEN_INTERVAL       = int(os.environ.get("TITAN_USER_SEEN_SECONDS", "60"))
+CHAT_COUNT_FLUSH_INTERVAL = int(os.environ.get("TITAN_CHAT_COUNT_FLUSH_SECONDS", "10"))
+# Analytics: every event is counted into analytics_hourly (kept forever, tiny)
+# by a trigger; the raw analytics rows are only kept this many days.
+ANALYTICS_RAW_DAYS     = int(os.environ.get("TITAN_ANALYTICS_RAW_DAYS", "7"))
+ANALYTICS_PRUNE_BATCH  = 2000
+# Response cache for history-free LLM calls (web search summaries, /pdf,
+# /word, /zip content, group chatter): their answer depends only on the
+# prompt, so repeats are served from an in-process LRU (capped in bytes)
+# backed by an optional SQLite file that survives restarts.
+RESPONSE_CACHE          = os.environ.get("TITAN_RESPONSE_CACHE", "1") == "1"
+RESPONSE_CACHE_MEM_MB   = float(os.environ.get("TITAN_RESPONSE_CACHE_MEM_MB", "32"))
+RESPONSE_CACHE_DISK_MB  = float(os.environ.get("TITAN_RESPONSE_CACHE_DISK_MB", "256"))
+RESPONSE_CACHE_PATH     = os.environ.get(
+    "TITAN_RESPONSE_CACHE_PATH", os.path.splitext(DB_PATH)[0] + ".cache.db")   # "" = memory only
+# Seconds an answer stays valid, per call site. Search results go stale
+# fast; generated documents about a topic don't.
+RESPONSE_CACHE_TTLS = {
+    "search"  : int(os.environ.get("TITAN_CACHE_TTL_SEARCH", "1800")),
+    "document": int(os.environ.get("TITAN_CACHE_TTL_DOCUMENT", "604800")),
+    "chatter" : int(os.environ.get("TITAN_CACHE_TTL_CHATTER", "600")),
+}
+
+
+class TTLCache:
+    """Thread-safe LRU map with a per-entry TTL and hit/miss counters.
+
+    max_bytes (optional) also caps the total size of the values, measured
+    with sizeof(value) (len() by default) — for caches of big strings,
+    where an item count says little about memory."""
+
+    def __init__(self, max_items=1000, ttl=60, max_bytes=0, sizeof=len):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._data = OrderedDict()   # key -> (expires_at, value, size)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                    self.bytes -= entry[2]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        size = self._sizeof(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), value, size)
+            self.bytes += size
+            while len(self._data) > self.max_items or (self.max_bytes and self.bytes > self.max_bytes):
+                self.bytes -= self._data.popitem(last=False)[1][2]
+                self.evictions += 1
+
+    def patch(self, key, fn):
+        """Apply fn(value) in place if key is cached — write-through for
+        updates we know the exact effect of."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                fn(entry[1])
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data), "bytes": self.bytes,
+                "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+
+class SQLiteShard:
+    """One SQLite file: its connection, the write-behind queue and writer
+    thread, the per-thread read connections, and the schema + migrations.
+    TitanDB owns one per shard and decides which shard a row lives in."""
+
+    def __init__(self, path, write_behind=DB_WRITE_BEHIND, wal=DB_WAL):
+        self.path = path
+        self.wal = wal
         self.conn = sqlite3.connect(
-            "mi_titan_v22.db",
+            path,
             check_same_thread=False,
         )
         self.conn.row_factory = sqlite3.Row
         self.c = self.conn.cursor()
+        self._wc = self.conn.cursor()   # writes only — never shared with readers
         self._lock = threading.Lock()
+        self._local = threading.local()
+        self._epoch, self._epoch_at = None, float("-inf")
+        self.c.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        # (for the recall index backfill in migration 8)
+        self.conn.create_function("titan_recall_terms", 2, self.recall_terms, deterministic=True)
+        self.conn.create_function("titan_recall_owner", 1, self.fts_owner, deterministic=True)
+        self._enable_incremental_vacuum()   # must come before switching to WAL
+        if wal:
+            self.c.execute("PRAGMA journal_mode=WAL")
+            # NORMAL is durable across app crashes in WAL mode; only an OS
+            # crash/power cut can lose the last few commits.
+            self.c.execute("PRAGMA synchronous=NORMAL")
         self._init_schema()
         self._migrate_schema()
-        logger.info("✅ TitanDB v22 initialized.")
+        self._ensure_recall_index()
+        self._check_query_plans()
+        self.write_behind = write_behind
+        self._queue = queue.Queue()
+        if write_behind:
+            threading.Thread(
+                target=self._writer_loop, name=f"titandb-writer-{os.path.basename(path)}", daemon=True
+            ).start()
+
+    # ── READ PATH ────────────────────────────────────────────────────────────
+    def _reader(self):
+        """Cursor on this thread's own read-only connection. In WAL mode
+        readers see the last committed snapshot and never wait on the writer
+        or on each other. Without WAL they share the writer connection, which
+        is how reads worked before."""
+        if not self.wal:
+            return self.conn.cursor()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            conn.row_factory = sqlite3.Row
+            conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+            self._local.conn = conn
+        return conn.cursor()
+
+    # ── WRITE PATH ───────────────────────────────────────────────────────────
+    def _write(self, *stmts, wait=False):
+        """Apply one or more (sql, params) statements as a single unit.
+
+        In write-behind mode the unit is queued for the writer thread and
+        this returns immediately; wait=True additionally blocks until it is
+        committed (for callers that re-read the row straight away, e.g. a
+        settings toggle followed by redrawing the menu)."""
+        if not self.write_behind:
+            with self._lock:
+                for sql, params in stmts:
+                    self._wc.execute(sql, params)
+                self.conn.commit()
+            return
+        self._queue.put(stmts)
+        if wait:
+            self.flush()
+
+    def flush(self, timeout=None):
+        """Barrier: returns once every write queued before this call has
+        been committed. No-op when write-behind is off."""
+        if not self.write_behind:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def _writer_loop(self):
+        interval = DB_FLUSH_INTERVAL_MS / 1000
+        while True:
+            batch = [self._queue.get()]
+            rows = 0 if isinstance(batch[0], threading.Event) else len(batch[0])
+            deadline = time.monotonic() + interval
+            while rows < DB_FLUSH_MAX_ROWS and not isinstance(batch[-1], threading.Event):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                if not isinstance(item, threading.Event):
+                    rows += len(item)
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch):
+        """One transaction for the whole batch. Each unit runs inside its own
+        SAVEPOINT so a single bad statement is rolled back and logged without
+        taking the rest of the batch down with it."""
+        barriers = [item for item in batch if isinstance(item, threading.Event)]
+        units = [item for item in batch if not isinstance(item, threading.Event)]
+        try:
+            if units:
+                with self._lock:
+                    # IMMEDIATE: take the file's write lock up front (waiting
+                    # up to busy_timeout if another bot process holds it)
+                    # rather than failing part-way through the batch.
+                    self._wc.execute("BEGIN IMMEDIATE")
+                    for unit in units:
+                        self._wc.execute("SAVEPOINT unit")
+                        try:
+                            for sql, params in unit:
+                                self._wc.execute(sql, params)
+                            self._wc.execute("RELEASE unit")
+                        except sqlite3.Error as e:
+                            self._wc.execute("ROLLBACK TO unit")
+                            self._wc.execute("RELEASE unit")
+                            logger.error(f"TitanDB write failed: {e} | {unit[0][0][:80]}")
+                    self.conn.commit()
+        except Exception as e:
+            logger.error(f"TitanDB batch commit failed ({len(units)} units): {e}")
+            try:
+                self.conn.rollback()
+            except Exception:
+                pass
+        finally:
+            for done in barriers:
+                done.set()
+
+    # Exact values for every get_stats() counter. Used to seed stats_counters
+    # and by reconcile_stats() to correct any drift.
+    STATS_EXACT = {
+        "total_users"    : "SELECT COUNT(*) FROM users",
+        "total_messages" : "SELECT COUNT(*) FROM memory",
+        "total_chats"    : "SELECT COUNT(*) FROM chat_registry",
+        "total_queries"  : "SELECT COALESCE(SUM(total_queries),0) FROM users",
+        "banned"         : "SELECT COUNT(*) FROM banned_users",
+    }
+    _STATS_RESEED = tuple(
+        f"INSERT OR REPLACE INTO stats_counters (name,value) SELECT '{name}', ({sql})"
+        for name, sql in STATS_EXACT.items()
+    )
+    # Added by migration 4. Not shown on its own: get_stats() folds it into
+    # total_messages so compaction doesn't make the message count go
+    # backwards. Kept out of STATS_EXACT because migration 3 reseeds from
+    # that, before memory_archive's counter exists.
+    STATS_ARCHIVE = {
+        "archived_messages": "SELECT COALESCE(SUM(n_rows),0) FROM memory_archive WHERE scope='user'",
+    }
+    _ARCHIVE_RESEED = tuple(
+        f"INSERT OR REPLACE INTO stats_counters (name,value) SELECT '{name}', ({sql})"
+        for name, sql in STATS_ARCHIVE.items()
+    )
+
+    # The long-term recall index, per history table: (create, backfill). Run
+    # by migration 8, and again by _ensure_recall_index for a DB that passed
+    # v8 on a Python whose SQLite had no FTS5 (see there).
+    _RECALL_FTS = {
+        table: (
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5("
+            " terms, owner, content UNINDEXED, role UNINDEXED, ts UNINDEXED,"
+            " tokenize='unicode61 remove_diacritics 2')",
+            f"INSERT INTO {table}_fts (rowid,terms,owner,content,role,ts) "
+            f"SELECT id, titan_recall_terms({col}, content), titan_recall_owner({col}), "
+            f"content, role, ts FROM {table}",
+        )
+        for table, col in (("memory", "uid"), ("group_memory", "chat_id"))
+    }
+
+    # Versioned schema migrations. Step N is applied once, inside a single
+    # transaction, and then PRAGMA user_version is set to N. Only ever append
+    # new steps — never edit or reorder one that has already shipped.
+    MIGRATIONS = [
+        # 1 — V22 columns for DB files carried over from V21.
+        (
+            "ALTER TABLE users ADD COLUMN voice_reply INTEGER DEFAULT 0",
+            "ALTER TABLE memory ADD COLUMN chat_id INTEGER DEFAULT 0",
+            "ALTER TABLE memory ADD COLUMN author TEXT DEFAULT ''",
+        ),
+        # 2 — indexes for the hot read paths (see HOT_QUERIES). memory and
+        # group_memory only grow, so without these every turn got slower.
+        (
+            "CREATE INDEX IF NOT EXISTS idx_memory_uid_id ON memory(uid, id)",
+            "CREATE INDEX IF NOT EXISTS idx_group_memory_chat_id ON group_memory(chat_id, id)",
+            "CREATE INDEX IF NOT EXISTS idx_analytics_event_ts ON analytics(event, ts)",
+            "CREATE INDEX IF NOT EXISTS idx_users_total_queries ON users(total_queries)",
+        ),
+        # 3 — get_stats() used to run five aggregate scans on every dashboard
+        # refresh. Triggers now keep running totals in stats_counters, in the
+        # same transaction as the write that changes them.
+        (
+            "CREATE TABLE IF NOT EXISTS stats_counters ("
+            " name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)",
+            """CREATE TRIGGER IF NOT EXISTS trg_stats_users_ins AFTER INSERT ON users BEGIN
+                UPDATE stats_counters SET value=value+1 WHERE name='total_users';
+                UPDATE stats_counters SET value=value+COALESCE(NEW.total_queries,0) WHERE name='total_queries';
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS trg_stats_users_del AFTER DELETE ON users BEGIN
+                UPDATE stats_counters SET value=value-1 WHERE name='total_users';
+                UPDATE stats_counters SET value=value-COALESCE(OLD.total_queries,0) WHERE name='total_queries';
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS trg_stats_users_queries AFTER UPDATE OF total_queries ON users BEGIN
+                UPDATE stats_counters
+                SET value=value+COALESCE(NEW.total_queries,0)-COALESCE(OLD.total_queries,0)
+                WHERE name='total_queries';
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS trg_stats_memory_ins AFTER INSERT ON memory BEGIN
+                UPDATE stats_counters SET value=value+1 WHERE name='total_messages';
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS trg_stats_memory_del AFTER DELETE ON memory BEGIN
+                UPDATE stats_counters SET value=value-1 WHERE name='total_messages';
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS trg_stats_chats_ins AFTER INSERT ON chat_registry BEGIN
+                UPDATE stats_counters SET value=value+1 WHERE name='total_chats';
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS trg_stats_chats_del AFTER DELETE ON chat_registry BEGIN
+                UPDATE stats_counters SET value=value-1 WHERE name='total_chats';
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS trg_stats_banned_ins AFTER INSERT ON banned_users BEGIN
+                UPDATE stats_counters SET value=value+1 WHERE name='banned';
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS trg_stats_banned_del AFTER DELETE ON banned_users BEGIN
+                UPDATE stats_counters SET value=value-1 WHERE name='banned';
+            END""",
+        ) + _STATS_RESEED,
+        # 4 — retention/compaction archive (table itself is in _init_schema).
+        (
+            "CREATE INDEX IF NOT EXISTS idx_memory_archive_key ON memory_archive(scope, key, first_id)",
+            "INSERT OR REPLACE INTO stats_counters (name,value) "
+            "SELECT 'archived_messages', COALESCE(SUM(n_rows),0) FROM memory_archive WHERE scope='user'",
+            """CREATE TRIGGER IF NOT EXISTS trg_stats_archive_ins AFTER INSERT ON memory_archive
+               WHEN NEW.scope='user' BEGIN
+                UPDATE stats_counters SET value=value+NEW.n_rows WHERE name='archived_messages';
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS trg_stats_archive_del AFTER DELETE ON memory_archive
+               WHEN OLD.scope='user' BEGIN
+                UPDATE stats_counters SET value=value-OLD.n_rows WHERE name='archived_messages';
+            END""",
+        ),
+        # 5 — hourly analytics rollups, filled by a trigger on every raw
+        # insert and backfilled from whatever raw history exists. Free-text
+        # details (document topics) are folded into '' so the key space
+        # stays (event, engine/model/direction, hour).
+        (
+            "CREATE TABLE IF NOT EXISTS analytics_hourly ("
+            " event TEXT NOT NULL, detail TEXT NOT NULL, hour TEXT NOT NULL,"
+            " n INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (event, detail, hour)) WITHOUT ROWID",
+            "CREATE INDEX IF NOT EXISTS idx_analytics_hourly_hour ON analytics_hourly(hour)",
+            """CREATE TRIGGER IF NOT EXISTS trg_analytics_hourly AFTER INSERT ON analytics BEGIN
+                INSERT INTO analytics_hourly (event,detail,hour,n) VALUES (
+                    COALESCE(NEW.event,''),
+                    CASE WHEN NEW.event IN ('pdf_created','zip_created','word_created')
+                         THEN '' ELSE COALESCE(NEW.detail,'') END,
+                    strftime('%Y-%m-%d %H:00', COALESCE(NEW.ts, CURRENT_TIMESTAMP)),
+                    1)
+                ON CONFLICT(event,detail,hour) DO UPDATE SET n=n+1;
+            END""",
+            """INSERT INTO analytics_hourly (event,detail,hour,n)
+               SELECT COALESCE(event,''),
+                      CASE WHEN event IN ('pdf_created','zip_created','word_created')
+                           THEN '' ELSE COALESCE(detail,'') END,
+                      strftime('%Y-%m-%d %H:00', ts), COUNT(*)
+               FROM analytics WHERE ts IS NOT NULL GROUP BY 1,2,3
+               ON CONFLICT(event,detail,hour) DO UPDATE SET n=n+excluded.n""",
+        ),
+        # 6 — per-DB settings that must never change once data exists
+        # (currently just the shard count, see TitanDB._check_layout).
+        (
+            "CREATE TABLE IF NOT EXISTS titan_meta (key TEXT PRIMARY KEY, value TEXT)",
+        ),
+        # 7 — rolling conversation summaries (see ConversationSummarizer).
+        # upto_id is the newest memory / group_memory id folded into summary.
+        (
+            "CREATE TABLE IF NOT EXISTS memory_summary ("
+            " scope TEXT NOT NULL, key INTEGER NOT NULL, summary TEXT NOT NULL DEFAULT '',"
+            " upto_id INTEGER NOT NULL DEFAULT 0, n_turns INTEGER NOT NULL DEFAULT 0,"
+            " updated_at TEXT DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (scope, key)) WITHOUT ROWID",
+        ),
+        # 8 — FTS5 index for long-term recall, one per history table, rowid =
+        # source row id. Every word is indexed prefixed with its owner
+        # ('k123zpython' for uid 123, 'kn100zpython' for chat -100), so a
+        # lookup only ever walks that conversation's posting lists, however
+        # big the table gets — and BM25's IDF is per conversation too.
+        # `owner` (the bare 'k123') is only there for /clear. The row's own
+        # text is kept alongside, so archived turns can still be recalled.
+        # Filled by add_memory / add_group_memory. Empty without FTS5.
+        tuple(stmt for stmts in _RECALL_FTS.values() for stmt in stmts) if HAS_FTS5 else (),
+    ]
+
+    # Queries on the per-message path, with sample params. _check_query_plans()
+    # runs EXPLAIN QUERY PLAN on each at startup and complains loudly if one
+    # falls back to a full table scan. Keep in sync with the methods below.
+    HOT_QUERIES = {
+        "get_user"          : ("SELECT * FROM users WHERE uid=?", (0,)),
+        "is_banned"         : ("SELECT 1 FROM banned_users WHERE uid=?", (0,)),
+        "get_history"       : ("SELECT id,role,content FROM memory WHERE uid=? AND id>? "
+                               "ORDER BY id DESC LIMIT ?", (0, 0, 8)),
+        "get_group_history" : ("SELECT id,role,author,content FROM group_memory WHERE chat_id=? AND id>? "
+                               "ORDER BY id DESC LIMIT ?", (0, 0, 12)),
+        # (recall() is not listed: FTS5 plans always read "SCAN ... VIRTUAL TABLE")
+        "get_summary"       : ("SELECT summary,upto_id,n_turns FROM memory_summary WHERE scope=? AND key=?",
+                               ("user", 0)),
+        "clear_history"     : ("SELECT id FROM memory WHERE uid=?", (0,)),
+        "top_users"         : ("SELECT uid,name,username,total_queries,last_seen FROM users "
+                               "ORDER BY total_queries DESC LIMIT ?", (20,)),
+        "analytics_window"  : ("SELECT COUNT(*) FROM analytics WHERE event=? AND ts>=?", ("ai_query", "")),
+        "analytics_rollup"  : ("SELECT detail,SUM(n) FROM analytics_hourly WHERE event=? AND hour>=? "
+                               "GROUP BY detail", ("ai_query", "")),
+    }
+
+    # ── Recall index terms (see migration 8) ──────────────────────
+    _RECALL_WORDS = re.compile(r"\w{3,}")
+    RECALL_STOPWORDS = frozenset(
+        "the and for you that this with are was have what how can not but from your "
+        "hai hain kya aur mein main nahi bhi koi yeh woh kar karo tha thi mujhe tum "
+        "aap hum kaise kyun kab yahan wahan".split()
+    )
+
+    @staticmethod
+    def fts_owner(key):
+        """The token a uid / chat_id owns its index entries under."""
+        return f"k{key}".replace("-", "n")
+
+    @classmethod
+    def recall_terms(cls, key, text):
+        """The words of text (3+ letters, lowercased, stopwords dropped),
+        each prefixed with key's owner token, space-separated."""
+        owner = cls.fts_owner(key)
+        return " ".join(f"{owner}z{w}" for w in cls._RECALL_WORDS.findall((text or "").lower())
+                        if w not in cls.RECALL_STOPWORDS)
 
     def _migrate_schema(self):
-        """Safely add new columns if upgrading from an older DB file."""
+        """Bring an existing DB file up to len(MIGRATIONS). BEGIN IMMEDIATE
+        takes SQLite's write lock before user_version is read, so two bot
+        processes starting together can't both apply the same step."""
         with self._lock:
-            for stmt in (
-                "ALTER TABLE users ADD COLUMN voice_reply INTEGER DEFAULT 0",
-                "ALTER TABLE memory ADD COLUMN chat_id INTEGER DEFAULT 0",
-                "ALTER TABLE memory ADD COLUMN author TEXT DEFAULT ''",
-            ):
+            for version, stmts in enumerate(self.MIGRATIONS, start=1):
+                self.c.execute("BEGIN IMMEDIATE")
                 try:
-                    self.c.execute(stmt)
+                    current = self.c.execute("PRAGMA user_version").fetchone()[0]
+                    if current >= version:
+                        self.conn.rollback()
+                        continue
+                    for stmt in stmts:
+                        try:
+                            self.c.execute(stmt)
+                        except sqlite3.OperationalError as e:
+                            if "duplicate column" not in str(e):
+                                raise
+                    self.c.execute(f"PRAGMA user_version={version}")
                     self.conn.commit()
-                except sqlite3.OperationalError:
-                    pass  # column already exists
+                    logger.info(f"TitanDB schema migrated to v{version}")
+                except Exception:
+                    self.conn.rollback()
+                    raise
+
+    def _ensure_recall_index(self):
+        """Sets has_fts: whether this file's recall tables exist and may be
+        written. Migration 8 is empty without FTS5 but user_version still
+        moves past it, so a DB first opened by such a Python never gets the
+        tables; with FTS5 available now, build (and backfill) any that are
+        missing. Without FTS5, or if the build fails, recall is simply off
+        for this shard — never an INSERT into a missing table, which would
+        roll back the memory row queued with it."""
+        def absent():
+            return [t for t in self._RECALL_FTS if not self.c.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (f"{t}_fts",)).fetchone()]
+
+        with self._lock:
+            missing = absent()
+            if missing and HAS_FTS5:
+                self.c.execute("BEGIN IMMEDIATE")
+                try:
+                    for table in absent():   # re-read under the write lock: another process may have won
+                        for stmt in self._RECALL_FTS[table]:
+                            self.c.execute(stmt)
+                    self.conn.commit()
+                    logger.warning(f"TitanDB recall index was missing in {self.path} "
+                                   f"({', '.join(missing)}) — rebuilt")
+                    missing = []
+                except sqlite3.Error as e:
+                    self.conn.rollback()
+                    logger.error(f"TitanDB recall index build failed in {self.path}: {e}")
+        self.has_fts = HAS_FTS5 and not missing
+
+    def explain_hot_queries(self):
+        """Returns {name: [plan detail, ...]} for every query in HOT_QUERIES."""
+        cur = self._reader()
+        return {
+            name: [row[3] for row in cur.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+            for name, (sql, params) in self.HOT_QUERIES.items()
+        }
+
+    def slow_query_plans(self):
+        """Hot queries whose plan has a full table scan or a temp sort."""
+        bad = {}
+        for name, plan in self.explain_hot_queries().items():
+            for step in plan:
+                if (step.startswith("SCAN") and "USING" not in step) or "TEMP B-TREE" in step:
+                    bad[name] = plan
+                    break
+        return bad
+
+    def _check_query_plans(self):
+        try:
+            for name, plan in self.slow_query_plans().items():
+                logger.warning(f"TitanDB: hot query '{name}' is not index-backed: {' | '.join(plan)}")
+        except sqlite3.Error as e:
+            logger.warning(f"TitanDB: query plan check skipped: {e}")
 
     def _init_schema(self):
         with self._lock:
@@ -311,202 +1017,1672 @@ class TitanDB:
                     reason    TEXT,
                     banned_at TEXT DEFAULT CURRENT_TIMESTAMP
                 );
+
+                CREATE TABLE IF NOT EXISTS memory_archive (
+                    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+                    scope     TEXT,       -- 'user' (memory) or 'group' (group_memory)
+                    key       INTEGER,    -- uid or chat_id
+                    first_id  INTEGER,
+                    last_id   INTEGER,
+                    first_ts  TEXT,
+                    last_ts   TEXT,
+                    n_rows    INTEGER,
+                    payload   BLOB        -- zlib(JSON list of the archived rows)
+                );
             """)
             self.conn.commit()
 
+    def _enable_incremental_vacuum(self):
+        """auto_vacuum can only be switched before the first table exists
+        (or by a full VACUUM), and VACUUM can't change it once the file is in
+        WAL mode — so this runs before the journal_mode pragma."""
+        if self.c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return
+        self.c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        if self.c.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+            logger.info(f"TitanDB: one-time VACUUM of {self.path} to enable incremental auto_vacuum")
+            try:
+                self.c.execute("PRAGMA journal_mode=DELETE")
+                self.c.execute("VACUUM")
+            except sqlite3.OperationalError as e:
+                # Another bot process has the file open; the next lone start does it.
+                logger.warning(f"TitanDB: VACUUM skipped ({e}), incremental vacuum stays off for now")
+
+    # Queue it in the same unit as the users write it announces.
+    BUMP_USERS_EPOCH = (
+        "INSERT INTO titan_meta (key,value) VALUES ('users_epoch','1') "
+        "ON CONFLICT(key) DO UPDATE SET value=CAST(value AS INTEGER)+1", ()
+    )
+
+    def users_epoch(self):
+        """This file's users_epoch, re-read at most every USER_EPOCH_CHECK
+        seconds. A cached users row tagged with an older one is stale —
+        some process (maybe this one) has changed a row it can't patch."""
+        now = time.monotonic()
+        if now - self._epoch_at >= USER_EPOCH_CHECK:
+            row = self._reader().execute("SELECT value FROM titan_meta WHERE key='users_epoch'").fetchone()
+            self._epoch, self._epoch_at = (row[0] if row else "0"), now
+        return self._epoch
+
+    def execute_now(self, sql, params=()):
+        """Run one write synchronously, bypassing the queue. Returns rowcount
+        for callers that need it (call flush() first if it depends on queued
+        writes)."""
+        with self._lock:
+            self._wc.execute(sql, params)
+            self.conn.commit()
+            return self._wc.rowcount
+
+    def archive_rows(self, scope, table, col, key, cutoff_id):
+        """Moves the oldest COMPACT_BATCH_ROWS rows with id <= cutoff_id for
+        one key into memory_archive (or drops them). Returns the number of
+        rows moved."""
+        with self._lock:
+            self._wc.execute("BEGIN IMMEDIATE")
+            try:
+                rows = [dict(r) for r in self._wc.execute(
+                    f"SELECT * FROM {table} WHERE {col}=? AND id<=? ORDER BY id LIMIT ?",
+                    (key, cutoff_id, COMPACT_BATCH_ROWS)
+                )]
+                if rows:
+                    first, last = rows[0], rows[-1]
+                    if MEMORY_ARCHIVE:
+                        self._wc.execute(
+                            "INSERT INTO memory_archive "
+                            "(scope,key,first_id,last_id,first_ts,last_ts,n_rows,payload) "
+                            "VALUES (?,?,?,?,?,?,?,?)",
+                            (scope, key, first["id"], last["id"], first["ts"], last["ts"], len(rows),
+                             zlib.compress(json.dumps(rows, ensure_ascii=False).encode(), 6))
+                        )
+                    elif self.has_fts:
+                        # Dropped outright: take them out of the recall index too.
+                        self._wc.executemany(f"DELETE FROM {table}_fts WHERE rowid=?",
+                                             [(r["id"],) for r in rows])
+                    self._wc.execute(
+                        f"DELETE FROM {table} WHERE {col}=? AND id BETWEEN ? AND ?",
+                        (key, first["id"], last["id"])
+                    )
+                self.conn.commit()
+                return len(rows)
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def _vacuum_step(self, pages=COMPACT_VACUUM_PAGES):
+        """Hands up to `pages` free pages back to the filesystem."""
+        with self._lock:
+            self._wc.execute(f"PRAGMA incremental_vacuum({pages})").fetchall()
+            self.conn.commit()
+
+
+class TitanDB:
+    """The bot's storage API. Every row lives in exactly one SQLiteShard:
+    users, memory, banned users and analytics by uid; group memory and the
+    chat registry by chat_id. Totals are summed across shards."""
+
+    def __init__(self, path=DB_PATH, write_behind=DB_WRITE_BEHIND, wal=DB_WAL, shards=DB_SHARDS):
+        self.path = path
+        self.shards = [
+            SQLiteShard(self.shard_path(path, i), write_behind, wal) for i in range(max(1, shards))
+        ]
+        self._check_layout()
+        self.user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        # uid -> token replaced on every change to that user's row. get_user
+        # only caches what it read if the token is the same as before the
+        # read, so a slow read-miss can't put back a row that update_config
+        # or ban_user has just invalidated.
+        self._user_gen = TTLCache(USER_CACHE_SIZE, 300)
+        self._user_fill_lock = threading.Lock()
+        # Keys that got new memory rows since the last compaction run.
+        self._compact_dirty = {"user": set(), "group": set()}
+        self._compact_sweep = True   # first run checks every key once
+        # uid -> (name, username) last written; expiry = next last_seen write.
+        self._seen_users = TTLCache(USER_CACHE_SIZE, USER_SEEN_INTERVAL)
+        self._known_chats = set()
+        self._chat_counts = {}       # chat_id -> msg_count increments not yet written
+        self._chat_counts_lock = threading.Lock()
+        if write_behind:
+            atexit.register(self.flush, 5)
+        logger.info(
+            f"✅ TitanDB v22 initialized ({len(self.shards)} shard(s), "
+            f"write-behind={'ON' if write_behind else 'OFF'}, journal={'WAL' if wal else 'DELETE'})."
+        )
+
+    @staticmethod
+    def shard_path(path, i):
+        """Shard 0 is the configured file itself, so an unsharded DB is
+        simply a one-shard DB; the others sit next to it."""
+        if i == 0:
+            return path
+        root, ext = os.path.splitext(path)
+        return f"{root}.shard{i}{ext or '.db'}"
+
+    def _shard(self, key):
+        return self.shards[key % len(self.shards)]
+
+    def _check_layout(self):
+        """Rows are placed by key % shard count, so changing TITAN_DB_SHARDS
+        on an existing DB would silently hide most of it. The count is
+        recorded in shard 0 on first start and checked on every start."""
+        s0 = self.shards[0]
+        with s0._lock:
+            s0.c.execute("BEGIN IMMEDIATE")
+            try:
+                row = s0.c.execute("SELECT value FROM titan_meta WHERE key='shards'").fetchone()
+                if row is None:
+                    # A file with data but no record predates sharding: one shard.
+                    legacy = s0.c.execute(
+                        "SELECT EXISTS(SELECT 1 FROM users) OR EXISTS(SELECT 1 FROM group_memory)"
+                    ).fetchone()[0]
+                    recorded = 1 if legacy else len(self.shards)
+                    s0.c.execute("INSERT INTO titan_meta (key,value) VALUES ('shards',?)", (str(recorded),))
+                else:
+                    recorded = int(row[0])
+                s0.conn.commit()
+            except Exception:
+                s0.conn.rollback()
+                raise
+        if recorded != len(self.shards):
+            raise RuntimeError(
+                f"{self.path} holds a {recorded}-shard TitanDB but TITAN_DB_SHARDS={len(self.shards)}; "
+                f"the shard count can't be changed on an existing database."
+            )
+
+    def flush(self, timeout=None):
+        """Barrier across every shard (see SQLiteShard.flush). Pending chat
+        message counters are queued first so they're included."""
+        self.flush_chat_counts()
+        return all([shard.flush(timeout) for shard in self.shards])
+
+    def explain_hot_queries(self):
+        return self.shards[0].explain_hot_queries()
+
+    def slow_query_plans(self):
+        return self.shards[0].slow_query_plans()
+
     # ── USER MANAGEMENT ──────────────────────────────────────────────────────
     def sync_user(self, uid, name, username):
-        with self._lock:
-            self.c.execute(
-                "INSERT OR IGNORE INTO users (uid,name,username) VALUES (?,?,?)",
-                (uid, name, username)
+        """Called on every message and button press. Only writes when the
+        user is new to this process, their name/username changed, or
+        last_seen is more than USER_SEEN_INTERVAL old."""
+        seen = self._seen_users.get(uid)
+        if seen == (name, username):
+            return
+        self._seen_users.set(uid, (name, username))
+        if seen is None:
+            self._shard(uid)._write(
+                ("INSERT OR IGNORE INTO users (uid,name,username) VALUES (?,?,?)",
+                 (uid, name, username)),
+                ("UPDATE users SET name=?,username=?,last_seen=CURRENT_TIMESTAMP WHERE uid=?",
+                 (name, username, uid)),
             )
-            self.c.execute(
+        else:
+            self._shard(uid)._write((
                 "UPDATE users SET name=?,username=?,last_seen=CURRENT_TIMESTAMP WHERE uid=?",
                 (name, username, uid)
-            )
-            self.conn.commit()
+            ))
+        self._user_changed(uid, lambda u: u.update(name=name, username=username))
 
     def register_user(self, uid, password):
-        with self._lock:
-            self.c.execute(
-                "UPDATE users SET password=?,registered=1 WHERE uid=?",
-                (password, uid)
-            )
-            self.conn.commit()
-            return self.c.rowcount > 0
+        # Needs the rowcount, so this one stays synchronous — flush first so
+        # the user row queued by sync_user() is actually there to update.
+        self.flush()
+        shard = self._shard(uid)
+        updated = shard.execute_now(
+            "UPDATE users SET password=?,registered=1 WHERE uid=?",
+            (password, uid)
+        ) > 0
+        shard.execute_now(*shard.BUMP_USERS_EPOCH)
+        self._user_changed(uid)
+        return updated
 
     def login_user(self, uid, password):
-        self.c.execute("SELECT password FROM users WHERE uid=?", (uid,))
-        row = self.c.fetchone()
+        shard = self._shard(uid)
+        row = shard._reader().execute("SELECT password FROM users WHERE uid=?", (uid,)).fetchone()
         if row and row["password"] == password:
-            with self._lock:
-                self.c.execute("UPDATE users SET logged_in=1 WHERE uid=?", (uid,))
-                self.conn.commit()
+            shard._write(("UPDATE users SET logged_in=1 WHERE uid=?", (uid,)), shard.BUMP_USERS_EPOCH, wait=True)
+            self._user_changed(uid)
             return True
         return False
 
     def logout_user(self, uid):
-        with self._lock:
-            self.c.execute("UPDATE users SET logged_in=0 WHERE uid=?", (uid,))
-            self.conn.commit()
+        self._shard(uid)._write(("UPDATE users SET logged_in=0 WHERE uid=?", (uid,)),
+                                SQLiteShard.BUMP_USERS_EPOCH, wait=True)
+        self._user_changed(uid)
+
+    def _user_changed(self, uid, patch=None):
+        """Invalidate (or patch in place) the cached row after a write.
+        Other processes find out through the shard's users_epoch — only
+        bumped by writes they can't afford to miss (not last_seen, not
+        total_queries)."""
+        with self._user_fill_lock:
+            self._user_gen.set(uid, object())
+            if patch is None:
+                self.user_cache.pop(uid)
+            else:
+                self.user_cache.patch(uid, lambda entry: patch(entry[1]))
 
     def get_user(self, uid):
-        self.c.execute("SELECT * FROM users WHERE uid=?", (uid,))
-        row = self.c.fetchone()
-        return dict(row) if row else {
-            "engine": "auto", "mode": "chat", "deep_think": 0,
-            "logged_in": 1, "registered": 0, "role": "user",
-            "total_queries": 0, "name": "User", "banned": 0,
-        }
+        shard = self._shard(uid)
+        epoch = shard.users_epoch()
+        cached = self.user_cache.get(uid)       # (users_epoch, row)
+        if cached is not None and cached[0] == epoch:
+            return dict(cached[1])
+        gen = self._user_gen.get(uid)
+        row = shard._reader().execute("SELECT * FROM users WHERE uid=?", (uid,)).fetchone()
+        if not row:
+            # Not cached: the row may just be sitting in the write queue.
+            return {
+                "engine": "auto", "mode": "chat", "deep_think": 0,
+                "logged_in": 1, "registered": 0, "role": "user",
+                "total_queries": 0, "name": "User", "banned": 0,
+            }
+        user = dict(row)
+        with self._user_fill_lock:
+            if self._user_gen.get(uid) is gen:
+                self.user_cache.set(uid, (epoch, user))
+        return dict(user)
 
     def update_config(self, uid, key, val):
-        with self._lock:
-            self.c.execute(f"UPDATE users SET {key}=? WHERE uid=?", (val, uid))
-            self.conn.commit()
+        # wait=True: every caller redraws a menu from get_user() right after,
+        # and dropping the entry only after the commit means the next read
+        # can't re-cache the old value.
+        self._shard(uid)._write((f"UPDATE users SET {key}=? WHERE uid=?", (val, uid)),
+                                SQLiteShard.BUMP_USERS_EPOCH, wait=True)
+        self._user_changed(uid)
 
     def increment_queries(self, uid):
-        with self._lock:
-            self.c.execute(
-                "UPDATE users SET total_queries=total_queries+1 WHERE uid=?", (uid,)
-            )
-            self.conn.commit()
+        self._shard(uid)._write(("UPDATE users SET total_queries=total_queries+1 WHERE uid=?", (uid,)))
+        self._user_changed(uid, lambda u: u.update(total_queries=(u.get("total_queries") or 0) + 1))
 
     def ban_user(self, uid, reason=""):
-        with self._lock:
-            self.c.execute(
-                "INSERT OR REPLACE INTO banned_users (uid,reason) VALUES (?,?)",
-                (uid, reason)
-            )
-            self.c.execute("UPDATE users SET banned=1 WHERE uid=?", (uid,))
-            self.conn.commit()
+        # An upsert rather than INSERT OR REPLACE: REPLACE deletes the old row
+        # without firing the DELETE trigger, which would double-count bans.
+        self._shard(uid)._write(
+            ("INSERT INTO banned_users (uid,reason) VALUES (?,?) "
+             "ON CONFLICT(uid) DO UPDATE SET reason=excluded.reason, banned_at=CURRENT_TIMESTAMP",
+             (uid, reason)),
+            ("UPDATE users SET banned=1 WHERE uid=?", (uid,)),
+            SQLiteShard.BUMP_USERS_EPOCH,
+            wait=True,
+        )
+        self._user_changed(uid)
 
     def unban_user(self, uid):
-        with self._lock:
-            self.c.execute("DELETE FROM banned_users WHERE uid=?", (uid,))
-            self.c.execute("UPDATE users SET banned=0 WHERE uid=?", (uid,))
-            self.conn.commit()
+        self._shard(uid)._write(
+            ("DELETE FROM banned_users WHERE uid=?", (uid,)),
+            ("UPDATE users SET banned=0 WHERE uid=?", (uid,)),
+            SQLiteShard.BUMP_USERS_EPOCH,
+            wait=True,
+        )
+        self._user_changed(uid)
 
     def is_banned(self, uid):
-        self.c.execute("SELECT 1 FROM banned_users WHERE uid=?", (uid,))
-        return self.c.fetchone() is not None
+        return self._shard(uid)._reader().execute(
+            "SELECT 1 FROM banned_users WHERE uid=?", (uid,)
+        ).fetchone() is not None
 
     def get_all_uids(self):
-        self.c.execute("SELECT uid FROM users")
-        return [r["uid"] for r in self.c.fetchall()]
+        return [r["uid"] for shard in self.shards for r in shard._reader().execute("SELECT uid FROM users")]
 
-    # ── MEMORY (conversation history) ────────────────────────────────────────
-    def add_memory(self, uid, role, content, engine=""):
-        with self._lock:
-            self.c.execute(
-                "INSERT INTO memory (uid,role,content,engine) VALUES (?,?,?,?)",
-                (uid, role, content, engine)
+    def top_users(self, limit=20):
+        rows = [
+            r for shard in self.shards for r in shard._reader().execute(
+                "SELECT uid,name,username,total_queries,last_seen FROM users "
+                "ORDER BY total_queries DESC LIMIT ?", (limit,)
             )
-            self.conn.commit()
+        ]
+        return sorted(rows, key=lambda r: r["total_queries"] or 0, reverse=True)[:limit]
 
-    def get_history(self, uid, limit=10):
-        self.c.execute(
-            "SELECT role,content FROM memory WHERE uid=? ORDER BY id DESC LIMIT ?",
-            (uid, limit)
-        )
-        rows = self.c.fetchall()
+    # ── MEMORY (conversation history) ────────────────────────────────────────
+    def add_memory(self, uid, role, content, engine=""):
+        self._shard(uid)._write((
+            "INSERT INTO memory (uid,role,content,engine) VALUES (?,?,?,?)",
+            (uid, role, content, engine)
+        ), *self._recall_index("memory", uid, role, content))
+        self._compact_dirty["user"].add(uid)
+
+    def get_history(self, uid, limit=10, after_id=0):
+        """Last `limit` turns, oldest first; after_id skips the turns a
+        rolling summary already covers."""
+        rows = self._shard(uid)._reader().execute(
+            "SELECT id,role,content FROM memory WHERE uid=? AND id>? ORDER BY id DESC LIMIT ?",
+            (uid, after_id, limit)
+        ).fetchall()
         return list(reversed(rows))
 
     def clear_history(self, uid):
-        with self._lock:
-            self.c.execute("DELETE FROM memory WHERE uid=?", (uid,))
-            self.conn.commit()
+        self._shard(uid)._write(
+            ("DELETE FROM memory WHERE uid=?", (uid,)),
+            ("DELETE FROM memory_archive WHERE scope='user' AND key=?", (uid,)),
+            ("DELETE FROM memory_summary WHERE scope='user' AND key=?", (uid,)),
+            *self._recall_forget("memory", uid),
+            wait=True,
+        )
 
     # ── GROUP MEMORY (shared per-chat history) ───────────────────────────────
     def add_group_memory(self, chat_id, role, content, author="", engine=""):
-        with self._lock:
-            self.c.execute(
+        self._shard(chat_id)._write((
+            "INSERT INTO group_memory (chat_id,role,author,content,engine) VALUES (?,?,?,?,?)",
+            (chat_id, role, author, content, engine)
+        ), *self._recall_index("group_memory", chat_id, role, content))
+        self._compact_dirty["group"].add(chat_id)
+
+    def add_group_memories(self, chat_id, rows):
+        """Bulk add_group_memory: rows of (role, content, author, engine),
+        queued as one batch so they commit together."""
+        stmts = []
+        for role, content, author, engine in rows:
+            stmts.append((
                 "INSERT INTO group_memory (chat_id,role,author,content,engine) VALUES (?,?,?,?,?)",
                 (chat_id, role, author, content, engine)
-            )
-            self.conn.commit()
+            ))
+            stmts.extend(self._recall_index("group_memory", chat_id, role, content))
+        if stmts:
+            self._shard(chat_id)._write(*stmts)
+            self._compact_dirty["group"].add(chat_id)
 
-    def get_group_history(self, chat_id, limit=12):
+    def get_group_history(self, chat_id, limit=12, after_id=0):
         """Returns recent shared history for a group chat, oldest first.
         User turns are prefixed with the speaker's name so the AI can follow
         a multi-person conversation instead of losing track of who said what."""
-        self.c.execute(
-            "SELECT role,author,content FROM group_memory WHERE chat_id=? ORDER BY id DESC LIMIT ?",
-            (chat_id, limit)
-        )
-        rows = list(reversed(self.c.fetchall()))
+        rows = list(reversed(self._shard(chat_id)._reader().execute(
+            "SELECT id,role,author,content FROM group_memory WHERE chat_id=? AND id>? ORDER BY id DESC LIMIT ?",
+            (chat_id, after_id, limit)
+        ).fetchall()))
         out = []
         for r in rows:
             content = r["content"]
             if r["role"] == "user" and r["author"]:
                 content = f"{r['author']}: {content}"
-            out.append({"role": r["role"], "content": content})
+            out.append({"id": r["id"], "role": r["role"], "content": content})
         return out
 
     def clear_group_history(self, chat_id):
-        with self._lock:
-            self.c.execute("DELETE FROM group_memory WHERE chat_id=?", (chat_id,))
-            self.conn.commit()
+        self._shard(chat_id)._write(
+            ("DELETE FROM group_memory WHERE chat_id=?", (chat_id,)),
+            ("DELETE FROM memory_archive WHERE scope='group' AND key=?", (chat_id,)),
+            ("DELETE FROM memory_summary WHERE scope='group' AND key=?", (chat_id,)),
+            *self._recall_forget("group_memory", chat_id),
+            wait=True,
+        )
 
-    def export_history(self, uid):
-        rows = self.get_history(uid, limit=200)
-        lines = []
-        for r in rows:
-            prefix = "👤 You" if r["role"] == "user" else "🤖 AI"
-            lines.append(f"{prefix}:\n{r['content']}\n{'─'*40}")
-        return "\n".join(lines) if lines else "No history found."
+    # ── ROLLING SUMMARIES ────────────────────────────────────────────────────
+    def get_summary(self, scope, key):
+        """{summary, upto_id, n_turns} for a uid ('user') or chat_id
+        ('group'), or None if nothing has been summarized yet."""
+        row = self._shard(key)._reader().execute(
+            "SELECT summary,upto_id,n_turns FROM memory_summary WHERE scope=? AND key=?",
+            (scope, key)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def get_unsummarized(self, scope, key, after_id=0, limit=200):
+        """Turns newer than after_id, oldest first, with their ids."""
+        table, col, _ = self.COMPACT_SCOPES[scope]
+        return [dict(r) for r in self._shard(key)._reader().execute(
+            f"SELECT id,role,author,content FROM {table} WHERE {col}=? AND id>? ORDER BY id LIMIT ?",
+            (key, after_id, limit)
+        )]
+
+    def set_summary(self, scope, key, summary, upto_id, n_turns):
+        """Store a newer summary. Written only if row upto_id still exists
+        (a /clear since the summarizer read it wins) and only forwards, so a
+        slow, stale summarizer run can't overwrite a newer one."""
+        table, col, _ = self.COMPACT_SCOPES[scope]
+        self._shard(key)._write((
+            f"INSERT INTO memory_summary (scope,key,summary,upto_id,n_turns) "
+            f"SELECT ?,?,?,?,? WHERE EXISTS (SELECT 1 FROM {table} WHERE {col}=? AND id=?) "
+            "ON CONFLICT(scope,key) DO UPDATE SET summary=excluded.summary, "
+            "upto_id=excluded.upto_id, n_turns=excluded.n_turns, updated_at=CURRENT_TIMESTAMP "
+            "WHERE excluded.upto_id > memory_summary.upto_id",
+            (scope, key, summary, upto_id, n_turns, key, upto_id)
+        ), wait=True)
+
+    # ── LONG-TERM RECALL (FTS5) ──────────────────────────────────────────────
+    def _recall_index(self, table, key, role, content):
+        """Statement indexing the row just inserted into table — queued right
+        behind its INSERT, so it lands in the same transaction."""
+        if not self._shard(key).has_fts:
+            return ()
+        return ((f"INSERT INTO {table}_fts (rowid,terms,owner,content,role,ts) "
+                 "VALUES (last_insert_rowid(),?,?,?,?,datetime('now'))",
+                 (SQLiteShard.recall_terms(key, content), SQLiteShard.fts_owner(key), content, role)),)
+
+    def _recall_forget(self, table, key):
+        if not self._shard(key).has_fts:
+            return ()
+        return ((f"DELETE FROM {table}_fts WHERE rowid IN "
+                 f"(SELECT rowid FROM {table}_fts WHERE {table}_fts MATCH ?)",
+                 (f'owner:"{SQLiteShard.fts_owner(key)}"',)),)
+
+    def recall(self, scope, key, text, before_id=None, limit=5, max_terms=12):
+        """Up to `limit` past turns of one conversation that best match
+        text (BM25 over its longest `max_terms` words, OR'ed), best first,
+        as dicts (id, role, content, ts). before_id skips the turns that
+        are being sent verbatim anyway."""
+        terms = sorted(set(SQLiteShard.recall_terms(key, text).split()), key=len, reverse=True)
+        if not self._shard(key).has_fts or not terms:
+            return []
+        table = self.COMPACT_SCOPES[scope][0]
+        try:
+            return [dict(r) for r in self._shard(key)._reader().execute(
+                f"SELECT rowid AS id, role, content, ts FROM {table}_fts "
+                f"WHERE {table}_fts MATCH ? AND rowid < ? "
+                f"ORDER BY bm25({table}_fts, 1.0, 0.0) LIMIT ?",
+                (" OR ".join(f'terms:"{t}"' for t in terms[:max_terms]),
+                 before_id if before_id is not None else 1 << 62, limit)
+            )]
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Recall lookup failed ({scope}:{key}): {e}")
+            return []
+
+    def iter_history(self, uid, since=None, until=None, batch=500):
+        """Every turn for uid, oldest first, as dicts (role, content,
+        engine, ts): archived batches first, then live rows through a cursor
+        read `batch` rows at a time. since/until are 'YYYY-MM-DD[ HH:MM:SS]'
+        strings (UTC, like the ts column); until is exclusive."""
+        self.flush()  # include the turns still sitting in the write queue
+        since, until = since or "", until or "9999"
+        shard = self._shard(uid)
+        archive = shard._reader().execute(
+            "SELECT payload FROM memory_archive WHERE scope='user' AND key=? "
+            "AND last_ts>=? AND first_ts<? ORDER BY first_id",
+            (uid, since, until)
+        )
+        for (payload,) in archive:
+            for r in self.unpack_archive(payload):
+                if since <= (r.get("ts") or "") < until:
+                    yield {k: r.get(k) for k in ("role", "content", "engine", "ts")}
+        cur = shard._reader().execute(
+            "SELECT role,content,engine,ts FROM memory WHERE uid=? AND ts>=? AND ts<? ORDER BY id",
+            (uid, since, until)
+        )
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                break
+            for r in rows:
+                yield dict(r)
 
     # ── CHAT REGISTRY ─────────────────────────────────────────────────────────
     def register_chat(self, chat_id, chat_type, title=""):
-        with self._lock:
-            self.c.execute(
-                "INSERT OR IGNORE INTO chat_registry (chat_id,chat_type,title) VALUES (?,?,?)",
-                (chat_id, chat_type, title)
-            )
-            self.conn.commit()
+        if chat_id in self._known_chats:
+            return
+        self._known_chats.add(chat_id)
+        self._shard(chat_id)._write((
+            "INSERT OR IGNORE INTO chat_registry (chat_id,chat_type,title) VALUES (?,?,?)",
+            (chat_id, chat_type, title)
+        ))
 
     def increment_chat_msg(self, chat_id):
-        with self._lock:
-            self.c.execute(
-                "UPDATE chat_registry SET msg_count=msg_count+1 WHERE chat_id=?",
-                (chat_id,)
-            )
-            self.conn.commit()
+        with self._chat_counts_lock:
+            self._chat_counts[chat_id] = self._chat_counts.get(chat_id, 0) + 1
+
+    def flush_chat_counts(self):
+        """Queue the summed msg_count increments, one UPSERT per chat."""
+        with self._chat_counts_lock:
+            if not self._chat_counts:
+                return
+            counts, self._chat_counts = self._chat_counts, {}
+        by_shard = {}
+        for chat_id, n in counts.items():
+            by_shard.setdefault(self._shard(chat_id), []).append((
+                "INSERT INTO chat_registry (chat_id,msg_count) VALUES (?,?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET msg_count=msg_count+excluded.msg_count",
+                (chat_id, n)
+            ))
+        for shard, stmts in by_shard.items():
+            shard._write(*stmts)
 
     # ── ANALYTICS ─────────────────────────────────────────────────────────────
     def log_event(self, uid, event, detail=""):
-        with self._lock:
-            self.c.execute(
-                "INSERT INTO analytics (uid,event,detail) VALUES (?,?,?)",
-                (uid, event, detail)
-            )
-            self.conn.commit()
+        self._shard(uid)._write((
+            "INSERT INTO analytics (uid,event,detail) VALUES (?,?,?)",
+            (uid, event, detail)
+        ))
+
+    def analytics_rollup(self, hours=24, event=None, daily=False):
+        """Event counts over the last `hours`, from analytics_hourly only.
+
+        event=None      -> [(event, n)] totals per event
+        event='ai_query'-> [(detail, n)] e.g. queries per engine
+        daily=True      -> [(YYYY-MM-DD, n)] per day (for `event`, or all)
+        """
+        self.flush()
+        since = f"-{int(hours)} hours"
+        where, params = "hour>=strftime('%Y-%m-%d %H:00','now',?)", [since]
+        if event:
+            where, params = "event=? AND " + where, [event, since]
+        if daily:
+            group = "substr(hour,1,10)"
+        else:
+            group = "detail" if event else "event"
+        totals = {}
+        for shard in self.shards:
+            for key, n in shard._reader().execute(
+                f"SELECT {group}, SUM(n) FROM analytics_hourly WHERE {where} GROUP BY 1", params
+            ):
+                totals[key] = totals.get(key, 0) + n
+        if daily:
+            return sorted(totals.items())
+        return sorted(totals.items(), key=lambda kv: kv[1], reverse=True)
+
+    def prune_analytics(self, days=ANALYTICS_RAW_DAYS):
+        """Background job: delete raw analytics rows older than `days` (the
+        hourly rollups keep their counts). Oldest-first in short batches."""
+        if days <= 0:
+            return 0
+        cutoff = f"-{int(days)} days"
+        removed = 0
+        for shard in self.shards:
+            while True:
+                n = shard.execute_now(
+                    "DELETE FROM analytics WHERE id IN "
+                    "(SELECT id FROM analytics WHERE ts<datetime('now',?) ORDER BY id LIMIT ?)",
+                    (cutoff, ANALYTICS_PRUNE_BATCH)
+                )
+                removed += n
+                if n < ANALYTICS_PRUNE_BATCH:
+                    break
+        if removed:
+            logger.info(f"TitanDB: pruned {removed} raw analytics rows older than {days}d")
+        return removed
 
     def get_stats(self):
-        self.c.execute("SELECT COUNT(*) as n FROM users")
-        total_users = self.c.fetchone()["n"]
-        self.c.execute("SELECT COUNT(*) as n FROM memory")
-        total_msgs = self.c.fetchone()["n"]
-        self.c.execute("SELECT COUNT(*) as n FROM chat_registry")
-        total_chats = self.c.fetchone()["n"]
-        self.c.execute("SELECT SUM(total_queries) as n FROM users")
-        row = self.c.fetchone()
-        total_q = row["n"] if row and row["n"] else 0
-        self.c.execute("SELECT COUNT(*) as n FROM banned_users")
-        banned = self.c.fetchone()["n"]
-        return {
-            "total_users": total_users, "total_messages": total_msgs,
-            "total_chats": total_chats, "total_queries": total_q,
-            "banned": banned,
-        }
+        """O(shards): sums the trigger-maintained totals in stats_counters."""
+        stats = dict.fromkeys({**SQLiteShard.STATS_EXACT, **SQLiteShard.STATS_ARCHIVE}, 0)
+        for shard in self.shards:
+            for r in shard._reader().execute("SELECT name,value FROM stats_counters"):
+                stats[r["name"]] += r["value"]
+        stats["total_messages"] += stats.pop("archived_messages")
+        return stats
+
+    def reconcile_stats(self):
+        """Recompute every counter from scratch (full scans — run it rarely).
+        Goes through the write queue so the recount and the overwrite happen
+        in the same transaction as the writes around it: nothing is lost or
+        counted twice."""
+        before = self.get_stats()
+        for shard in self.shards:
+            shard._write(*[(sql, ()) for sql in shard._STATS_RESEED + shard._ARCHIVE_RESEED], wait=True)
+        after = self.get_stats()
+        drift = {k: after[k] - before[k] for k in after if after[k] != before[k]}
+        if drift:
+            logger.info(f"TitanDB stats reconciled, adjusted by: {drift}")
+
+    # ── Retention / compaction ────────────────────────────────────
+    # scope -> (table, key column, newest rows kept per key)
+    COMPACT_SCOPES = {
+        "user" : ("memory",       "uid",     MEMORY_KEEP_TURNS),
+        "group": ("group_memory", "chat_id", GROUP_MEMORY_KEEP_TURNS),
+    }
+
+    def compact_memory(self):
+        """Background job: trim every uid / chat_id that got new rows since
+        the last run down to its newest keep rows. Works in batches of
+        COMPACT_BATCH_ROWS, each its own short write transaction, so the
+        handlers' queued writes interleave with it instead of waiting behind
+        one big DELETE."""
+        self.flush()
+        if self._compact_sweep:
+            self._compact_sweep = False
+            for scope, (table, col, keep) in self.COMPACT_SCOPES.items():
+                for shard in self.shards if keep else ():
+                    self._compact_dirty[scope].update(
+                        r[0] for r in shard._reader().execute(
+                            f"SELECT {col} FROM {table} GROUP BY {col} HAVING COUNT(*) > ?", (keep,))
+                    )
+        moved, batches, touched = 0, 0, set()
+        for scope, (table, col, keep) in self.COMPACT_SCOPES.items():
+            dirty = self._compact_dirty[scope]
+            while dirty and batches < COMPACT_MAX_BATCHES:
+                key = dirty.pop()
+                if not keep:
+                    continue
+                shard = self._shard(key)
+                row = shard._reader().execute(
+                    f"SELECT id FROM {table} WHERE {col}=? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                    (key, keep)
+                ).fetchone()
+                if not row:
+                    continue
+                n = shard.archive_rows(scope, table, col, key, row[0])
+                touched.add(shard)
+                moved += n
+                batches += 1
+                if n == COMPACT_BATCH_ROWS:
+                    dirty.add(key)      # more left below the cutoff — next batch/run
+        if moved:
+            for shard in touched:
+                shard._vacuum_step()
+            logger.info(f"TitanDB compaction: {'archived' if MEMORY_ARCHIVE else 'dropped'} "
+                        f"{moved} rows in {batches} batches")
+        return moved
+
+    @staticmethod
+    def unpack_archive(payload):
+        """The row dicts stored in one memory_archive.payload blob."""
+        return json.loads(zlib.decompress(payload))
 
 
 db = TitanDB()
 
+
+class ResponseCache:
+    """Cache of finished AI answers, keyed by a hash of everything the
+    answer depends on (see key()). Values are anything JSON-serialisable.
+
+    Two tiers: a TTLCache capped at RESPONSE_CACHE_MEM_MB, then (if
+    RESPONSE_CACHE_PATH is set) a separate SQLite file capped at
+    RESPONSE_CACHE_DISK_MB. A disk hit is promoted to memory. The file is
+    only a cache — deleting it is always safe — so it lives outside the
+    TitanDB shards and has no migrations.
+
+    Hits/misses are counted per call site ("search", "document", ...) for
+    /cache.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, mem_mb=RESPONSE_CACHE_MEM_MB,
+                 disk_mb=RESPONSE_CACHE_DISK_MB, enabled=RESPONSE_CACHE):
+        self.enabled = enabled
+        self.mem = TTLCache(max_items=100000, ttl=600, max_bytes=int(mem_mb * 1024 * 1024))
+        self.disk_max_bytes = int(disk_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._counts = {}   # site -> {"mem": n, "disk": n, "miss": n, "bypass": n}
+        self.conn = None
+        if enabled and path:
+            try:
+                self.conn = sqlite3.connect(path, check_same_thread=False,
+                                            timeout=DB_BUSY_TIMEOUT_MS / 1000)
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("PRAGMA synchronous=NORMAL")
+                self.conn.execute("""CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY, value BLOB, size INTEGER,
+                    expires REAL, used_at REAL) WITHOUT ROWID""")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_rc_used ON response_cache(used_at)")
+                self.conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Response cache: disk tier disabled ({e})")
+                self.conn = None
+
+    @staticmethod
+    def normalize(text):
+        """Case and whitespace differences shouldn't miss the cache."""
+        return " ".join(str(text).split()).casefold()
+
+    @classmethod
+    def key(cls, site, *parts):
+        h = hashlib.sha256(site.encode())
+        for part in parts:
+            h.update(b"\x1f" + cls.normalize(part).encode())
+        return h.hexdigest()
+
+    def _count(self, site, what):
+        with self._lock:
+            self._counts.setdefault(site, {"mem": 0, "disk": 0, "miss": 0, "bypass": 0})[what] += 1
+
+    def get(self, site, key, bypass=False):
+        """Cached value or None. bypass=True always misses (the caller
+        will set() a fresh answer over the old one)."""
+        if not self.enabled:
+            return None
+        if bypass:
+            self._count(site, "bypass")
+            return None
+        raw = self.mem.get(key)
+        if raw is not None:
+            self._count(site, "mem")
+            return json.loads(raw)
+        if self.conn is not None:
+            now = time.time()
+            try:
+                with self._lock:
+                    row = self.conn.execute(
+                        "SELECT value, expires FROM response_cache WHERE key=? AND expires>?",
+                        (key, now)).fetchone()
+                    if row:
+                        self.conn.execute("UPDATE response_cache SET used_at=? WHERE key=?", (now, key))
+                        self.conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Response cache read error: {e}")
+                row = None
+            if row:
+                raw = zlib.decompress(row[0]).decode()
+                self.mem.set(key, raw, ttl=row[1] - now)
+                self._count(site, "disk")
+                return json.loads(raw)
+        self._count(site, "miss")
+        return None
+
+    def set(self, site, key, value, ttl=None):
+        if not self.enabled:
+            return
+        ttl = ttl or RESPONSE_CACHE_TTLS.get(site, 600)
+        raw = json.dumps(value, ensure_ascii=False)
+        self.mem.set(key, raw, ttl=ttl)
+        if self.conn is not None:
+            blob = zlib.compress(raw.encode(), 6)
+            now = time.time()
+            try:
+                with self._lock:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO response_cache(key, value, size, expires, used_at) "
+                        "VALUES (?,?,?,?,?)", (key, blob, len(blob), now + ttl, now))
+                    self.conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Response cache write error: {e}")
+
+    def prune(self):
+        """Background job: drop expired rows, then least-recently-used ones
+        until the file is under RESPONSE_CACHE_DISK_MB."""
+        if self.conn is None:
+            return 0
+        removed = 0
+        with self._lock:
+            removed += self.conn.execute("DELETE FROM response_cache WHERE expires<=?",
+                                         (time.time(),)).rowcount
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+            while total > self.disk_max_bytes:
+                rows = self.conn.execute(
+                    "SELECT key, size FROM response_cache ORDER BY used_at LIMIT 200").fetchall()
+                if not rows:
+                    break
+                self.conn.executemany("DELETE FROM response_cache WHERE key=?", [(k,) for k, _ in rows])
+                total -= sum(sz for _, sz in rows)
+                removed += len(rows)
+            self.conn.commit()
+        if removed:
+            logger.info(f"Response cache: pruned {removed} disk entries")
+        return removed
+
+    def clear(self):
+        self.mem.clear()
+        if self.conn is not None:
+            with self._lock:
+                self.conn.execute("DELETE FROM response_cache")
+                self.conn.commit()
+
+    def stats(self):
+        disk_rows = disk_bytes = 0
+        if self.conn is not None:
+            with self._lock:
+                disk_rows, disk_bytes = self.conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM response_cache").fetchone()
+        with self._lock:
+            sites = {k: dict(v) for k, v in self._counts.items()}
+        return {"enabled": self.enabled, "mem": self.mem.stats(),
+                "disk_rows": disk_rows, "disk_bytes": disk_bytes, "sites": sites}
+
+
+response_cache = ResponseCache()
+
+
+class SingleFlight:
+    """Coalesces identical calls that are in flight at the same time: the
+    first caller for a key does the work, everyone who asks for the same
+    key meanwhile waits for it and gets the same result (or exception).
+    Unlike response_cache nothing is kept afterwards — this covers the
+    window before the first answer exists, e.g. twenty people running
+    /search on the same trending topic within the same few seconds.
+
+    do() is for code on threads, ado() for coroutines on the event loop;
+    each keeps its own table. Both return (result, shared). In ado() the
+    work is a task of its own: a waiter that is cancelled (a timed-out
+    get_response) only stops waiting, and the task is cancelled only once
+    nobody is left waiting for it.
+    """
+
+    _all = {}
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}       # key -> {"done": Event, "result": ..., "error": ...}
+        self._futures = {}     # key -> [asyncio.Task, n waiters] (loop only, no lock)
+        self._lock = threading.Lock()
+        self.leaders = self.deduped = 0
+        SingleFlight._all[name] = self
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+                self.leaders += 1
+            else:
+                self.deduped += 1
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise self._copy_error(call["error"]) from call["error"]
+            return call["result"], True
+        try:
+            call["result"] = fn(*args, **kwargs)
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["done"].set()
+        return call["result"], False
+
+    async def ado(self, key, coro_fn):
+        entry = self._futures.get(key)
+        shared = entry is not None
+        if shared:
+            self.deduped += 1
+        else:
+            task = asyncio.ensure_future(coro_fn())
+            entry = self._futures[key] = [task, 0]
+            task.add_done_callback(partial(self._task_done, key))
+            self.leaders += 1
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task), shared
+        except asyncio.CancelledError:
+            if not task.done() and entry[1] == 1:
+                task.cancel()      # the last one waiting gave up
+            raise
+        except Exception as e:
+            if shared:
+                raise self._copy_error(e) from e
+            raise
+        finally:
+            entry[1] -= 1
+
+    def _task_done(self, key, task):
+        if self._futures.get(key, (None,))[0] is task:
+            del self._futures[key]
+        if not task.cancelled():
+            task.exception()       # mark retrieved — every waiter may be gone
+
+    @staticmethod
+    def _copy_error(e):
+        """A fresh instance of the leader's exception for a follower to
+        raise, so several callers don't share (and keep extending) one
+        traceback. Falls back to a RuntimeError if it can't be copied."""
+        try:
+            return copy.copy(e).with_traceback(None)
+        except Exception:
+            return RuntimeError(f"{type(e).__name__}: {e}")
+
+    @classmethod
+    def stats(cls):
+        return {name: {"leaders": f.leaders, "deduped": f.deduped} for name, f in cls._all.items()}
+
+
+ai_flight     = SingleFlight("ai")
+search_flight = SingleFlight("search")
+image_flight  = SingleFlight("image")
+
 # ══════════════════════════════════════════════════════════════════════════════════
 # 🧠  SECTION 3 : NEURAL ENGINE — MULTI-AI AUTO-SWITCH ROUTER
 # ══════════════════════════════════════════════════════════════════════════════════
 
+class AsyncRuntime:
+    """One asyncio event loop on a daemon thread, shared by the whole bot.
+
+    Waiting on AI providers is the slow part of nearly every update, so it
+    runs here as coroutines (NeuralEngine.aget_response): a thousand
+    answers in flight cost a thousand coroutines, not a thousand parked
+    threads. From a coroutine, blocking calls (pyTelegramBotAPI, SQLite)
+    go through `await AsyncRuntime.io(fn, ...)`; from a thread, a
+    coroutine is run with AsyncRuntime.run(coro) or started with spawn().
+
+    Nothing on io_pool may wait for the loop (run(), get_response): the
+    loop needs those threads to finish. Thread code that does — offloaded
+    handlers, or sync helpers awaited with AsyncRuntime.job() — runs on
+    job_pool instead.
+    """
+
+    io_pool  = ThreadPoolExecutor(max_workers=ASYNC_IO_THREADS, thread_name_prefix="titan-io")
+    job_pool = ThreadPoolExecutor(max_workers=JOB_THREADS, thread_name_prefix="titan-job")
+    cpu_pool = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="titan-cpu")
+    _loop    = None
+    _thread  = None
+    _lock    = threading.Lock()
+
+    @classmethod
+    def loop(cls):
+        with cls._lock:
+            if cls._loop is None:
+                loop = asyncio.new_event_loop()
+                loop.set_default_executor(cls.io_pool)
+                cls._thread = threading.Thread(target=loop.run_forever, name="titan-async", daemon=True)
+                cls._thread.start()
+                cls._loop = loop
+        return cls._loop
+
+    @classmethod
+    def in_loop(cls):
+        return cls._thread is not None and threading.current_thread() is cls._thread
+
+    @classmethod
+    def run(cls, coro, timeout=None):
+        """Runs coro on the loop and blocks the calling thread for its result.
+        On timeout the coroutine is cancelled and TimeoutError raised."""
+        if cls.in_loop():
+            coro.close()
+            raise RuntimeError("AsyncRuntime.run() called on the event loop — await the coroutine instead")
+        fut = asyncio.run_coroutine_threadsafe(coro, cls.loop())
+        try:
+            return fut.result(timeout)
+        except FutureTimeout:
+            fut.cancel()
+            raise
+
+    @classmethod
+    def spawn(cls, coro):
+        """Starts coro on the loop without waiting for it; failures are logged."""
+        fut = asyncio.run_coroutine_threadsafe(coro, cls.loop())
+        fut.add_done_callback(cls._log_failure)
+        return fut
+
+    @staticmethod
+    def _log_failure(fut):
+        if not fut.cancelled() and fut.exception() is not None:
+            logger.error(f"Background task failed: {fut.exception()!r}")
+
+    @classmethod
+    async def io(cls, fn, *args, **kwargs):
+        """await a blocking call without blocking the loop."""
+        return await asyncio.get_running_loop().run_in_executor(cls.io_pool, partial(fn, *args, **kwargs))
+
+    @classmethod
+    async def job(cls, fn, *args, **kwargs):
+        """Like io(), for sync code that itself waits on the loop."""
+        return await asyncio.get_running_loop().run_in_executor(cls.job_pool, partial(fn, *args, **kwargs))
+
+    @classmethod
+    def call_later(cls, delay, fn, *args):
+        """Thread-safe: run fn(*args) on the io pool after delay seconds."""
+        loop = cls.loop()
+        loop.call_soon_threadsafe(loop.call_later, max(0.0, delay), cls.io_pool.submit, fn, *args)
+
+
+def offload(kind):
+    """Decorator for long jobs started from a handler: the call queues the
+    function on AsyncRuntime's "job" or "cpu" pool and returns at once, so
+    the TeleBot worker is free for the next update. The cpu pool is sized
+    to the machine, so a burst of /pdf requests queues instead of having
+    dozens of renders fighting over the CPU — only pure rendering belongs
+    there: a job that also sleeps or waits on an AI answer runs on "job"
+    and submits its render step to cpu_pool (see PDFGenerator)."""
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            pool = AsyncRuntime.cpu_pool if kind == "cpu" else AsyncRuntime.job_pool
+            fut = pool.submit(fn, *args, **kwargs)
+            fut.add_done_callback(AsyncRuntime._log_failure)
+            return fut
+        return wrapper
+    return deco
+
+
+class AsyncHTTP:
+    """aiohttp transport for provider calls made from the event loop. Same
+    timeouts as the requests `session` (20 s to connect / between reads).
+    Without aiohttp, NeuralEngine.acall_text runs the blocking call_* on
+    the io pool instead."""
+
+    _session = None
+
+    @classmethod
+    def session(cls):
+        # Only ever called on the loop thread, so no lock needed.
+        if cls._session is None or cls._session.closed:
+            cls._session = aiohttp.ClientSession(
+                headers={"User-Agent": "MI-Titan-Bot/22.0"},
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=20, sock_read=20),
+            )
+        return cls._session
+
+    @classmethod
+    async def post_json(cls, url, headers, payload):
+        async with cls.session().post(url, headers=headers, json=payload) as r:
+            r.raise_for_status()
+            return await r.json(content_type=None)
+
+    @classmethod
+    async def sse_events(cls, url, headers, payload):
+        """Async generator over the JSON events of a streamed response."""
+        async with cls.session().post(url, headers=headers, json=payload) as r:
+            r.raise_for_status()
+            async for raw in r.content:
+                event = NeuralEngine._sse_event(raw)
+                if event is NeuralEngine.SSE_DONE:
+                    return
+                if event is not None:
+                    yield event
+
+
+class ProviderHealth:
+    """Per-provider circuit breaker plus EWMA latency and error rate.
+
+    closed    -> requests flow; failures are counted
+    open      -> provider is skipped until its cooldown ends
+    half-open -> exactly one trial request; success closes, failure re-opens
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+    ALPHA = 0.2                 # EWMA weight of the newest sample
+    DEFAULT_LATENCY = 3.0       # assumed until the first success
+    _all = {}
+    _all_lock = threading.Lock()
+
+    def __init__(self, name):
+        self.name = name
+        self.state = self.CLOSED
+        self.latency = None          # EWMA seconds, successes only
+        self.error_rate = 0.0        # EWMA of 0/1 outcomes
+        self.calls = self.failures = self.streak = 0
+        self.cooldown = CIRCUIT_COOLDOWN
+        self.opened_at = self.failed_at = 0.0
+        self.trial_running = False
+        self.last_error = ""
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, name):
+        with cls._all_lock:
+            if name not in cls._all:
+                cls._all[name] = cls(name)
+            return cls._all[name]
+
+    @classmethod
+    def all(cls):
+        with cls._all_lock:
+            return dict(cls._all)
+
+    def _cooled_down(self):
+        return time.monotonic() - self.opened_at >= self.cooldown
+
+    def available(self):
+        """Would allow() say yes right now? (no side effects)"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                return self._cooled_down()
+            return not self.trial_running
+
+    def allow(self):
+        """Call right before sending a request; False = skip this provider."""
+        with self._lock:
+            if self.state == self.OPEN and self._cooled_down():
+                self.state = self.HALF_OPEN
+                self.trial_running = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self, seconds):
+        with self._lock:
+            self.calls += 1
+            self.streak = 0
+            self.error_rate *= 1 - self.ALPHA
+            self.latency = seconds if self.latency is None else (
+                self.ALPHA * seconds + (1 - self.ALPHA) * self.latency)
+            if self.state != self.CLOSED:
+                logger.info(f"Circuit [{self.name}] closed after a successful trial")
+            self.state = self.CLOSED
+            self.cooldown = CIRCUIT_COOLDOWN
+            self.trial_running = False
+
+    def record_failure(self, error):
+        with self._lock:
+            self.calls += 1
+            self.failures += 1
+            self.streak += 1
+            self.error_rate = self.ALPHA + (1 - self.ALPHA) * self.error_rate
+            self.failed_at = time.monotonic()
+            self.last_error = str(error)[:200]
+            if self.state == self.HALF_OPEN:
+                self.cooldown = min(CIRCUIT_MAX_COOLDOWN, self.cooldown * 2)
+                self._open()
+            elif self.state == self.CLOSED and (
+                self.streak >= CIRCUIT_FAILS
+                or (self.calls >= 10 and self.error_rate >= CIRCUIT_ERROR_RATE)
+            ):
+                self._open()
+
+    def release(self):
+        """The request was abandoned (lost a hedged race) before finishing:
+        no verdict either way, but a half-open trial slot is freed."""
+        with self._lock:
+            self.trial_running = False
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.trial_running = False
+        logger.warning(f"Circuit [{self.name}] OPEN for {self.cooldown}s "
+                       f"(streak={self.streak}, err={self.error_rate:.0%}): {self.last_error}")
+
+    def expected_latency(self):
+        """Rough expected time to a good answer: EWMA latency inflated by
+        the error rate (a failed call costs another attempt). The error
+        penalty halves every minute without a new failure, so a provider
+        that blipped once and lost all its traffic gets picked again."""
+        latency = self.DEFAULT_LATENCY if self.latency is None else self.latency
+        errors = self.error_rate * 0.5 ** ((time.monotonic() - self.failed_at) / 60)
+        return latency / max(0.1, 1 - errors)
+
+    @staticmethod
+    def status_of(error):
+        """HTTP status of a failed provider call (requests or aiohttp), or None."""
+        resp = getattr(error, "response", None)
+        return getattr(resp, "status_code", None) or getattr(error, "status", None)
+
+    @classmethod
+    def is_provider_fault(cls, error):
+        """400/413/422 mean *this request* was bad — not the provider's
+        health — and 429 means we are over quota, which ProviderLimiter
+        deals with. Everything else (timeouts, 5xx, auth) counts. The
+        non-faults are neutral: neither a success nor timed."""
+        return cls.status_of(error) not in (400, 413, 422, 429)
+
+    @classmethod
+    def route(cls, names, prefer_fastest=False):
+        """(names to try in order, forced). Tripped providers are dropped;
+        with prefer_fastest the rest are sorted by expected_latency(). If
+        every provider is tripped, all of them are returned with
+        forced=True — a slow attempt beats an instant error."""
+        names = list(names)
+        healthy = [n for n in names if cls.get(n).available()]
+        if not healthy:
+            return names, True
+        if prefer_fastest:
+            healthy.sort(key=lambda n: cls.get(n).expected_latency())
+        return healthy, False
+
+    def snapshot(self):
+        with self._lock:
+            state = self.state
+            if state == self.OPEN and self._cooled_down():
+                state = self.HALF_OPEN
+            return {
+                "state": state, "latency": self.latency, "error_rate": self.error_rate,
+                "calls": self.calls, "failures": self.failures, "last_error": self.last_error,
+                "retry_in": max(0, round(self.cooldown - (time.monotonic() - self.opened_at)))
+                            if state == self.OPEN else 0,
+            }
+
+    @classmethod
+    def reset(cls):
+        """Forget all history — every provider starts closed again."""
+        with cls._all_lock:
+            cls._all.clear()
+
+    @classmethod
+    def report(cls, detailed=False):
+        icons = {cls.CLOSED: "🟢", cls.HALF_OPEN: "🟡", cls.OPEN: "🔴"}
+        lines = []
+        for name, h in sorted(cls.all().items()):
+            snap = h.snapshot()
+            lat = f"{snap['latency']:.2f}s" if snap["latency"] is not None else "—"
+            line = (f"{icons[snap['state']]} `{name}` {snap['state']} · {lat} · "
+                    f"err {snap['error_rate']:.0%}")
+            if snap["retry_in"]:
+                line += f" · retry in {snap['retry_in']}s"
+            if detailed:
+                line += f" · {snap['calls']} calls / {snap['failures']} failed"
+                if snap["last_error"] and snap["state"] != cls.CLOSED:
+                    # Code span: raw exception text is full of _ * [ that
+                    # would break /health's Markdown parse.
+                    err = snap["last_error"][:120].replace("`", "'")
+                    line += f"\n    `{err}`"
+            lines.append(line)
+        return "\n".join(lines) or "_No provider calls yet._"
+
+
+class QuotaExceeded(RuntimeError):
+    """ProviderLimiter said no: this provider's local quota is used up for
+    this priority class. Not a provider failure."""
+
+
+class TokenBucket:
+    """Refills `per_minute` units evenly over a minute, holding at most one
+    minute's worth. per_minute=0 means unlimited. The level can go
+    negative when a request turns out to cost more than estimated."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self._at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.capacity:
+            self.level = min(self.capacity, self.level + (now - self._at) * self.capacity / 60)
+        self._at = now
+
+    def fits(self, n, reserve=0.0):
+        """Can n be taken while leaving `reserve` (fraction) untouched?"""
+        if not self.capacity:
+            return True
+        self._refill()
+        n = min(n, self.capacity * (1 - reserve))      # oversize requests wait for a full bucket
+        return self.level - n >= self.capacity * reserve
+
+    def wait_time(self, n, reserve=0.0):
+        """Seconds until fits(n, reserve)."""
+        if not self.capacity:
+            return 0.0
+        self._refill()
+        n = min(n, self.capacity * (1 - reserve))
+        missing = n + self.capacity * reserve - self.level
+        return max(0.0, missing * 60 / self.capacity)
+
+    def peek(self):
+        """Current level without touching state (safe from other threads)."""
+        if not self.capacity:
+            return float("inf")
+        return min(self.capacity, self.level + (time.monotonic() - self._at) * self.capacity / 60)
+
+    def take(self, n):
+        if self.capacity:
+            self._refill()
+            self.level -= min(n, self.capacity)
+
+
+class ProviderLimiter:
+    """Client-side RPM/TPM quota per provider (PROVIDER_QUOTAS), so the bot
+    spends its quota on purpose instead of discovering it through 429s.
+
+    Requests come in priority classes. Lower classes must leave a share of
+    each bucket unused (RESERVE) and give up sooner (MAX_WAIT): an
+    unaddressed group quip is shed at once when quota is short, a
+    PDF/ZIP/Word generation queues for up to a minute, and a private chat
+    or mention waits a few seconds before the router moves on to the next
+    engine. Waiters are served strictly in (priority, arrival) order.
+
+    Vision, Whisper and TTS calls use the same key, so they draw on the
+    same buckets (QUOTA_OF) through NeuralEngine.quota_call.
+
+    Only used from the AsyncRuntime event loop, so it needs no locks —
+    thread code goes through acquire_sync().
+    """
+
+    INTERACTIVE, CHATTER, BACKGROUND = 0, 1, 2
+    CLASS_NAMES = {0: "interactive", 1: "chatter", 2: "background"}
+    RESERVE     = {0: 0.0, 1: 0.3, 2: 0.5}
+    MAX_WAIT    = {0: 3.0, 1: 0.0, 2: 60.0}
+    OUTPUT_ESTIMATE = {"fast": 300, "deep": 1200}   # tokens, corrected by settle()
+    VISION_ESTIMATE = 2000                          # image + prompt + max_tokens; never settled
+    QUOTA_OF    = {"groq_vision": "groq", "gemini_vision": "gemini"}   # ProviderHealth name -> bucket
+    _all = {}
+    _seq = 0
+
+    def __init__(self, name):
+        rpm, tpm = PROVIDER_QUOTAS.get(name, (0, 0))
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._waiters = []     # (priority, seq) of queued acquire() calls
+        self.counts = {p: {"granted": 0, "queued": 0, "shed": 0} for p in self.CLASS_NAMES}
+
+    @classmethod
+    def get(cls, name):
+        if name not in cls._all:
+            cls._all[name] = cls(name)
+        return cls._all[name]
+
+    @classmethod
+    def priority_for(cls, cache_site):
+        """Default class of a get_response call, from its call site."""
+        return {"chatter": cls.CHATTER, "document": cls.BACKGROUND}.get(cache_site, cls.INTERACTIVE)
+
+    def _fits(self, tokens, priority):
+        reserve = self.RESERVE[priority]
+        return self.requests.fits(1, reserve) and self.tokens.fits(tokens, reserve)
+
+    async def acquire(self, tokens, priority=INTERACTIVE):
+        """Takes one request and `tokens` from the buckets, waiting up to
+        MAX_WAIT[priority]. False = shed."""
+        if not self._waiters and self._fits(tokens, priority):
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.counts[priority]["granted"] += 1
+            return True
+        reserve = self.RESERVE[priority]
+        deadline = time.monotonic() + self.MAX_WAIT[priority]
+        ProviderLimiter._seq += 1
+        me = (priority, ProviderLimiter._seq)
+        self._waiters.append(me)
+        self.counts[priority]["queued"] += 1
+        try:
+            while True:
+                if min(self._waiters) == me and self._fits(tokens, priority):
+                    self.requests.take(1)
+                    self.tokens.take(tokens)
+                    self.counts[priority]["granted"] += 1
+                    return True
+                need = max(self.requests.wait_time(1, reserve), self.tokens.wait_time(tokens, reserve))
+                left = deadline - time.monotonic()
+                if left <= 0 or need > left:
+                    self.counts[priority]["shed"] += 1
+                    return False
+                await asyncio.sleep(min(max(need, 0.05), 0.5))
+        finally:
+            self._waiters.remove(me)
+
+    def acquire_sync(self, tokens, priority=INTERACTIVE):
+        """acquire() for code on a thread: waits on the event loop, which
+        owns the buckets. Not from the io pool (see AsyncRuntime)."""
+        return AsyncRuntime.run(self.acquire(tokens, priority))
+
+    def settle(self, estimated, actual):
+        """Charge the difference once a call's real size is known."""
+        if actual > estimated:
+            self.tokens.take(actual - estimated)
+        elif self.tokens.capacity:
+            self.tokens.level = min(self.tokens.capacity, self.tokens.level + estimated - actual)
+
+    def drain(self, retry_after=None):
+        """The provider answered 429 anyway (shared key, wrong quota
+        config): empty the request bucket so nothing is sent until it has
+        refilled, or for Retry-After seconds if that is longer."""
+        if self.requests.capacity:
+            self.requests._refill()
+            try:
+                wait = max(float(retry_after or 0), 0.0)
+            except ValueError:         # HTTP-date form — just wait for the refill
+                wait = 0.0
+            self.requests.level = min(0.0, -wait * self.requests.capacity / 60)
+        logger.warning(f"Quota [{self.name}] 429 from provider — pausing "
+                       f"{'for ' + str(retry_after) + 's' if retry_after else 'until the bucket refills'}")
+
+    @classmethod
+    def report(cls):
+        lines = []
+        for name, lim in sorted(cls._all.items()):
+            level = lambda b: f"{max(0, b.peek()):.0f}/{b.capacity:.0f}" if b.capacity else "∞"
+            shed = " · ".join(f"{cls.CLASS_NAMES[p]} {c['granted']}✓/{c['shed']}✗"
+                              for p, c in lim.counts.items() if c["granted"] or c["shed"])
+            lines.append(f"• `{name}` req {level(lim.requests)} · tok {level(lim.tokens)}"
+                         + (f"\n    {shed}" if shed else ""))
+        return "\n".join(lines) or "_No quota use yet._"
+
+
+class LoadGovernor:
+    """Graceful degradation under load (see LOAD GOVERNOR config). level()
+    is cheap and safe from any thread: it recomputes at most twice a second
+    (unless inflight alone already crosses the next level) and only ever
+    moves down one level per LOAD_COOLDOWN_SECONDS."""
+
+    NORMAL, BUSY, OVERLOADED = 0, 1, 2
+    NAMES = {0: "normal", 1: "busy", 2: "overloaded"}
+    SHEDS = {"chatter": BUSY, "voice": OVERLOADED}
+    NOTICES = {
+        1: "⚡ _Abhi bot par load zyada hai — jawab fast mode mein diya gaya hai._",
+        2: "⚡ _Bot abhi bohot busy hai — chhote jawab, voice replies thodi der ke liye band._",
+    }
+
+    inflight = 0                 # AI requests being answered (event loop only)
+    score = 0.0
+    _level = 0
+    _checked = 0.0
+    _calm_since = None
+    _lock = threading.Lock()
+    _noticed = TTLCache(max_items=100000, ttl=LOAD_NOTICE_SECONDS)
+    counts = {"downgraded": 0, "chatter": 0, "voice": 0, "notices": 0}
+
+    @classmethod
+    async def track(cls, coro):
+        """Await coro, counted as one in-flight AI request."""
+        cls.inflight += 1
+        try:
+            return await coro
+        finally:
+            cls.inflight -= 1
+
+    @classmethod
+    def pressure(cls):
+        """(score, detail) — score >= 1 means busy, >= 2 overloaded."""
+        queued = AsyncRuntime.io_pool._work_queue.qsize() + AsyncRuntime.job_pool._work_queue.qsize() + sum(
+            len(lim._waiters) for lim in list(ProviderLimiter._all.values()))
+        latencies = [h.latency for name, h in ProviderHealth.all().items()
+                     if name in CONTEXT_BUDGETS and h.latency and h.state != ProviderHealth.OPEN]
+        latency = min(latencies) if latencies else 0.0
+        score = max(cls.inflight / LOAD_INFLIGHT_HIGH, queued / LOAD_QUEUE_HIGH,
+                    latency / LOAD_LATENCY_HIGH)
+        return score, f"inflight {cls.inflight} · queued {queued} · latency {latency:.1f}s"
+
+    @classmethod
+    def level(cls):
+        if not LOAD_GOVERNOR:
+            return cls.NORMAL
+        now = time.monotonic()
+        # A burst can start hundreds of requests within one interval, so a
+        # jump in inflight always forces a recompute.
+        if now - cls._checked < 0.5 and cls.inflight < (cls._level + 1) * LOAD_INFLIGHT_HIGH:
+            return cls._level
+        with cls._lock:
+            cls._checked = now
+            cls.score, detail = cls.pressure()
+            target = min(cls.OVERLOADED, int(cls.score))
+            if target > cls._level:
+                logger.warning(f"Load governor: {cls.NAMES[cls._level]} -> {cls.NAMES[target]} ({detail})")
+                cls._level, cls._calm_since = target, None
+            elif target < cls._level and cls.score < cls._level - 0.3:
+                if cls._calm_since is None:
+                    cls._calm_since = now
+                elif now - cls._calm_since >= LOAD_COOLDOWN_SECONDS:
+                    logger.info(f"Load governor: {cls.NAMES[cls._level]} -> "
+                                f"{cls.NAMES[cls._level - 1]} ({detail})")
+                    cls._level -= 1
+                    cls._calm_since = None
+            else:
+                cls._calm_since = None
+            return cls._level
+
+    @classmethod
+    def downgrade(cls):
+        """True if a Deep Think request should use the fast model now."""
+        if cls.level() >= cls.BUSY:
+            cls.counts["downgraded"] += 1
+            return True
+        return False
+
+    @classmethod
+    def cap(cls, max_tokens):
+        """max_tokens for a text call at the current load."""
+        return min(max_tokens, LOAD_MAX_TOKENS.get(cls.level(), max_tokens))
+
+    @classmethod
+    def sheds(cls, kind):
+        """True if optional work of this kind ("chatter", "voice") should be
+        skipped right now."""
+        if cls.level() >= cls.SHEDS[kind]:
+            cls.counts[kind] += 1
+            return True
+        return False
+
+    @classmethod
+    def notice_for(cls, uid):
+        """A one-line "bot is busy" notice for uid, at most once per
+        LOAD_NOTICE_SECONDS; "" when load is normal."""
+        level = cls.level()
+        if level == cls.NORMAL or cls._noticed.get(uid):
+            return ""
+        cls._noticed.set(uid, True)
+        cls.counts["notices"] += 1
+        return cls.NOTICES[level]
+
+    @classmethod
+    def report(cls):
+        level = cls.level()
+        _, detail = cls.pressure()
+        return (f"• *{cls.NAMES[level]}* (score {cls.score:.2f}) — {detail}\n"
+                f"• deep→fast {cls.counts['downgraded']} · chatter shed {cls.counts['chatter']} · "
+                f"voice shed {cls.counts['voice']} · notices {cls.counts['notices']}")
+
+
+class ContextBuilder:
+    """Token-budgeted conversation context.
+
+    Tokens are estimated locally (no tokenizer download): every word counts
+    one token per ~4 characters and every punctuation mark one token, which
+    lands within ~15% of the providers' BPE counts for English/Roman Urdu
+    and errs high on code — the safe side for a budget.
+    """
+
+    MESSAGE_OVERHEAD = 4       # role/formatting tokens per message
+    _PIECES = re.compile(r"\w+|[^\w\s]")
+
+    # Keyed on (hash, length) rather than the text itself, so the cache
+    # never keeps whole answers or document prompts alive.
+    _token_counts = TTLCache(4096, 3600)
+
+    @classmethod
+    def estimate_tokens(cls, text):
+        if not text:
+            return 0
+        key = (hash(text), len(text))
+        n = cls._token_counts.get(key)
+        if n is None:
+            n = sum((len(p) + 3) // 4 for p in cls._PIECES.findall(text))
+            cls._token_counts.set(key, n)
+        return n
+
+    @staticmethod
+    def budget(engine, mode="chat", deep=False):
+        """Input-token budget (system + history + prompt) for one call."""
+        base = CONTEXT_BUDGETS.get(engine, min(CONTEXT_BUDGETS.values()))
+        factor = CONTEXT_MODE_FACTOR.get(mode, 1.0) * (CONTEXT_DEEP_FACTOR if deep else 1.0)
+        return int(base * factor)
+
+    @classmethod
+    def truncate(cls, text, max_tokens):
+        """Keeps the head and tail of an oversized text (where the question
+        and the conclusion usually are) and drops the middle."""
+        tokens = cls.estimate_tokens(text)
+        if tokens <= max_tokens:
+            return text
+        keep = max(1, int(len(text) * max_tokens / tokens)) - 40
+        head = text[:max(0, keep * 2 // 3)]
+        tail = text[len(text) - max(0, keep // 3):] if keep > 0 else ""
+        return f"{head}\n…[{tokens - max_tokens} tokens kaat diye]…\n{tail}"
+
+    @classmethod
+    def pack(cls, rows, budget):
+        """Newest turns of rows (oldest-first role/content dicts) that fit
+        in budget tokens, each capped at CONTEXT_TURN_MAX_TOKENS. Returns
+        (history, tokens used)."""
+        picked, used = [], 0
+        for r in reversed(rows):
+            content = cls.truncate(r["content"] or "", CONTEXT_TURN_MAX_TOKENS)
+            cost = cls.estimate_tokens(content) + cls.MESSAGE_OVERHEAD
+            if used + cost > budget:
+                break
+            picked.append({"role": r["role"], "content": content})
+            used += cost
+        picked.reverse()
+        # Start on a user turn, so every provider sees a well-formed dialogue.
+        while picked and picked[0]["role"] != "user":
+            used -= cls.estimate_tokens(picked.pop(0)["content"]) + cls.MESSAGE_OVERHEAD
+        return picked, used
+
+    RECALL_HEADER = "Purani baatein jo is message se related ho sakti hain:"
+
+    @classmethod
+    def recall_block(cls, turns, budget=None):
+        """System-prompt block for recalled turns (best match first), as
+        many as fit in budget tokens (RECALL_TOKENS), shown oldest first."""
+        budget = RECALL_TOKENS if budget is None else budget
+        picked, used = [], cls.estimate_tokens(cls.RECALL_HEADER)
+        for t in turns:
+            who = "Assistant" if t["role"] == "assistant" else "User"
+            line = f"- [{(t.get('ts') or '')[:10]}] {who}: {cls.truncate(t['content'] or '', RECALL_TURN_TOKENS)}"
+            cost = cls.estimate_tokens(line)
+            if used + cost <= budget:
+                picked.append((t["id"], line))
+                used += cost
+        if not picked:
+            return ""
+        return cls.RECALL_HEADER + "\n" + "\n".join(line for _, line in sorted(picked))
+
+    @classmethod
+    def build(cls, engine, mode, deep, system, prompt, rows):
+        """(history, prompt, total tokens) for one engine call."""
+        prompt = cls.truncate(prompt, CONTEXT_PROMPT_MAX_TOKENS)
+        fixed = (cls.estimate_tokens(system) + cls.estimate_tokens(prompt)
+                 + 2 * cls.MESSAGE_OVERHEAD)
+        history, used = cls.pack(rows, cls.budget(engine, mode, deep) - fixed) if rows else ([], 0)
+        return history, prompt, fixed + used
+
+
+class ComplexityRouter:
+    """Offline fast/deep model choice per message (see AUTOMATIC DEPTH).
+
+    A hand-weighted score, no model and no I/O — a few regexes, ~40 µs
+    per prompt. Weights were tuned on titan_bench.py's ROUTE_SET; rerun
+    `titan_bench.py route` after changing them.
+    """
+
+    DEEP_WORDS = re.compile(
+        r"\b(explain|why|kyun|kyon|how (does|do|to|can)|compare|comparison|difference|farq|design|"
+        r"architecture|debug|error|exception|bug|optimi[sz]e|prove|derive|analy[sz]e|analysis|"
+        r"implement|algorithm|complexity|refactor|step[- ]by[- ]step|detail|detailed|tafseel|essay|"
+        r"research|strategy|plan|pros and cons|samjhao|samjha|write|likho|build|banao|bana do|"
+        r"solve|calculate|derivation|translate|summar[iy]\w*|review|script|function|program|"
+        r"api|database|query|proof|theorem|equation|integral|vs|versus|story|kahani|letter|"
+        r"\d{3,} words|kya kya)\b", re.I)
+    CHIT_CHAT = re.compile(
+        r"^\s*(salam|assalam\w*|aoa|hi+|hello|hey|thanks?|thank you|shukriya|ok(ay)?|acha|achha|"
+        r"theek|thik|good (morning|night|evening)|kaise ho|kya haal|bye|allah hafiz|khuda hafiz|"
+        r"lol|haha+|hmm+|nice|wow|great|jazakallah|mashallah)\b", re.I)
+    CODE = re.compile(
+        r"```|\bdef \w+\(|\bclass \w+|^\s*(import|from) \w+|#include|=>|\bfunction\s*\w*\(|"
+        r"[;{}]\s*$|\bSELECT\b.+\bFROM\b|Traceback|\w+Error\b", re.M | re.I)
+    MODE_WEIGHT = {"code": 1.0, "build": 1.5, "study": 0.8, "search": -0.5}
+    counts = {"fast": 0, "deep": 0}
+
+    @classmethod
+    def score(cls, prompt, mode="chat"):
+        """(score, reasons). >= DEPTH_THRESHOLD means the deep model."""
+        text = prompt or ""
+        tokens = ContextBuilder.estimate_tokens(text)
+        score, reasons = min(2.0, tokens / 120), [f"{tokens} tok"]
+        if cls.CODE.search(text):
+            score += 2.0
+            reasons.append("code")
+        keywords = len(cls.DEEP_WORDS.findall(text))
+        if keywords:
+            score += min(2.0, 1.2 * keywords)
+            reasons.append(f"{keywords} kw")
+        if cls.CHIT_CHAT.match(text) and tokens < 25:
+            score -= 2.0
+            reasons.append("chit-chat")
+        if text.count("?") > 1 or text.count("\n") > 4:
+            score += 0.5
+            reasons.append("multi-part")
+        if mode in cls.MODE_WEIGHT:
+            score += cls.MODE_WEIGHT[mode]
+            reasons.append(mode)
+        return score, reasons
+
+    @classmethod
+    def wants_deep(cls, prompt, mode="chat", toggle=False):
+        score, _ = cls.score(prompt, mode)
+        deep = score + (DEPTH_TOGGLE_BIAS if toggle else 0.0) >= DEPTH_THRESHOLD
+        cls.counts["deep" if deep else "fast"] += 1
+        return deep
+
+    @classmethod
+    def report(cls):
+        total = sum(cls.counts.values()) or 1
+        return (f"• auto depth {'ON' if AUTO_DEPTH else 'OFF'}: {cls.counts['fast']} fast · "
+                f"{cls.counts['deep']} deep ({100 * cls.counts['deep'] / total:.0f}% deep)")
+
+
 class NeuralEngine:
     """
     Priority chain: Gemini 1.5 Flash → Groq LLaMA-3.3-70b → OpenRouter
@@ -546,7 +2722,15 @@ class NeuralEngine:
         ),
     }
 
+    # (text, label) returned when no engine could answer.
+    OVERLOADED = (
+        "⚠️ Tamam AI Nodes temporarily overloaded hain.\n"
+        "Thodi der mein dobara try karein. Shukriya! 🙏",
+        "Error ❌"
+    )
+
     @classmethod
+    @lru_cache(maxsize=256)
     def build_system(cls, mode="chat", deep=False, custom=None):
         if custom:
             return custom
@@ -565,6 +2749,140 @@ class NeuralEngine:
             )
         return cls.BASE_SYSTEM + f"\nCURRENT MODE: {mode_hint}{length_hint}"
 
+    # ── Latency samples (for the p95 hedge delay) ────────────────────────────
+    _latencies = {}            # "engine:fast" / "engine:deep" -> deque of seconds
+    _latencies_lock = threading.Lock()
+
+    @classmethod
+    def _timed_call(cls, provider, key, fn, *args):
+        """Runs fn(*args), recording the outcome on ProviderHealth and its
+        latency (under `key`) on success — including for calls that lost a
+        race, so the p95 isn't skewed towards the fast ones."""
+        health = ProviderHealth.get(provider)
+        t0 = time.monotonic()
+        try:
+            result = fn(*args)
+        except Exception as e:
+            if ProviderHealth.is_provider_fault(e):
+                health.record_failure(e)
+            else:
+                health.release()    # no verdict: a fast 429 is not a fast provider
+            raise
+        elapsed = time.monotonic() - t0
+        health.record_success(elapsed)
+        cls._record_latency(key, elapsed)
+        return result
+
+    @classmethod
+    async def _atimed_call(cls, provider, key, coro_fn, *args):
+        """_timed_call for coroutines. A call cancelled because another
+        engine won the race is neither a success nor a failure."""
+        health = ProviderHealth.get(provider)
+        t0 = time.monotonic()
+        try:
+            result = await coro_fn(*args)
+        except asyncio.CancelledError:
+            health.release()
+            raise
+        except Exception as e:
+            if ProviderHealth.is_provider_fault(e):
+                health.record_failure(e)
+            else:
+                health.release()    # no verdict: a fast 429 is not a fast provider
+            raise
+        elapsed = time.monotonic() - t0
+        health.record_success(elapsed)
+        cls._record_latency(key, elapsed)
+        return result
+
+    @classmethod
+    async def _aquota_call(cls, eng, key, priority, est_tokens, prompt, system, history, fast, on_delta):
+        """acall_text behind ProviderLimiter: waits for / takes quota first
+        (QuotaExceeded if this priority class can't get any), then charges
+        the real size afterwards. A 429 drains the provider's bucket."""
+        limiter = ProviderLimiter.get(eng)
+        try:
+            granted = await limiter.acquire(est_tokens, priority)
+        except asyncio.CancelledError:
+            ProviderHealth.get(eng).release()
+            raise
+        if not granted:
+            ProviderHealth.get(eng).release()
+            raise QuotaExceeded(f"{eng} quota exhausted for {ProviderLimiter.CLASS_NAMES[priority]} requests")
+        try:
+            result = await cls._atimed_call(eng, key, cls.acall_text, eng, prompt, system, history, fast, on_delta)
+        except Exception as e:
+            if ProviderHealth.status_of(e) == 429:
+                limiter.drain(cls._retry_after(e))
+            raise
+        in_tokens = est_tokens - ProviderLimiter.OUTPUT_ESTIMATE["fast" if fast else "deep"]
+        limiter.settle(est_tokens, in_tokens + ContextBuilder.estimate_tokens(result))
+        return result
+
+    @classmethod
+    def quota_call(cls, provider, fn, tokens=0, priority=ProviderLimiter.INTERACTIVE):
+        """Blocking counterpart of _aquota_call for the calls that don't go
+        through the router (vision, Whisper, TTS): takes quota from
+        `provider`'s buckets, runs fn() on this thread, drains the bucket on
+        a 429. QuotaExceeded if this priority class can't get any."""
+        limiter = ProviderLimiter.get(provider)
+        if not limiter.acquire_sync(tokens, priority):
+            raise QuotaExceeded(f"{provider} quota exhausted for {ProviderLimiter.CLASS_NAMES[priority]} requests")
+        try:
+            return fn()
+        except Exception as e:
+            if ProviderHealth.status_of(e) == 429:
+                AsyncRuntime.loop().call_soon_threadsafe(limiter.drain, cls._retry_after(e))
+            raise
+
+    @staticmethod
+    def _retry_after(e):
+        headers = getattr(getattr(e, "response", None), "headers", None) or getattr(e, "headers", None) or {}
+        return headers.get("Retry-After")
+
+    @classmethod
+    def _record_latency(cls, key, elapsed):
+        if key:
+            with cls._latencies_lock:
+                cls._latencies.setdefault(key, deque(maxlen=200)).append(elapsed)
+
+    @classmethod
+    def first_healthy(cls, attempts, prefer_fastest=False, tokens=ProviderLimiter.VISION_ESTIMATE):
+        """attempts: {provider: (label, zero-arg callable)}. Tries them in
+        ProviderHealth.route() order, skipping tripped providers and ones
+        whose quota (ProviderLimiter.QUOTA_OF) is used up. Returns
+        (result, label, errors) — result is None if everything failed, and
+        errors maps provider -> exception for callers that need details."""
+        names, forced = ProviderHealth.route(attempts, prefer_fastest)
+        errors = {}
+        for name in names:
+            if not forced and not ProviderHealth.get(name).allow():
+                continue
+            label, fn = attempts[name]
+            try:
+                return cls.quota_call(ProviderLimiter.QUOTA_OF.get(name, name),
+                                      partial(cls._timed_call, name, None, fn), tokens), label, errors
+            except QuotaExceeded as e:
+                ProviderHealth.get(name).release()
+                logger.info(f"{name} skipped: {e}")
+                errors[name] = e
+            except Exception as e:
+                logger.warning(f"{name} failed: {e}")
+                errors[name] = e
+        return None, "", errors
+
+    @classmethod
+    def hedge_delay(cls, key):
+        """Seconds to wait on `key` before hedging with the next engine."""
+        if HEDGE_DELAY_MS:
+            return HEDGE_DELAY_MS / 1000
+        with cls._latencies_lock:
+            samples = sorted(cls._latencies.get(key, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_MS / 1000
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        return min(HEDGE_MAX_MS, max(HEDGE_MIN_MS, p95 * 1000)) / 1000
+
     @staticmethod
     def _history_to_gemini(history):
         parts = []
@@ -573,31 +2891,151 @@ class NeuralEngine:
             parts.append({"role": role, "parts": [{"text": h["content"]}]})
         return parts
 
+    SSE_DONE = object()
+
     @staticmethod
-    def call_gemini(prompt, system, history=None):
-        url = (
-            "https://generativelanguage.googleapis.com/v1beta/"
-            f"models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}"
-        )
-        contents = []
-        if history:
-            contents.extend(NeuralEngine._history_to_gemini(history))
-        contents.append({"role": "user", "parts": [{"text": prompt}]})
-        payload = {
-            "system_instruction": {"parts": [{"text": system}]},
-            "contents": contents,
-            "generationConfig": {"temperature": 0.75, "maxOutputTokens": 4096},
-        }
-        r = session.post(url, json=payload, timeout=20)
-        r.raise_for_status()
-        return r.json()["candidates"][0]["content"]["parts"][0]["text"]
+    def _sse_event(raw):
+        """One line of a server-sent-events stream -> its JSON event, None
+        for anything else (comments, keep-alives, bad JSON), or SSE_DONE."""
+        line = raw.decode("utf-8", "replace") if isinstance(raw, bytes) else raw
+        line = line.strip()
+        if not line.startswith("data:"):
+            return None
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return NeuralEngine.SSE_DONE
+        try:
+            return json.loads(data)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _chat_messages(prompt, system, history):
+        messages = [{"role": "system", "content": system}]
+        for h in history or ():
+            messages.append({"role": h["role"], "content": h["content"]})
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    @classmethod
+    def _text_request(cls, provider, prompt, system, history=None, fast=False, model=None, stream=False):
+        """(url, headers, payload) of one text-chat call — shared by the
+        blocking call_* methods and acall_text.
+
+        Groq: gpt-oss-120b by default, gpt-oss-20b with fast=True (~2x
+        faster; max_tokens also capped lower, which pairs with the
+        [FAST MODE] system-prompt instruction — Deep Think is what unlocks
+        the full 4096-token budget). model= overrides the choice. Under
+        load, LoadGovernor lowers every provider's output cap."""
+        if provider == "gemini":
+            method = "streamGenerateContent?alt=sse&" if stream else "generateContent?"
+            url = f"{GEMINI_BASE_URL}/v1beta/models/gemini-1.5-flash:{method}key={GEMINI_API_KEY}"
+            contents = cls._history_to_gemini(history or [])
+            contents.append({"role": "user", "parts": [{"text": prompt}]})
+            payload = {
+                "system_instruction": {"parts": [{"text": system}]},
+                "contents": contents,
+                "generationConfig": {"temperature": 0.75, "maxOutputTokens": LoadGovernor.cap(4096)},
+            }
+            return url, {}, payload
+        if provider == "groq":
+            url = f"{GROQ_BASE_URL}/openai/v1/chat/completions"
+            headers = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
+            payload = {
+                "model": model or ("openai/gpt-oss-20b" if fast else "openai/gpt-oss-120b"),
+                "messages": cls._chat_messages(prompt, system, history),
+                "temperature": 0.75,
+                "max_tokens": LoadGovernor.cap(700 if fast else 4096),
+            }
+        else:
+            url = f"{OPENROUTER_BASE_URL}/api/v1/chat/completions"
+            headers = {
+                "Authorization": f"Bearer {OPENROUTER_KEY}",
+                "Content-Type": "application/json",
+                "HTTP-Referer": "https://github.com/MiTV-Network",
+            }
+            payload = {
+                "model": "meta-llama/llama-3.3-70b-instruct",
+                "messages": cls._chat_messages(prompt, system, history),
+                "max_tokens": LoadGovernor.cap(4096),
+            }
+        if stream:
+            payload["stream"] = True
+        return url, headers, payload
+
+    @staticmethod
+    def _response_text(provider, body):
+        if provider == "gemini":
+            return body["candidates"][0]["content"]["parts"][0]["text"]
+        return body["choices"][0]["message"]["content"]
+
+    @staticmethod
+    def _delta_texts(provider, event):
+        """Text chunks carried by one streamed event."""
+        if provider == "gemini":
+            return [part["text"]
+                    for cand in event.get("candidates") or []
+                    for part in (cand.get("content") or {}).get("parts") or []
+                    if part.get("text")]
+        choices = event.get("choices") or [{}]
+        delta = (choices[0].get("delta") or {}).get("content")
+        return [delta] if delta else []
+
+    @classmethod
+    def _call_text(cls, provider, prompt, system, history=None, fast=False, model=None, on_delta=None):
+        """Blocking text call. on_delta: optional callback — if given, the
+        answer is streamed (SSE) and on_delta(text) is called per chunk.
+        Either way the full text is returned."""
+        url, headers, payload = cls._text_request(
+            provider, prompt, system, history, fast, model, stream=bool(on_delta))
+        if not on_delta:
+            r = session.post(url, headers=headers, json=payload, timeout=20)
+            r.raise_for_status()
+            return cls._response_text(provider, r.json())
+        parts = []
+        with session.post(url, headers=headers, json=payload, timeout=20, stream=True) as r:
+            r.raise_for_status()
+            for raw in r.iter_lines():
+                event = cls._sse_event(raw)
+                if event is cls.SSE_DONE:
+                    break
+                for text in cls._delta_texts(provider, event) if event else ():
+                    parts.append(text)
+                    on_delta(text)
+        if not parts:
+            raise RuntimeError("stream ended without any content")
+        return "".join(parts)
+
+    @classmethod
+    async def acall_text(cls, provider, prompt, system, history=None, fast=False, on_delta=None):
+        """Coroutine version of the call_* methods, for the event loop."""
+        if not HAS_AIOHTTP:
+            sync = {
+                "gemini"     : cls.call_gemini,
+                "groq"       : partial(cls.call_groq, fast=fast),
+                "openrouter" : cls.call_openrouter,
+            }[provider]
+            return await AsyncRuntime.io(sync, prompt, system, history, on_delta=on_delta)
+        url, headers, payload = cls._text_request(
+            provider, prompt, system, history, fast, stream=bool(on_delta))
+        if not on_delta:
+            return cls._response_text(provider, await AsyncHTTP.post_json(url, headers, payload))
+        parts = []
+        async for event in AsyncHTTP.sse_events(url, headers, payload):
+            for text in cls._delta_texts(provider, event):
+                parts.append(text)
+                on_delta(text)
+        if not parts:
+            raise RuntimeError("stream ended without any content")
+        return "".join(parts)
+
+    @classmethod
+    def call_gemini(cls, prompt, system, history=None, on_delta=None):
+        return cls._call_text("gemini", prompt, system, history, on_delta=on_delta)
 
     @staticmethod
     def call_gemini_vision(image_bytes, mime_type, prompt, system):
-        url = (
-            "https://generativelanguage.googleapis.com/v1beta/"
-            f"models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}"
-        )
+        url = f"{GEMINI_BASE_URL}/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}"
         b64 = base64.b64encode(image_bytes).decode()
         payload = {
             "system_instruction": {"parts": [{"text": system}]},
@@ -613,37 +3051,12 @@ class NeuralEngine:
         r.raise_for_status()
         return r.json()["candidates"][0]["content"]["parts"][0]["text"]
 
-    @staticmethod
-    def call_groq(prompt, system, history=None, fast=False, model=None):
-        """Groq text chat. By default uses gpt-oss-120b (best quality).
-        Pass fast=True for gpt-oss-20b (~2x faster, still very capable) —
-        used for short group replies, quick signal summaries, anything
-        latency-sensitive. Pass an explicit model= to override entirely.
-
-        max_tokens is also capped lower in fast mode: shorter generations
-        finish faster regardless of tokens/sec, and pairs with the
-        [FAST MODE] system-prompt instruction to keep replies concise
-        instead of long by default — Deep Think is what unlocks the full
-        4096-token budget for long, thorough answers."""
-        headers = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
-        messages = [{"role": "system", "content": system}]
-        if history:
-            for h in history:
-                messages.append({"role": h["role"], "content": h["content"]})
-        messages.append({"role": "user", "content": prompt})
-        chosen_model = model or ("openai/gpt-oss-20b" if fast else "openai/gpt-oss-120b")
-        payload = {
-            "model": chosen_model,
-            "messages": messages,
-            "temperature": 0.75,
-            "max_tokens": 700 if fast else 4096,
-        }
-        r = session.post(
-            "https://api.groq.com/openai/v1/chat/completions",
-            headers=headers, json=payload, timeout=20,
-        )
-        r.raise_for_status()
-        return r.json()["choices"][0]["message"]["content"]
+    @classmethod
+    def call_groq(cls, prompt, system, history=None, fast=False, model=None, on_delta=None):
+        """Groq text chat — see _text_request for the model choice. Used
+        directly for latency-sensitive calls (group replies, quick signal
+        summaries) as well as by the router."""
+        return cls._call_text("groq", prompt, system, history, fast=fast, model=model, on_delta=on_delta)
 
     @staticmethod
     def call_groq_vision(image_bytes, prompt, system, mime_type="image/jpeg", json_mode=False):
@@ -682,7 +3095,7 @@ class NeuralEngine:
         if json_mode:
             payload["response_format"] = {"type": "json_object"}
         r = session.post(
-            "https://api.groq.com/openai/v1/chat/completions",
+            f"{GROQ_BASE_URL}/openai/v1/chat/completions",
             headers=headers, json=payload, timeout=25,
         )
         r.raise_for_status()
@@ -714,7 +3127,7 @@ class NeuralEngine:
             "response_format": "wav",
         }
         r = session.post(
-            "https://api.groq.com/openai/v1/audio/speech",
+            f"{GROQ_BASE_URL}/openai/v1/audio/speech",
             headers=headers, json=payload, timeout=20,
         )
         r.raise_for_status()
@@ -732,7 +3145,7 @@ class NeuralEngine:
                 files = {"file": (filename, audio_bytes, "audio/ogg")}
                 data = {"model": model_id}
                 r = session.post(
-                    "https://api.groq.com/openai/v1/audio/transcriptions",
+                    f"{GROQ_BASE_URL}/openai/v1/audio/transcriptions",
                     headers=headers, files=files, data=data, timeout=30,
                 )
                 r.raise_for_status()
@@ -740,35 +3153,27 @@ class NeuralEngine:
             except Exception as e:
                 logger.warning(f"Whisper model {model_id} failed: {e}")
                 continue
-        raise RuntimeError("Both Whisper models failed")
-
-    @staticmethod
-    def call_openrouter(prompt, system, history=None):
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_KEY}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "https://github.com/MiTV-Network",
-        }
-        messages = [{"role": "system", "content": system}]
-        if history:
-            for h in history:
-                messages.append({"role": h["role"], "content": h["content"]})
-        messages.append({"role": "user", "content": prompt})
-        payload = {
-            "model": "meta-llama/llama-3.3-70b-instruct",
-            "messages": messages,
-            "max_tokens": 4096,
-        }
-        r = session.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers=headers, json=payload, timeout=20,
-        )
-        r.raise_for_status()
-        return r.json()["choices"][0]["message"]["content"]
+        raise RuntimeError("Both Whisper models failed")
+
+    @classmethod
+    def call_openrouter(cls, prompt, system, history=None, on_delta=None):
+        return cls._call_text("openrouter", prompt, system, history, on_delta=on_delta)
+
+    @classmethod
+    def get_response(cls, *args, **kwargs):
+        """Blocking form of aget_response, for code running on a thread
+        (handlers, offloaded jobs). Never call it from a coroutine, or from
+        the io pool. Gives up after RESPONSE_TIMEOUT with the overloaded reply."""
+        try:
+            return AsyncRuntime.run(cls.aget_response(*args, **kwargs), timeout=RESPONSE_TIMEOUT)
+        except FutureTimeout:
+            logger.warning(f"get_response timed out after {RESPONSE_TIMEOUT:g}s (uid={args[0] if args else '?'})")
+            return cls.OVERLOADED
 
     @classmethod
-    def get_response(cls, uid, prompt, engine_override=None, custom_role=None,
-                      use_history=True, chat_id=None, author="", fast=False):
+    async def aget_response(cls, uid, prompt, engine_override=None, custom_role=None,
+                            use_history=True, chat_id=None, author="", fast=False, stream=None,
+                            cache_site=None, bypass_cache=False, priority=None, persist=True):
         """
         Main router. Returns (response_text, engine_label).
         Injects conversation history automatically.
@@ -782,26 +3187,125 @@ class NeuralEngine:
         default gpt-oss-120b) for latency-sensitive replies — short group
         chatter, quick acknowledgements — where near-instant response
         matters more than the small quality difference.
+
+        stream: optional ProgressiveReply — engines are then called in
+        streaming mode and their text is fed to it as it arrives. The
+        return value is the same either way.
+
+        cache_site: for use_history=False calls, names the caller
+        ("search", "document", "chatter") — the answer is then looked up
+        in / stored to response_cache with that site's TTL, keyed on
+        (system prompt, prompt, engine, speed). bypass_cache=True skips
+        the lookup and stores a fresh answer.
+
+        priority: ProviderLimiter class of the call; by default chatter for
+        cache_site="chatter", background for "document", else interactive.
+
+        persist=False keeps the exchange out of memory entirely — for
+        prompts that aren't the user's own words (GroupChatter sends a
+        transcript of other people's group messages under the last
+        speaker's uid, and stores its reply in group memory itself).
+
+        Identical history-free calls in flight at the same time are
+        coalesced (ai_flight): only the first reaches a provider.
         """
-        u = db.get_user(uid)
+        if use_history or stream is not None:
+            return await LoadGovernor.track(cls._arespond(
+                uid, prompt, engine_override, custom_role, use_history,
+                chat_id, author, fast, stream, cache_site, bypass_cache, priority, persist))
+        u = await AsyncRuntime.io(db.get_user, uid)
+        deep = bool(u.get("deep_think", 0))
+        key = ResponseCache.key(
+            "ai", cls.build_system(u.get("mode", "chat"), deep, custom_role), prompt,
+            engine_override or u.get("engine", "auto"), "fast" if (fast or not deep) else "deep")
+        result, shared = await ai_flight.ado(key, lambda: LoadGovernor.track(cls._arespond(
+            uid, prompt, engine_override, custom_role, use_history,
+            chat_id, author, fast, stream, cache_site, bypass_cache, priority, persist)))
+        if shared:
+            await AsyncRuntime.io(cls._remember, uid, chat_id, author, prompt, result[0], result[1],
+                                  persist and result is not cls.OVERLOADED, "ai_dedup", cache_site or "")
+        return result
+
+    @staticmethod
+    def _remember(uid, chat_id, author, prompt, response, engine, persist, event, detail):
+        """Bookkeeping for one answered prompt (io pool): uid's query count,
+        the exchange in uid's — or the group's — memory unless persist is
+        False, and an analytics event. The same whether the answer came from
+        a provider, response_cache or another caller's identical request,
+        so a user's transcript doesn't depend on who asked first."""
+        db.increment_queries(uid)
+        if persist and chat_id is not None:
+            db.add_group_memory(chat_id, "user", prompt, author=author)
+            db.add_group_memory(chat_id, "assistant", response, engine=engine)
+        elif persist:
+            db.add_memory(uid, "user", prompt)
+            db.add_memory(uid, "assistant", response, engine)
+        db.log_event(uid, event, detail)
+
+    @classmethod
+    async def _arespond(cls, uid, prompt, engine_override, custom_role, use_history,
+                        chat_id, author, fast, stream, cache_site, bypass_cache, priority, persist):
+        """The router itself — see aget_response. Every SQLite / disk-cache
+        call here goes through AsyncRuntime.io: a cold page or a busy shard
+        must not stall every other conversation on the loop."""
+
+        u = await AsyncRuntime.io(db.get_user, uid)
         mode   = u.get("mode", "chat")
         deep   = bool(u.get("deep_think", 0))
+        if AUTO_DEPTH and not fast:
+            deep = ComplexityRouter.wants_deep(prompt, mode, toggle=deep)
+        if deep and LoadGovernor.downgrade():
+            deep = False        # busy: Deep Think waits, everyone gets the fast model
         engine = engine_override or u.get("engine", "auto")
         system = cls.build_system(mode, deep, custom_role)
 
         # Auto speed selection: unless the caller already forced fast=True
-        # for a specific reason (group chatter, quick acks), use the fast
-        # 20B model whenever Deep Think is OFF, and the full 120B model
-        # only when the user explicitly wants deeper/longer answers via
-        # Deep Think. This keeps normal chat snappy and reserves the
-        # slower, higher-quality model for when it's actually asked for.
+        # for a specific reason (group chatter, quick acks), `deep` above is
+        # ComplexityRouter's call for this message (Deep Think biases it
+        # towards deep; with TITAN_AUTO_DEPTH=0 it is the toggle alone), and
+        # the fast 20B model answers everything that isn't deep. This keeps
+        # small talk snappy and sends hard questions to the 120B model even
+        # when the user never found the toggle.
         effective_fast = fast or (not deep)
 
+        cache_key = None
+        if cache_site and not use_history and stream is None:
+            cache_key = ResponseCache.key(cache_site, system, prompt, engine,
+                                          "fast" if effective_fast else "deep")
+            hit = await AsyncRuntime.io(response_cache.get, cache_site, cache_key, bypass=bypass_cache)
+            if hit is not None:
+                await AsyncRuntime.io(cls._remember, uid, chat_id, author, prompt, hit[0], hit[1],
+                                      persist, "ai_cache_hit", cache_site)
+                return hit[0], hit[1]
+
         is_group = chat_id is not None
+        scope, scope_key = ("group", chat_id) if is_group else ("user", uid)
+        call_system = system
         if use_history:
-            history = db.get_group_history(chat_id, limit=12) if is_group else db.get_history(uid, limit=8)
+            def load_context():
+                # Older turns come in as the rolling summary; only the ones it
+                # hasn't absorbed yet are sent verbatim.
+                summary = db.get_summary(scope, scope_key) if SUMMARY_ENABLED else None
+                after = summary["upto_id"] if summary else 0
+                rows = (db.get_group_history(chat_id, limit=CONTEXT_MAX_TURNS, after_id=after) if is_group
+                        else db.get_history(uid, limit=CONTEXT_MAX_TURNS, after_id=after))
+                # Plus whatever older turns match this message best (BM25).
+                extra = []
+                if summary and summary["summary"]:
+                    extra.append(f"{ConversationSummarizer.HEADER}\n{summary['summary']}")
+                if RECALL_ENABLED:
+                    recalled = db.recall(scope, scope_key, prompt, limit=RECALL_TOP_K,
+                                         before_id=rows[0]["id"] if rows else None)
+                    block = ContextBuilder.recall_block(recalled) if recalled else ""
+                    if block:
+                        extra.append(block)
+                return rows, extra
+
+            rows, extra = await AsyncRuntime.io(load_context)
+            if extra:
+                call_system = "\n\n".join([system, *extra])
         else:
-            history = []
+            rows = []
 
         order_map = {
             "auto"       : ["gemini", "groq", "openrouter"],
@@ -810,40 +3314,188 @@ class NeuralEngine:
             "openrouter" : ["openrouter", "groq", "gemini"],
         }
         order = order_map.get(engine, ["gemini", "groq", "openrouter"])
+        # Skip engines whose circuit is open; "auto" also goes fastest-first.
+        order, forced = ProviderHealth.route(order, prefer_fastest=(engine == "auto"))
 
         labels = {
             "gemini"     : "Gemini-1.5-Flash 💎",
             "groq"       : "Groq GPT-OSS-20B ⚡⚡" if effective_fast else "Groq GPT-OSS-120B ⚡",
             "openrouter" : "OpenRouter Llama 🌐",
         }
-        funcs = {
-            "gemini"     : lambda p, s, h: cls.call_gemini(p, s, h),
-            "groq"       : lambda p, s, h: cls.call_groq(p, s, h, fast=effective_fast),
-            "openrouter" : lambda p, s, h: cls.call_openrouter(p, s, h),
-        }
+        def feeder(eng):
+            return (lambda text: stream.feed(eng, text)) if stream is not None else None
+
+        def remember(eng, response):
+            cls._remember(uid, chat_id, author, prompt, response, eng, persist, "ai_query", eng)
+            if cache_key is not None:
+                response_cache.set(cache_site, cache_key, [response, labels[eng]])
+
+        # Engines run as tasks on the event loop. The next one in `order` is
+        # started when a running one fails, or (hedging) when the newest one
+        # has been running longer than its hedge delay. First success wins;
+        # slower engines still in flight are cancelled (their HTTP requests
+        # are closed) — only the winner is written to memory.
+        speed   = "fast" if effective_fast else "deep"
+        waiting = list(order)
+        running = {}   # task -> engine
+        if priority is None:
+            priority = ProviderLimiter.priority_for(cache_site)
+        shed = []
+
+        def launch():
+            while waiting:
+                eng = waiting.pop(0)
+                if not forced and not ProviderHealth.get(eng).allow():
+                    continue   # tripped (or half-open trial already running)
+                # Each engine gets the history that fits its own budget.
+                history, call_prompt, tokens = ContextBuilder.build(eng, mode, deep, call_system, prompt, rows)
+                logger.info(f"Engine [{eng}] | uid={uid} | chat={chat_id} | fast={fast} | "
+                            f"ctx={len(history)} turns/{tokens} tok{' | hedge' if running else ''}")
+                task = asyncio.ensure_future(cls._aquota_call(
+                    eng, f"{eng}:{speed}", priority, tokens + ProviderLimiter.OUTPUT_ESTIMATE[speed],
+                    call_prompt, call_system, history, effective_fast, feeder(eng)))
+                running[task] = eng
+                return eng
+            return None
 
-        for eng in order:
-            try:
-                logger.info(f"Engine [{eng}] | uid={uid} | chat={chat_id} | fast={fast}")
-                response = funcs[eng](prompt, system, history)
-                db.increment_queries(uid)
-                if is_group:
-                    db.add_group_memory(chat_id, "user", prompt, author=author)
-                    db.add_group_memory(chat_id, "assistant", response, engine=eng)
-                else:
-                    db.add_memory(uid, "user", prompt)
-                    db.add_memory(uid, "assistant", response, eng)
-                db.log_event(uid, "ai_query", eng)
+        newest = launch()
+        while running:
+            hedge_in = None
+            if (HEDGE_ENABLED and waiting and LoadGovernor.level() == LoadGovernor.NORMAL
+                    and not (stream is not None and stream.has_output())):
+                # (no hedging once an engine is visibly streaming its answer)
+                hedge_in = cls.hedge_delay(f"{newest}:{speed}")
+            done, _ = await asyncio.wait(running, timeout=hedge_in, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                newest = launch() or newest
+                continue
+            for fut in done:
+                eng = running.pop(fut)
+                try:
+                    response = fut.result()
+                except QuotaExceeded as e:
+                    logger.info(f"Engine {eng} skipped: {e}")
+                    shed.append(eng)
+                    newest = launch() or newest
+                    continue
+                except Exception as e:
+                    logger.warning(f"Engine {eng} failed: {e}")
+                    if stream is not None:
+                        stream.drop(eng)
+                    newest = launch() or newest
+                    continue
+                for loser in running:
+                    loser.cancel()
+                await AsyncRuntime.io(remember, eng, response)
+                if use_history and persist:
+                    ConversationSummarizer.touch(scope, scope_key)
                 return response, labels[eng]
+
+        if shed:
+            logger.warning(f"AI request shed (uid={uid}, {ProviderLimiter.CLASS_NAMES[priority]}): "
+                           f"no quota on {', '.join(shed)}")
+        return cls.OVERLOADED
+
+
+class ConversationSummarizer:
+    """Rolling per-conversation summaries (see ROLLING SUMMARIES config).
+
+    get_response marks a conversation dirty after each turn it stores; the
+    background job picks dirty ones up, and once enough turns are waiting
+    it asks the fast model for old summary + evicted turns -> new summary.
+    Runs on the event loop at background priority, so it only ever spends
+    quota that interactive traffic isn't using.
+    """
+
+    ENGINES = ("groq", "gemini")   # groq = gpt-oss-20b with fast=True
+    HEADER  = "Is conversation ka pehle ka hissa (summary):"
+    SYSTEM  = (
+        "You maintain the running memory of a chat between a user (or a group) and an AI "
+        "assistant. Merge the previous summary and the new turns into ONE updated summary: "
+        "names, facts about the people, decisions, open questions, code/project details and "
+        "preferences that may matter later. Drop greetings and small talk. Plain bullet "
+        "points, same language mix as the chat, at most {words} words. Output only the summary."
+    )
+
+    _dirty   = set()    # (scope, key)
+    _running = set()
+    _lock    = threading.Lock()
+    runs = failures = 0
+
+    @classmethod
+    def touch(cls, scope, key):
+        if SUMMARY_ENABLED:
+            with cls._lock:
+                cls._dirty.add((scope, key))
+
+    @classmethod
+    def run(cls):
+        """Background job: start a summarizer task for every dirty
+        conversation that isn't already being summarized. Returns at once —
+        quota waits happen on the event loop, not on the jobs thread."""
+        with cls._lock:
+            todo = cls._dirty - cls._running
+            cls._dirty -= todo
+            cls._running |= todo
+        for scope, key in todo:
+            AsyncRuntime.spawn(cls._arun(scope, key))
+        return len(todo)
+
+    @classmethod
+    async def _arun(cls, scope, key):
+        try:
+            await cls.asummarize(scope, key)
+        finally:
+            with cls._lock:
+                cls._running.discard((scope, key))
+
+    @classmethod
+    def _transcript(cls, rows):
+        lines = []
+        for r in rows:
+            who = "Assistant" if r["role"] == "assistant" else (r.get("author") or "User")
+            lines.append(f"{who}: {ContextBuilder.truncate(r['content'] or '', 300)}")
+        return "\n".join(lines)
+
+    @classmethod
+    async def asummarize(cls, scope, key, force=False):
+        """Fold the turns that left the window into the summary. Returns
+        the number of turns folded in (0 if not due yet or the call failed)."""
+        current = await AsyncRuntime.io(db.get_summary, scope, key) or {"summary": "", "upto_id": 0, "n_turns": 0}
+        rows = await AsyncRuntime.io(db.get_unsummarized, scope, key, current["upto_id"],
+                                     SUMMARY_MAX_ROWS + SUMMARY_KEEP_TURNS)
+        if len(rows) <= SUMMARY_KEEP_TURNS or (len(rows) < SUMMARY_TRIGGER_TURNS and not force):
+            return 0
+        evicted = rows[:-SUMMARY_KEEP_TURNS]
+        prompt = (f"Previous summary:\n{current['summary'] or '(none yet)'}\n\n"
+                  f"New turns:\n{cls._transcript(evicted)}")
+        system = cls.SYSTEM.format(words=SUMMARY_MAX_TOKENS * 3 // 4)
+        tokens = ContextBuilder.estimate_tokens(prompt) + ContextBuilder.estimate_tokens(system)
+        for eng in cls.ENGINES:
+            if not ProviderHealth.get(eng).allow():
+                continue
+            try:
+                text = await NeuralEngine._aquota_call(
+                    eng, f"{eng}:fast", ProviderLimiter.BACKGROUND,
+                    tokens + ProviderLimiter.OUTPUT_ESTIMATE["fast"],
+                    prompt, system, [], True, None)
             except Exception as e:
-                logger.warning(f"Engine {eng} failed: {e}")
+                logger.info(f"Summary of {scope}:{key} via {eng} failed: {e}")
                 continue
-
-        return (
-            "⚠️ Tamam AI Nodes temporarily overloaded hain.\n"
-            "Thodi der mein dobara try karein. Shukriya! 🙏",
-            "Error ❌"
-        )
+            text = ContextBuilder.truncate((text or "").strip(), SUMMARY_MAX_TOKENS)
+            if not text:
+                continue
+            await AsyncRuntime.io(db.set_summary, scope, key, text, evicted[-1]["id"],
+                                  current["n_turns"] + len(evicted))
+            cls.runs += 1
+            logger.info(f"Summary {scope}:{key} += {len(evicted)} turns "
+                        f"({current['n_turns'] + len(evicted)} total) via {eng}")
+            if len(rows) == SUMMARY_MAX_ROWS + SUMMARY_KEEP_TURNS:
+                cls.touch(scope, key)      # a long backlog — carry on next run
+            return len(evicted)
+        cls.failures += 1
+        cls.touch(scope, key)              # retry on the next run
+        return 0
 
 
 # ══════════════════════════════════════════════════════════════════════════════════
@@ -889,8 +3541,28 @@ class WebSearchEngine:
         return results
 
     @classmethod
-    def search_and_summarize(cls, uid, query):
-        """Full search + AI summarization pipeline."""
+    def search_and_summarize(cls, uid, query, fresh=False):
+        """Full search + AI summarization pipeline.
+
+        The (summary, sources) pair is cached per normalized query for
+        RESPONSE_CACHE_TTLS["search"], so a popular search skips both the
+        web search and the AI call. fresh=True re-runs it and refreshes
+        the cached copy."""
+        key = ResponseCache.key("search", query)
+        hit = response_cache.get("search", key, bypass=fresh)
+        if hit is not None:
+            db.increment_queries(uid)
+            db.log_event(uid, "ai_cache_hit", "search")
+            return hit[0], hit[1]
+        # Same query already being searched for someone else? Share it.
+        (ans, results), shared = search_flight.do(key, cls._search_and_summarize, uid, query, key)
+        if shared:
+            db.increment_queries(uid)
+            db.log_event(uid, "ai_dedup", "search")
+        return ans, results
+
+    @classmethod
+    def _search_and_summarize(cls, uid, query, key):
         results = cls.search(query, max_results=5)
         if not results:
             return f"❌ '{query}' ke liye koi results nahi mile.", []
@@ -911,6 +3583,8 @@ class WebSearchEngine:
             custom_role="Expert Internet Researcher & Summarizer",
             use_history=False
         )
+        if node != "Error ❌":
+            response_cache.set("search", key, [ans, results[:3]])
         return ans, results[:3]
 
 
@@ -932,14 +3606,24 @@ class ImageEngine:
         """
         Try each Pollinations model in order.
         Returns (image_bytes, model_used) or (None, None).
+
+        Without an explicit seed, concurrent requests for the same prompt
+        and size share one generation (image_flight).
         """
+        if seed is None:
+            key = ResponseCache.key("image", prompt, width, height)
+            return image_flight.do(key, cls._generate, prompt, width, height, None)[0]
+        return cls._generate(prompt, width, height, seed)
+
+    @classmethod
+    def _generate(cls, prompt, width, height, seed):
         if seed is None:
             seed = random.randint(1, 999999)
         encoded = requests.utils.quote(prompt)
 
         for model in cls.MODELS:
             url = (
-                f"https://image.pollinations.ai/prompt/{encoded}"
+                f"{POLLINATIONS_BASE_URL}/prompt/{encoded}"
                 f"?model={model}&width={width}&height={height}"
                 f"&seed={seed}&nologo=true&enhance=true"
             )
@@ -1030,45 +3714,30 @@ class TradingSignalEngine:
         if user_note:
             prompt += f"\n\nUser ka extra note: {user_note}"
 
-        raw = None
-        engine_used = ""
+        # Groq first (JSON mode is what makes the signal parse reliably);
+        # Gemini only when Groq fails or its circuit is open.
+        raw, engine_used, errors = NeuralEngine.first_healthy({
+            "groq_vision": ("Groq Qwen3.6-27b Vision ⚡", lambda: NeuralEngine.call_groq_vision(
+                image_bytes, prompt, cls.SYSTEM_PROMPT, mime_type, json_mode=True)),
+            "gemini_vision": ("Gemini Vision 💎 (Groq fallback)", lambda: NeuralEngine.call_gemini_vision(
+                image_bytes, mime_type, prompt + "\n\n" + cls.SYSTEM_PROMPT, cls.SYSTEM_PROMPT)),
+        })
         groq_error_detail = ""
-        try:
-            raw = NeuralEngine.call_groq_vision(
-                image_bytes, prompt, cls.SYSTEM_PROMPT, mime_type, json_mode=True
-            )
-            engine_used = "Groq Qwen3.6-27b Vision ⚡"
-        except requests.exceptions.HTTPError as e:
-            body = ""
+        groq_error = errors.get("groq_vision")
+        body = ""
+        if isinstance(groq_error, requests.exceptions.HTTPError):
             try:
-                body = e.response.text[:300]
+                body = groq_error.response.text[:300]
             except Exception:
                 pass
-            if "terms_required" in body or "model_terms_required" in body:
-                groq_error_detail = (
-                    "Groq vision model (qwen3.6-27b) ke terms accept nahi hue. "
-                    "Fix: https://console.groq.com/playground?model=qwen/qwen3.6-27b "
-                    "pe ja kar Accept Terms dabao."
-                )
-            logger.warning(f"Groq chart vision failed: {e} | {body}")
-            try:
-                raw = NeuralEngine.call_gemini_vision(
-                    image_bytes, mime_type,
-                    prompt + "\n\n" + cls.SYSTEM_PROMPT, cls.SYSTEM_PROMPT
-                )
-                engine_used = "Gemini Vision 💎 (Groq fallback)"
-            except Exception as e2:
-                logger.error(f"Gemini chart vision also failed: {e2}")
-        except Exception as e:
-            logger.warning(f"Groq chart vision failed: {e}")
-            try:
-                raw = NeuralEngine.call_gemini_vision(
-                    image_bytes, mime_type,
-                    prompt + "\n\n" + cls.SYSTEM_PROMPT, cls.SYSTEM_PROMPT
-                )
-                engine_used = "Gemini Vision 💎 (Groq fallback)"
-            except Exception as e2:
-                logger.error(f"Gemini chart vision also failed: {e2}")
+        if "terms_required" in body or "model_terms_required" in body:
+            groq_error_detail = (
+                "Groq vision model (qwen3.6-27b) ke terms accept nahi hue. "
+                "Fix: https://console.groq.com/playground?model=qwen/qwen3.6-27b "
+                "pe ja kar Accept Terms dabao."
+            )
+        if not raw and errors:
+            logger.error(f"Chart vision failed on every provider: {errors}")
 
         parsed = cls._safe_parse(raw)
         parsed["engine_used"] = engine_used or "N/A"
@@ -1297,9 +3966,14 @@ class PDFGenerator:
         content, _ = NeuralEngine.get_response(
             uid, prompt,
             custom_role="Professional Author & Document Writer",
-            use_history=False
+            use_history=False, cache_site="document"
         )
+        return AsyncRuntime.cpu_pool.submit(
+            cls._render, uid, topic, content, theme, subtitle, author).result()
 
+    @classmethod
+    def _render(cls, uid, topic, content, theme, subtitle, author):
+        """Lays the answer out as a PDF — runs on the cpu pool."""
         pdf = FPDF()
         pdf.set_auto_page_break(auto=True, margin=15)
 
@@ -1456,7 +4130,7 @@ class ZipProjectGenerator:
         raw, _ = NeuralEngine.get_response(
             uid, prompt,
             custom_role="Expert Full-Stack Web Developer",
-            use_history=False
+            use_history=False, cache_site="document"
         )
 
         # Parse JSON
@@ -1480,7 +4154,11 @@ class ZipProjectGenerator:
 
         if not files:
             return None, "Koi files generate nahi huin."
+        return AsyncRuntime.cpu_pool.submit(cls._render, uid, project_name, files).result()
 
+    @classmethod
+    def _render(cls, uid, project_name, files):
+        """Deflates the files into a ZIP — runs on the cpu pool."""
         # Create ZIP in memory
         zip_buf = io.BytesIO()
         with zipfile.ZipFile(zip_buf, 'w', zipfile.ZIP_DEFLATED) as zf:
@@ -1514,9 +4192,13 @@ class WordDocGenerator:
         content, _ = NeuralEngine.get_response(
             uid, prompt,
             custom_role="Professional Document Writer",
-            use_history=False
+            use_history=False, cache_site="document"
         )
+        return AsyncRuntime.cpu_pool.submit(cls._render, uid, topic, content, author).result()
 
+    @classmethod
+    def _render(cls, uid, topic, content, author):
+        """Builds the .docx from the answer — runs on the cpu pool."""
         doc = Document()
 
         # Title
@@ -1565,6 +4247,91 @@ class WordDocGenerator:
         return fname, None
 
 
+# ══════════════════════════════════════════════════════════════════════════════════
+# 📜  SECTION 8B : CHAT HISTORY EXPORT
+# ══════════════════════════════════════════════════════════════════════════════════
+
+# Exports are built in memory and only spill to a temp file (in the system
+# temp dir, never the bot's working directory) past this size.
+EXPORT_SPOOL_BYTES = 1024 * 1024
+
+
+class HistoryExporter:
+    FORMATS = ("txt", "jsonl", "md")
+
+    @classmethod
+    def build(cls, uid, name="", fmt="txt", since=None, until=None, compress=False):
+        """Streams uid's full history into a spooled buffer, one row at a
+        time, optionally through gzip. Returns (file, filename, n_rows); the
+        file is rewound and ready for send_document — close it after."""
+        fname = f"history_{uid}.{fmt}" + (".gz" if compress else "")
+        spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES, mode="w+b")
+        gz = gzip.GzipFile(filename=fname[:-3], mode="wb", fileobj=spool) if compress else None
+        out = gz or spool
+
+        def write(text):
+            out.write(text.encode("utf-8"))
+
+        span = f"{since or 'start'} → {until or 'now'}"
+        if fmt == "txt":
+            write(f"{BOT_NAME} — Chat History Export\n"
+                  f"User: {name} | UID: {uid}\nRange: {span}\n"
+                  f"Exported: {datetime.now()}\n{'═' * 50}\n\n")
+        elif fmt == "md":
+            write(f"# {BOT_NAME} — Chat History\n\n"
+                  f"- **User:** {name} (`{uid}`)\n- **Range:** {span}\n"
+                  f"- **Exported:** {datetime.now():%Y-%m-%d %H:%M}\n\n---\n\n")
+
+        n = 0
+        for r in db.iter_history(uid, since, until):
+            n += 1
+            who = "👤 You" if r["role"] == "user" else "🤖 AI"
+            if fmt == "jsonl":
+                write(json.dumps(r, ensure_ascii=False) + "\n")
+            elif fmt == "md":
+                engine = f" · _{r['engine']}_" if r.get("engine") else ""
+                write(f"### {who} · {r['ts']}{engine}\n\n{r['content']}\n\n---\n\n")
+            else:
+                write(f"{who} [{r['ts']}]:\n{r['content']}\n{'─' * 40}\n")
+        if n == 0 and fmt == "txt":
+            write("No history found.\n")
+
+        if gz:
+            gz.close()   # writes the gzip trailer; leaves spool open
+        spool.seek(0)
+        return spool, fname, n
+
+    @classmethod
+    def parse_args(cls, args):
+        """`/export [txt|jsonl|md] [gz] [YYYY-MM-DD [YYYY-MM-DD]]` ->
+        (fmt, compress, since, until). The second date is inclusive."""
+        fmt, compress, dates = "txt", False, []
+        for a in args:
+            a = a.lower()
+            if a in cls.FORMATS:
+                fmt = a
+            elif a in ("gz", "gzip"):
+                compress = True
+            elif re.fullmatch(r"\d{4}-\d{2}-\d{2}", a):
+                dates.append(a)
+        since = dates[0] if dates else None
+        until = None
+        if len(dates) > 1:
+            until = (datetime.strptime(dates[1], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+        return fmt, compress, since, until
+
+
+def send_history_export(chat_id, uid, name="", fmt="txt", since=None, until=None, compress=False):
+    upload_doc_action(chat_id)
+    f, fname, n = HistoryExporter.build(uid, name, fmt, since, until, compress)
+    try:
+        bot.send_document(chat_id, f, visible_file_name=fname,
+                          caption=f"📜 *Your Chat History* — {n} messages",
+                          parse_mode="Markdown")
+    finally:
+        f.close()
+
+
 # ══════════════════════════════════════════════════════════════════════════════════
 # 🎛️  SECTION 9 : UI — KEYBOARDS & MENUS
 # ══════════════════════════════════════════════════════════════════════════════════
@@ -1668,6 +4435,164 @@ def pdf_theme_kb():
 # ✨  SECTION 10 : ANIMATION ENGINE
 # ══════════════════════════════════════════════════════════════════════════════════
 
+def _md_pages(text, limit=4000):
+    """Split text into Telegram-sized pages on line boundaries. A page cut
+    inside a ``` block is closed and the block reopened on the next page,
+    so every page is valid Markdown on its own."""
+    pages, cur, in_code = [], "", False
+    for line in text.split("\n"):
+        reopen = "```\n" if in_code else ""
+        while len(cur) + len(line) > limit - 8:  # a huge line: flush, then cut it
+            if cur != reopen:
+                pages.append(cur.rstrip("\n") + ("\n```" if in_code else ""))
+                cur = reopen
+                continue
+            room = limit - 8 - len(cur)
+            head, line = line[:room], line[room:]
+            pages.append(cur + head + ("\n```" if in_code else ""))
+            cur = reopen
+        if len(cur) + len(line) + 1 > limit - 4:
+            pages.append(cur.rstrip("\n") + ("\n```" if in_code else ""))
+            cur = "```\n" if in_code else ""
+        cur += line + "\n"
+        if line.lstrip().startswith("```"):
+            in_code = not in_code
+    if cur.strip():
+        pages.append(cur.rstrip("\n"))
+    if any(len(p) > limit for p in pages):
+        # Shouldn't happen — but an oversized page is a failed send, so
+        # cut it blindly (Markdown and all) rather than lose the answer.
+        logger.warning(f"_md_pages: page over {limit} chars — hard-splitting it")
+        pages = [p[i:i + limit] for p in pages for i in range(0, len(p), limit)]
+    return pages or [""]
+
+
+class ProgressiveReply:
+    """Shows a streamed answer while it is being generated.
+
+    feed(engine, text) appends a chunk; the Telegram message is edited at
+    most every STREAM_EDIT_INTERVAL seconds, always from AsyncRuntime's io
+    pool — feed() is called on the event loop and must never block on
+    Telegram. A deferred render makes sure the last chunk before a pause
+    still shows. Past ~4000 chars it rolls
+    over into a new message. While streaming the text is sent without
+    parse_mode (half-written Markdown is invalid); finish(final) does the
+    real Markdown edit, falling back to plain text if Telegram rejects it.
+
+    With hedging, two engines can stream at once: the first to produce
+    text owns the display, and if it fails (drop) the next one takes over.
+
+    Two locks: _lock guards the buffers and flags and is only ever held
+    for a few lines (feed takes it on the loop); _render_lock serializes
+    the Telegram calls of renders and finish, and is only taken on the io
+    pool — never while holding _lock.
+    """
+
+    CURSOR = " ▌"
+
+    def __init__(self, chat_id, message_id=None, reply_to=None):
+        self.chat_id = chat_id
+        self.reply_to = reply_to
+        self.mids = [message_id] if message_id else []
+        self._shown = [None] * len(self.mids)
+        self._buffers = {}
+        self._owner = None
+        self._lock = threading.RLock()
+        self._render_lock = threading.Lock()   # mids / _shown belong to whoever holds it
+        self._last_edit = 0.0
+        self._pending = False
+        self._done = False
+        self.first_output_at = None
+
+    def has_output(self):
+        return self._owner is not None
+
+    def feed(self, engine, text):
+        with self._lock:
+            if self._done:
+                return
+            self._buffers[engine] = self._buffers.get(engine, "") + text
+            if self._owner is None:
+                self._owner = engine
+                self.first_output_at = time.monotonic()
+            if engine == self._owner:
+                self._schedule()
+
+    def drop(self, engine):
+        with self._lock:
+            self._buffers.pop(engine, None)
+            if self._owner == engine:
+                rest = [e for e, b in self._buffers.items() if b]
+                self._owner = max(rest, key=lambda e: len(self._buffers[e])) if rest else None
+                if self._owner:
+                    self._schedule()
+
+    def _schedule(self):
+        if not self._pending:
+            self._pending = True
+            AsyncRuntime.call_later(STREAM_EDIT_INTERVAL - (time.monotonic() - self._last_edit),
+                                    self._render_stream)
+
+    def _render_stream(self):
+        with self._render_lock:
+            with self._lock:
+                self._pending = False
+                if self._done or self._owner is None:
+                    return
+                self._last_edit = time.monotonic()
+                text = self._buffers[self._owner]
+            pages = _md_pages(text)
+            pages[-1] += self.CURSOR
+            self._show(pages, parse_mode=None)
+
+    def _show(self, pages, parse_mode):
+        for i, page in enumerate(pages):
+            if i < len(self.mids) and self._shown[i] == page:
+                continue
+            try:
+                if i < len(self.mids):
+                    try:
+                        bot.edit_message_text(page, self.chat_id, self.mids[i], parse_mode=parse_mode,
+                                              disable_web_page_preview=True)
+                    except Exception as e:
+                        if parse_mode is None or "not modified" in str(e):
+                            raise
+                        bot.edit_message_text(page, self.chat_id, self.mids[i],
+                                              disable_web_page_preview=True)
+                else:
+                    try:
+                        msg = bot.send_message(self.chat_id, page, parse_mode=parse_mode,
+                                               disable_web_page_preview=True,
+                                               reply_to_message_id=self.reply_to if not self.mids else None)
+                    except Exception:
+                        if parse_mode is None:
+                            raise
+                        msg = bot.send_message(self.chat_id, page, disable_web_page_preview=True)
+                    self.mids.append(msg.message_id)
+                    self._shown.append(None)
+                self._shown[i] = page
+            except Exception as e:
+                if "not modified" not in str(e):
+                    logger.warning(f"ProgressiveReply render error: {e}")
+
+    def finish(self, final_text):
+        """Final Markdown render of the complete answer (with whatever
+        header/footer the caller wraps it in). Extra pages left over from
+        the streamed draft are deleted."""
+        with self._lock:
+            self._done = True
+        with self._render_lock:
+            pages = _md_pages(final_text)
+            self._show(pages, parse_mode="Markdown")
+            for mid in self.mids[len(pages):]:
+                try:
+                    bot.delete_message(self.chat_id, mid)
+                except Exception:
+                    pass
+            del self.mids[len(pages):]
+            del self._shown[len(pages):]
+
+
 def animate(chat_id, frames=None, delay=0.55):
     """Send animated loading message. Returns message_id."""
     if not frames:
@@ -1686,6 +4611,25 @@ def animate(chat_id, frames=None, delay=0.55):
         return 0
 
 
+async def aanimate(chat_id, frames=None, delay=0.55):
+    """animate() for coroutines: the pauses between frames are
+    asyncio.sleep, so no thread is held while the animation plays."""
+    if not frames:
+        frames = LOADING_FRAMES
+    try:
+        msg = await AsyncRuntime.io(bot.send_message, chat_id, frames[0])
+        for f in frames[1:]:
+            await asyncio.sleep(delay)
+            try:
+                await AsyncRuntime.io(bot.edit_message_text, f, chat_id, msg.message_id)
+            except Exception:
+                pass
+        return msg.message_id
+    except Exception as e:
+        logger.error(f"Animate error: {e}")
+        return 0
+
+
 def typing(chat_id):
     try:
         bot.send_chat_action(chat_id, "typing")
@@ -1912,7 +4856,7 @@ def cmd_help(m):
         f"• `/models` — Kaunsa Groq model kahan use ho raha hai\n"
         f"• `/clear` — Memory clear\n"
         f"• `/history` — Chat history\n"
-        f"• `/export` — History download\n"
+        f"• `/export [md|jsonl] [gz] [from] [to]` — History download\n"
         f"• `/profile` — Apni profile\n"
         f"• `/engine` — AI engine change\n"
         f"• `/mode` — Mode change\n"
@@ -1983,16 +4927,20 @@ def cmd_profile(m):
 
 
 @bot.message_handler(commands=["search"])
+@offload("job")
 def cmd_search(m):
     uid   = m.from_user.id
     db.sync_user(uid, m.from_user.first_name, m.from_user.username or "")
-    query = " ".join(m.text.split()[1:]).strip()
+    words = m.text.split()[1:]
+    fresh = "--fresh" in words          # skip the cached answer
+    query = " ".join(w for w in words if w != "--fresh").strip()
     if not query:
-        bot.send_message(m.chat.id, "🔍 Usage: `/search Python kya hai`", parse_mode="Markdown")
+        bot.send_message(m.chat.id, "🔍 Usage: `/search Python kya hai`\n"
+                         "_Naye results ke liye:_ `/search --fresh Python kya hai`", parse_mode="Markdown")
         return
     typing(m.chat.id)
     mid = animate(m.chat.id, SEARCH_FRAMES)
-    ans, results = WebSearchEngine.search_and_summarize(uid, query)
+    ans, results = WebSearchEngine.search_and_summarize(uid, query, fresh=fresh)
     sources = ""
     if results:
         sources = "\n\n📎 *Sources:*\n" + "\n".join(
@@ -2023,6 +4971,7 @@ def cmd_image(m):
     _do_image_generation(uid, m.chat.id, prompt, m.from_user.first_name)
 
 
+@offload("job")
 def _do_image_generation(uid, chat_id, prompt, user_name="User"):
     mid = animate(chat_id, IMAGE_FRAMES, delay=0.7)
     upload_photo_action(chat_id)
@@ -2091,6 +5040,7 @@ _pending_word = {}
 _awaiting_signal = set()   # uids who just ran /signal and whose NEXT photo should be treated as a chart
 
 
+@offload("job")
 def _do_pdf(uid, chat_id, topic, theme, author=""):
     mid = animate(chat_id, PDF_FRAMES, delay=0.8)
     upload_doc_action(chat_id)
@@ -2135,6 +5085,7 @@ def cmd_zip(m):
     _do_zip_project(uid, m.chat.id, desc)
 
 
+@offload("job")
 def _do_zip_project(uid, chat_id, description):
     mid = animate(chat_id, BUILD_FRAMES, delay=0.8)
     upload_doc_action(chat_id)
@@ -2179,6 +5130,7 @@ def cmd_word(m):
     _do_word_doc(uid, m.chat.id, topic, m.from_user.first_name)
 
 
+@offload("job")
 def _do_word_doc(uid, chat_id, topic, author=""):
     mid = animate(chat_id, PDF_FRAMES, delay=0.8)
     upload_doc_action(chat_id)
@@ -2211,6 +5163,7 @@ def _do_word_doc(uid, chat_id, topic, author=""):
 
 
 @bot.message_handler(commands=["code"])
+@offload("job")
 def cmd_code(m):
     uid  = m.from_user.id
     db.sync_user(uid, m.from_user.first_name, m.from_user.username or "")
@@ -2285,25 +5238,13 @@ def cmd_history(m):
 
 @bot.message_handler(commands=["export"])
 def cmd_export(m):
+    """/export [txt|jsonl|md] [gz] [from YYYY-MM-DD] [to YYYY-MM-DD]"""
     uid = m.from_user.id
-    upload_doc_action(m.chat.id)
-    content = db.export_history(uid)
-    fname = f"history_{uid}.txt"
-    with open(fname, 'w', encoding='utf-8') as f:
-        f.write(f"{BOT_NAME} — Chat History Export\n")
-        f.write(f"User: {m.from_user.first_name} | UID: {uid}\n")
-        f.write(f"Exported: {datetime.now()}\n")
-        f.write("═" * 50 + "\n\n")
-        f.write(content)
+    fmt, compress, since, until = HistoryExporter.parse_args(m.text.split()[1:])
     try:
-        with open(fname, 'rb') as f:
-            bot.send_document(m.chat.id, f, caption="📜 *Your Full Chat History*",
-                              parse_mode="Markdown")
+        send_history_export(m.chat.id, uid, m.from_user.first_name, fmt, since, until, compress)
     except Exception as e:
         bot.send_message(m.chat.id, f"❌ Export Error: {e}")
-    finally:
-        if os.path.exists(fname):
-            os.remove(fname)
 
 
 @bot.message_handler(commands=["engine"])
@@ -2351,7 +5292,8 @@ def cmd_models(m):
         "preview model, needs terms accepted once)_\n\n"
         "🌐 *Fallback (if Groq is down):* Gemini 1.5 Flash → OpenRouter\n\n"
         "Run `/testgroq` to verify each model is actually reachable with "
-        "your current `GROQ_API_KEY`."
+        "your current `GROQ_API_KEY`.\n\n"
+        "🩺 *Provider health (live):*\n" + ProviderHealth.report()
     )
     bot.send_message(m.chat.id, text, parse_mode="Markdown")
 
@@ -2457,6 +5399,7 @@ def admin_only(func):
 @admin_only
 def cmd_admin(m):
     stats = db.get_stats()
+    uc    = db.user_cache.stats()
     bot.send_message(m.chat.id,
         f"🛡️ *ADMIN PANEL — MI TITAN V22*\n\n"
         f"👥 Users: `{stats['total_users']}`\n"
@@ -2464,12 +5407,17 @@ def cmd_admin(m):
         f"📡 Chats: `{stats['total_chats']}`\n"
         f"🔢 Queries: `{stats['total_queries']}`\n"
         f"🚫 Banned: `{stats['banned']}`\n"
-        f"⏱️ Uptime: `{uptime()}`\n\n"
+        f"⏱️ Uptime: `{uptime()}`\n"
+        f"🗃️ User cache: `{uc['hit_rate']:.0%}` hit "
+        f"(`{uc['hits']}`/`{uc['hits'] + uc['misses']}`, `{uc['size']}` rows)\n\n"
         f"*Commands:*\n"
         f"• `/broadcast [msg]` — All users ko message\n"
         f"• `/ban [uid] [reason]` — User ban karo\n"
         f"• `/unban [uid]` — User unban karo\n"
         f"• `/users` — User list\n"
+        f"• `/analytics [24h|7d] [event] [daily]` — Event counts\n"
+        f"• `/health [reset]` — AI provider circuit breakers\n"
+        f"• `/cache [clear]` — AI response cache hit rates\n"
         f"• `/setadmin [uid]` — Admin banao",
         parse_mode="Markdown")
 
@@ -2535,14 +5483,89 @@ def cmd_unban(m):
 @bot.message_handler(commands=["users"])
 @admin_only
 def cmd_users(m):
-    db.c.execute("SELECT uid,name,username,total_queries,last_seen FROM users ORDER BY total_queries DESC LIMIT 20")
-    rows = db.c.fetchall()
+    rows = db.top_users(20)
     text = "👥 *TOP 20 USERS:*\n\n"
     for i, r in enumerate(rows, 1):
         text += f"{i}. `{r['uid']}` — {r['name']} (@{r['username']}) | Queries: {r['total_queries']}\n"
     bot.send_message(m.chat.id, text, parse_mode="Markdown")
 
 
+@bot.message_handler(commands=["analytics"])
+@admin_only
+def cmd_analytics(m):
+    """/analytics                       -> every event, last 24h
+       /analytics 24h ai_query          -> queries per engine
+       /analytics 30d trading_signal daily -> signals per day"""
+    hours, event, daily = 24, None, False
+    for arg in m.text.split()[1:]:
+        a = arg.lower()
+        if a == "daily":
+            daily = True
+        elif re.fullmatch(r"\d+[hd]?", a):
+            hours = int(a.rstrip("hd")) * (24 if a.endswith("d") else 1)
+        else:
+            event = arg
+    t0   = time.perf_counter()
+    rows = db.analytics_rollup(hours, event, daily)
+    ms   = (time.perf_counter() - t0) * 1000
+    span = f"{hours // 24}d" if hours % 24 == 0 else f"{hours}h"
+    head = (f"📊 *ANALYTICS* — `{event or 'all events'}`, last {span}"
+            f"{', per day' if daily else ''}\n\n")
+    if not rows:
+        bot.send_message(m.chat.id, head + "_Koi data nahi._", parse_mode="Markdown")
+        return
+    total = sum(n for _, n in rows)
+    body  = "".join(f"• `{k or '—'}`: *{n}*\n" for k, n in rows[:40])
+    bot.send_message(m.chat.id,
+        head + body + f"\nTotal: *{total}* · _{ms:.1f} ms_",
+        parse_mode="Markdown")
+
+
+@bot.message_handler(commands=["health"])
+@admin_only
+def cmd_health(m):
+    if "reset" in m.text.lower():
+        ProviderHealth.reset()
+        bot.send_message(m.chat.id, "♻️ Saare provider circuits reset (closed) ho gaye.")
+        return
+    bot.send_message(m.chat.id,
+        "🩺 *AI PROVIDER HEALTH*\n"
+        "_EWMA latency · error rate · circuit state_\n\n" + ProviderHealth.report(detailed=True)
+        + "\n\n📊 *QUOTA* _(requests · tokens left this minute)_\n" + ProviderLimiter.report()
+        + "\n\n🚦 *LOAD*\n" + LoadGovernor.report() + "\n" + ComplexityRouter.report()
+        + "\n\n💬 *GROUP CHATTER*\n" + GroupChatter.report(),
+        parse_mode="Markdown")
+
+
+@bot.message_handler(commands=["cache"])
+@admin_only
+def cmd_cache(m):
+    if "clear" in m.text.lower():
+        response_cache.clear()
+        bot.send_message(m.chat.id, "🧹 Response cache khali kar diya.")
+        return
+    st = response_cache.stats()
+    if not st["enabled"]:
+        bot.send_message(m.chat.id, "💤 Response cache band hai (`TITAN_RESPONSE_CACHE=0`).", parse_mode="Markdown")
+        return
+    lines = []
+    for site, c in sorted(st["sites"].items()):
+        total = c["mem"] + c["disk"] + c["miss"]
+        rate = (c["mem"] + c["disk"]) / total * 100 if total else 0.0
+        lines.append(f"• `{site}` — hit {rate:.0f}% (mem {c['mem']}, disk {c['disk']}, "
+                     f"miss {c['miss']}, bypass {c['bypass']})")
+    bot.send_message(m.chat.id,
+        "🗃️ *RESPONSE CACHE*\n━━━━━━━━━━━━━━\n"
+        f"🧠 Memory: {st['mem']['size']} items · {st['mem']['bytes'] / 1048576:.1f} MB · "
+        f"{st['mem']['evictions']} evicted\n"
+        f"💾 Disk: {st['disk_rows']} items · {st['disk_bytes'] / 1048576:.1f} MB\n\n"
+        + ("\n".join(lines) or "_Abhi tak koi lookup nahi._")
+        + "\n\n🔗 *Coalesced* _(duplicate calls that waited on an identical one)_\n"
+        + "\n".join(f"• `{name}` — {c['deduped']} shared / {c['leaders']} made"
+                    for name, c in SingleFlight.stats().items()),
+        parse_mode="Markdown")
+
+
 @bot.message_handler(commands=["setadmin"])
 @admin_only
 def cmd_setadmin(m):
@@ -2617,11 +5640,7 @@ def on_callback(c):
                 bot.answer_callback_query(c.id, "Pehle topic do!")
                 return
             bot.edit_message_text(f"📄 Creating PDF...\nTheme: *{theme}*", cid, mid, parse_mode="Markdown")
-            threading.Thread(
-                target=_do_pdf,
-                args=(uid, cid, info["topic"], theme, info.get("author","")),
-                daemon=True
-            ).start()
+            _do_pdf(uid, cid, info["topic"], theme, info.get("author",""))
             _pending_pdf.pop(uid, None)
 
         # ── ZIP Project ─────────────────────────────────────────────────────
@@ -2630,20 +5649,15 @@ def on_callback(c):
             msg = bot.send_message(cid,
                 "📦 *Web project describe karein:*\n_Example: portfolio website for a photographer_",
                 parse_mode="Markdown", reply_markup=back_kb())
-            bot.register_next_step_handler(msg, lambda m: (
-                threading.Thread(target=_do_zip_project, args=(uid, cid, m.text or ""), daemon=True).start()
-            ))
+            bot.register_next_step_handler(msg, lambda m: _do_zip_project(uid, cid, m.text or ""))
 
         # ── Word Document ───────────────────────────────────────────────────
         elif d == "do_word":
             bot.answer_callback_query(c.id)
             msg = bot.send_message(cid, "📝 *Word doc topic likhein:*",
                                    parse_mode="Markdown", reply_markup=back_kb())
-            bot.register_next_step_handler(msg, lambda m: (
-                threading.Thread(target=_do_word_doc,
-                                 args=(uid, cid, m.text or "", c.from_user.first_name),
-                                 daemon=True).start()
-            ))
+            bot.register_next_step_handler(msg, lambda m: _do_word_doc(uid, cid, m.text or "",
+                                                                       c.from_user.first_name))
 
         # ── Engines ────────────────────────────────────────────────────────
         elif d == "menu_engines":
@@ -2733,17 +5747,7 @@ def on_callback(c):
         # ── Export History ──────────────────────────────────────────────────
         elif d == "export_history":
             bot.answer_callback_query(c.id, "📜 Exporting...")
-            content = db.export_history(uid)
-            fname   = f"history_{uid}.txt"
-            with open(fname, 'w', encoding='utf-8') as f:
-                f.write(content)
-            try:
-                with open(fname, 'rb') as f:
-                    bot.send_document(cid, f, caption="📜 *Your Chat History*",
-                                      parse_mode="Markdown")
-            finally:
-                if os.path.exists(fname):
-                    os.remove(fname)
+            send_history_export(cid, uid, c.from_user.first_name)
 
         # ── Profile ─────────────────────────────────────────────────────────
         elif d == "my_profile":
@@ -2812,6 +5816,7 @@ def _pdf_topic_received(uid, chat_id, topic, author):
         parse_mode="Markdown", reply_markup=pdf_theme_kb())
 
 
+@offload("job")
 def _search_flow(uid, chat_id, query):
     if not query.strip():
         return
@@ -2840,6 +5845,7 @@ def _search_flow(uid, chat_id, query):
 # ══════════════════════════════════════════════════════════════════════════════════
 
 @bot.message_handler(content_types=["voice"])
+@offload("job")
 def handle_voice(m):
     """Transcribe voice notes via Groq Whisper."""
     uid = m.from_user.id if m.from_user else 0
@@ -2849,7 +5855,7 @@ def handle_voice(m):
     try:
         fi   = bot.get_file(m.voice.file_id)
         data = bot.download_file(fi.file_path)
-        text = NeuralEngine.call_groq_whisper(data, "voice.ogg")
+        text = NeuralEngine.quota_call("groq", partial(NeuralEngine.call_groq_whisper, data, "voice.ogg"))
         if not text:
             bot.edit_message_text("❌ Transcription failed.", m.chat.id, mid)
             return
@@ -2894,6 +5900,7 @@ def _looks_like_chart_request(uid, caption):
 
 
 @bot.message_handler(content_types=["photo"])
+@offload("job")
 def handle_photo(m):
     """Routes an incoming photo to either the Trading Signal Engine
     (if the user just ran /signal or their caption mentions trading/chart
@@ -2915,13 +5922,14 @@ def handle_photo(m):
         fi   = bot.get_file(m.photo[-1].file_id)
         data = bot.download_file(fi.file_path)
         system = NeuralEngine.build_system("chat")
-        engine_label = "Groq Qwen3.6 Vision ⚡"
-        try:
-            ans = NeuralEngine.call_groq_vision(data, caption, system)
-        except Exception as e:
-            logger.warning(f"Groq vision failed, falling back to Gemini: {e}")
-            ans = NeuralEngine.call_gemini_vision(data, "image/jpeg", caption, system)
-            engine_label = "Gemini Vision 💎"
+        ans, engine_label, errors = NeuralEngine.first_healthy({
+            "groq_vision": ("Groq Qwen3.6 Vision ⚡",
+                            lambda: NeuralEngine.call_groq_vision(data, caption, system)),
+            "gemini_vision": ("Gemini Vision 💎",
+                              lambda: NeuralEngine.call_gemini_vision(data, "image/jpeg", caption, system)),
+        }, prefer_fastest=True)
+        if ans is None:
+            raise RuntimeError(f"vision providers failed: {errors}")
         full_text = f"👁️ *IMAGE ANALYSIS*\n\n{ans}\n\n⚡ _{engine_label}_"
 
         if _voice_is_on(uid):
@@ -3011,6 +6019,7 @@ def _handle_chart_signal_photo(m, uid, caption):
 
 
 @bot.message_handler(content_types=["document"])
+@offload("job")
 def handle_document(m):
     """Handle document uploads — analyze filename/caption."""
     uid = m.from_user.id if m.from_user else 0
@@ -3065,161 +6074,285 @@ def handle_text(m):
         return
 
     # ── GROUP / SUPERGROUP ────────────────────────────────────────────────────
+    # The AI part of both replies runs as a coroutine on AsyncRuntime, so
+    # this TeleBot worker is free again as soon as the checks above pass.
     if chat_type in ["group", "supergroup"]:
-        speaker = m.from_user.first_name if m.from_user else "Someone"
-        try:
-            if _BOT_ME["id"] is None:
-                binfo = bot.get_me()
-                _BOT_ME["id"] = binfo.id
-                _BOT_ME["username"] = (binfo.username or "").lower()
-            bot_username = _BOT_ME["username"]
-            is_reply     = (
-                m.reply_to_message and m.reply_to_message.from_user
-                and m.reply_to_message.from_user.id == _BOT_ME["id"]
-            )
-            is_mention   = (
-                bot_username in text.lower() or
-                "mi ai" in text.lower() or
-                "titan" in text.lower()
-            )
-            if is_reply or is_mention:
-                typing(chat_id)
-                clean_text = re.sub(r'@\S+', '', text).strip()
-                ans, node  = NeuralEngine.get_response(
-                    uid, clean_text,
-                    custom_role=(
-                        "Tum ek helpful Telegram GROUP assistant ho. Roman Urdu+English mein jawab do. "
-                        "Group ki purani baat-cheet neeche di gayi hai (har line 'Naam: message' format mein) — "
-                        "isay context ki tarah use karo taake pata rahe kis ne kya kaha tha."
-                    ),
-                    chat_id=chat_id, author=speaker,
-                )
-                if _voice_is_on(uid):
-                    voice_sent = _maybe_send_voice(chat_id, uid, ans)
-                    if voice_sent:
-                        preview = ans.strip()
-                        if len(preview) > 200:
-                            preview = preview[:200].rsplit(" ", 1)[0] + "..."
-                        bot.send_message(chat_id, f"🎙️ _{preview}_\n\n⚡ _{node}_",
-                                          parse_mode="Markdown", reply_to_message_id=m.message_id)
-                    else:
-                        _send_chunks(chat_id, f"🤖 {ans}\n\n━━━━━━━━━━━━\n⚡ _{node}_", reply_to=m.message_id)
-                else:
-                    _send_chunks(chat_id,
-                        f"🤖 {ans}\n\n━━━━━━━━━━━━\n⚡ _{node}_",
-                        reply_to=m.message_id)
-            else:
-                # Record the user's message into shared group memory even
-                # when the bot isn't directly addressed, so context isn't
-                # lost — then give a short witty reply for flavor, and
-                # record THAT too (previously only the user's line was
-                # saved, so the bot's own replies vanished from context
-                # and later `/`-mention questions couldn't see them).
-                db.add_group_memory(chat_id, "user", text, author=speaker)
-                sys = "1-2 line ka friendly Roman Urdu/English reply do. Koi lamba jawab nahi."
-                ans, _ = NeuralEngine.get_response(
-                    uid, text, custom_role=sys, use_history=False, fast=True
-                )
-                try:
-                    bot.reply_to(m, ans)
-                    db.add_group_memory(chat_id, "assistant", ans, engine="groq-fast")
-                except Exception:
-                    pass
-        except Exception as e:
-            logger.error(f"Group error: {e}")
+        AsyncRuntime.spawn(_group_reply(m, uid, chat_id, text))
         return
 
     # ── PRIVATE CHAT ──────────────────────────────────────────────────────────
     if chat_type == "private":
-        u    = db.get_user(uid)
-        mode = u.get("mode", "chat")
-        typing(chat_id)
+        AsyncRuntime.spawn(_private_reply(m, uid, chat_id, text))
+
+
+class GroupChatter:
+    """Debounced, batched replies to group messages that don't address
+    the bot (see GROUP CHATTER config). All state lives on the event loop,
+    so no locks: add() is called from _group_reply, windows are tasks.
 
-        mid = animate(chat_id, random.sample(LOADING_FRAMES, min(5, len(LOADING_FRAMES))), delay=0.45)
-        ans = ""
+    One window = one bulk group_memory write + at most one LLM call and
+    one Telegram message, however many people were talking.
+    """
+
+    SYSTEM = (
+        "Tum ek Telegram group mein ho. Neeche group ke taaza messages hain ('Naam: message'). "
+        "Poori baat-cheet par sirf EK 1-2 line ka friendly Roman Urdu/English reply do — "
+        "har message ka alag jawab nahi. Koi lamba jawab nahi."
+    )
+
+    _pending = {}   # chat_id -> [{uid, speaker, text, message, at}]
+    _windows = {}   # chat_id -> asyncio.Task
+    # chat_id -> TokenBucket (replies per minute). A bucket idle for a
+    # minute is full again, so dropping it after two loses nothing.
+    _budgets = TTLCache(10000, 120)
+    messages = windows = replies = over_budget = 0
+
+    @classmethod
+    def add(cls, chat_id, uid, speaker, text, message):
+        cls.messages += 1
+        cls._pending.setdefault(chat_id, []).append(
+            {"uid": uid, "speaker": speaker, "text": text, "message": message, "at": time.monotonic()})
+        if chat_id not in cls._windows:
+            task = asyncio.ensure_future(cls._window(chat_id))
+            task.add_done_callback(AsyncRuntime._log_failure)
+            cls._windows[chat_id] = task
+
+    @classmethod
+    async def absorb(cls, chat_id):
+        """The bot is being addressed in this group: store the pending
+        messages now (so the reply sees them in history) and close the
+        window without a chatter reply of its own."""
+        task = cls._windows.pop(chat_id, None)
+        if task is not None:
+            task.cancel()
+        await AsyncRuntime.io(cls._store, chat_id, cls._pending.pop(chat_id, []))
 
+    @classmethod
+    def _store(cls, chat_id, batch):
+        if batch:
+            db.add_group_memories(chat_id, [("user", p["text"], p["speaker"], "") for p in batch])
+            ConversationSummarizer.touch("group", chat_id)
+
+    @classmethod
+    async def _window(cls, chat_id):
+        opened = time.monotonic()
+        while True:
+            due = min(cls._pending[chat_id][-1]["at"] + CHATTER_DEBOUNCE_SECONDS,
+                      opened + CHATTER_MAX_WAIT_SECONDS)
+            if due <= time.monotonic():
+                break
+            await asyncio.sleep(due - time.monotonic())
+        cls._windows.pop(chat_id, None)
+        batch = cls._pending.pop(chat_id, [])
+        cls.windows += 1
+        await AsyncRuntime.io(cls._store, chat_id, batch)
+        await cls._reply(chat_id, batch)
+
+    @classmethod
+    async def _reply(cls, chat_id, batch):
+        if LoadGovernor.sheds("chatter"):
+            return
+        bucket = cls._budgets.get(chat_id) or TokenBucket(CHATTER_PER_MINUTE)
+        cls._budgets.set(chat_id, bucket)
+        if CHATTER_PER_MINUTE <= 0 or not bucket.fits(1):
+            cls.over_budget += 1
+            return
+        bucket.take(1)
+        last = batch[-1]
+        transcript = "\n".join(f"{p['speaker']}: {ContextBuilder.truncate(p['text'], 150)}"
+                               for p in batch[-CHATTER_BATCH_LINES:])
+        ans, node = await NeuralEngine.aget_response(
+            last["uid"], transcript, custom_role=cls.SYSTEM,
+            use_history=False, fast=True, cache_site="chatter", persist=False)
+        if node == "Error ❌":
+            return      # shed or all engines down — an unprompted quip isn't worth an error
         try:
-            if mode == "search":
-                ans, results = WebSearchEngine.search_and_summarize(uid, text)
-                sources = ""
-                if results:
-                    sources = "\n\n📎 *Sources:*\n" + "\n".join(
-                        [f"🔗 [{r.get('title','')[:40]}...]({r.get('href','')})" for r in results]
-                    )
-                final = f"🌐 *WEB SEARCH*\n━━━━━━━━━━━━━━\n\n{ans}{sources}"
-
-            elif mode == "study":
-                ans, node = NeuralEngine.get_response(uid, text,
-                    custom_role="Expert teacher. Detail mein Roman Urdu+English mein headings aur examples ke saath samjhao.")
-                final = f"📚 *STUDY ASSISTANT*\n━━━━━━━━━━━━━━\n\n{ans}\n\n━━━━━━━━━━━━\n⚡ _{node}_"
-
-            elif mode == "code":
-                ans, node = NeuralEngine.get_response(uid, text,
-                    custom_role="Expert programmer. Code blocks use karo. Comments shamil karo.")
-                final = f"💻 *CODE EXPERT*\n━━━━━━━━━━━━━━\n\n{ans}\n\n━━━━━━━━━━━━\n⚡ _{node}_"
-
-            elif mode == "creative":
-                ans, node = NeuralEngine.get_response(uid, text,
-                    custom_role="Creative poet/writer. Poetic, imaginative Roman Urdu mein jawab do.")
-                final = f"🎨 *CREATIVE MODE*\n━━━━━━━━━━━━━━\n\n{ans}\n\n━━━━━━━━━━━━\n⚡ _{node}_"
-
-            elif mode == "build":
-                ans, node = NeuralEngine.get_response(uid, text,
-                    custom_role="Expert full-stack developer. Complete code do. Production-ready.")
-                final = f"🏗️ *BUILD MODE*\n━━━━━━━━━━━━━━\n\n{ans}\n\n━━━━━━━━━━━━\n⚡ _{node}_"
-
-            elif mode == "doctor":
-                ans, node = NeuralEngine.get_response(uid, text,
-                    custom_role="Medical info assistant. Helpful medical info do. Always advise to see a real doctor.")
-                final = f"🏥 *MEDICAL INFO*\n━━━━━━━━━━━━━━\n\n{ans}\n\n⚠️ _Kisi asli doctor se zaroor milein!_\n⚡ _{node}_"
-
-            elif mode == "legal":
-                ans, node = NeuralEngine.get_response(uid, text,
-                    custom_role="Legal info assistant. Helpful info do. Always advise real lawyer.")
-                final = f"⚖️ *LEGAL INFO*\n━━━━━━━━━━━━━━\n\n{ans}\n\n⚠️ _Asli lawyer se zaroor milein!_\n⚡ _{node}_"
-
-            elif mode == "finance":
-                ans, node = NeuralEngine.get_response(uid, text,
-                    custom_role="Financial info assistant. Helpful info do. Always advise real expert.")
-                final = f"💰 *FINANCE INFO*\n━━━━━━━━━━━━━━\n\n{ans}\n\n⚠️ _Asli financial advisor se milein!_\n⚡ _{node}_"
+            await AsyncRuntime.io(bot.reply_to, last["message"], ans)
+        except Exception:
+            return
+        await AsyncRuntime.io(db.add_group_memory, chat_id, "assistant", ans, engine=node)
+        cls.replies += 1
 
-            else:
-                ans, node = NeuralEngine.get_response(uid, text)
-                final = (
-                    f"{ans}\n\n"
-                    f"━━━━━━━━━━━━━━\n"
-                    f"🧠 *Node:* _{node}_  |  🏢 _{ORG_NAME}_"
-                )
+    @classmethod
+    def report(cls):
+        return (f"{cls.messages} msgs → {cls.windows} windows → {cls.replies} replies "
+                f"({cls.over_budget} over budget, {len(cls._windows)} open)")
 
-            try:
-                bot.delete_message(chat_id, mid)
-            except Exception:
-                pass
 
-            if _voice_is_on(uid):
-                voice_sent = _maybe_send_voice(chat_id, uid, ans)
+async def _group_reply(m, uid, chat_id, text):
+    speaker = m.from_user.first_name if m.from_user else "Someone"
+    try:
+        if _BOT_ME["id"] is None:
+            binfo = await AsyncRuntime.io(bot.get_me)
+            _BOT_ME["id"] = binfo.id
+            _BOT_ME["username"] = (binfo.username or "").lower()
+        bot_username = _BOT_ME["username"]
+        is_reply     = (
+            m.reply_to_message and m.reply_to_message.from_user
+            and m.reply_to_message.from_user.id == _BOT_ME["id"]
+        )
+        is_mention   = (
+            bot_username in text.lower() or
+            "mi ai" in text.lower() or
+            "titan" in text.lower()
+        )
+        if is_reply or is_mention:
+            await GroupChatter.absorb(chat_id)
+            await AsyncRuntime.io(typing, chat_id)
+            clean_text = re.sub(r'@\S+', '', text).strip()
+            ans, node  = await NeuralEngine.aget_response(
+                uid, clean_text,
+                custom_role=(
+                    "Tum ek helpful Telegram GROUP assistant ho. Roman Urdu+English mein jawab do. "
+                    "Group ki purani baat-cheet neeche di gayi hai (har line 'Naam: message' format mein) — "
+                    "isay context ki tarah use karo taake pata rahe kis ne kya kaha tha."
+                ),
+                chat_id=chat_id, author=speaker,
+            )
+            notice = LoadGovernor.notice_for(uid)
+            footer = f"⚡ _{node}_" + (f"\n{notice}" if notice else "")
+            if await AsyncRuntime.io(_voice_is_on, uid):
+                voice_sent = await AsyncRuntime.job(_maybe_send_voice, chat_id, uid, ans)
                 if voice_sent:
-                    # Voice already carries the answer — just send a short
-                    # text preview instead of the full response, so people
-                    # don't get the same thing twice.
                     preview = ans.strip()
                     if len(preview) > 200:
                         preview = preview[:200].rsplit(" ", 1)[0] + "..."
-                    bot.send_message(chat_id, f"🎙️ _{preview}_\n\n⚡ _{node}_", parse_mode="Markdown")
+                    await AsyncRuntime.io(bot.send_message, chat_id, f"🎙️ _{preview}_\n\n{footer}",
+                                          parse_mode="Markdown", reply_to_message_id=m.message_id)
                 else:
-                    # Voice failed — fall back to the full text so the
-                    # user isn't left with nothing.
-                    _send_chunks(chat_id, final)
+                    await AsyncRuntime.io(_send_chunks, chat_id, f"🤖 {ans}\n\n━━━━━━━━━━━━\n{footer}",
+                                          reply_to=m.message_id)
             else:
-                _send_chunks(chat_id, final)
+                await AsyncRuntime.io(_send_chunks, chat_id,
+                    f"🤖 {ans}\n\n━━━━━━━━━━━━\n{footer}",
+                    reply_to=m.message_id)
+        else:
+            # Not addressed: the message is recorded into shared group
+            # memory (so later mentions have the context) and may get a
+            # short reply for flavor — both batched per group by
+            # GroupChatter, so a busy group costs one LLM call and one
+            # message per burst of conversation, not one per message.
+            GroupChatter.add(chat_id, uid, speaker, text, m)
+    except Exception as e:
+        logger.error(f"Group error: {e}")
 
+
+async def _private_reply(m, uid, chat_id, text):
+    u    = await AsyncRuntime.io(db.get_user, uid)
+    mode = u.get("mode", "chat")
+    await AsyncRuntime.io(typing, chat_id)
+
+    # Streamed replies: one placeholder message that the answer is
+    # written into as it arrives (no loading animation — the first
+    # tokens usually beat it). Web search and voice replies keep the
+    # old animate-then-send flow.
+    stream = None
+    if STREAM_REPLIES and mode != "search" and not u.get("voice_reply", 0):
+        try:
+            mid = (await AsyncRuntime.io(bot.send_message, chat_id, "🧠 ...")).message_id
+            stream = ProgressiveReply(chat_id, mid)
         except Exception as e:
-            logger.error(f"Private handler error: {e}")
-            try:
-                bot.edit_message_text(f"❌ Error: {e}", chat_id, mid)
-            except Exception:
-                pass
+            logger.warning(f"Stream placeholder failed: {e}")
+    anim = None
+    if stream is None:
+        # The animation plays while the answer is being fetched.
+        anim = asyncio.ensure_future(
+            aanimate(chat_id, random.sample(LOADING_FRAMES, min(5, len(LOADING_FRAMES))), delay=0.45))
+    ans = ""
+
+    try:
+        if mode == "search":
+            ans, results = await AsyncRuntime.job(WebSearchEngine.search_and_summarize, uid, text)
+            sources = ""
+            if results:
+                sources = "\n\n📎 *Sources:*\n" + "\n".join(
+                    [f"🔗 [{r.get('title','')[:40]}...]({r.get('href','')})" for r in results]
+                )
+            final = f"🌐 *WEB SEARCH*\n━━━━━━━━━━━━━━\n\n{ans}{sources}"
+
+        elif mode == "study":
+            ans, node = await NeuralEngine.aget_response(uid, text, stream=stream,
+                custom_role="Expert teacher. Detail mein Roman Urdu+English mein headings aur examples ke saath samjhao.")
+            final = f"📚 *STUDY ASSISTANT*\n━━━━━━━━━━━━━━\n\n{ans}\n\n━━━━━━━━━━━━\n⚡ _{node}_"
+
+        elif mode == "code":
+            ans, node = await NeuralEngine.aget_response(uid, text, stream=stream,
+                custom_role="Expert programmer. Code blocks use karo. Comments shamil karo.")
+            final = f"💻 *CODE EXPERT*\n━━━━━━━━━━━━━━\n\n{ans}\n\n━━━━━━━━━━━━\n⚡ _{node}_"
+
+        elif mode == "creative":
+            ans, node = await NeuralEngine.aget_response(uid, text, stream=stream,
+                custom_role="Creative poet/writer. Poetic, imaginative Roman Urdu mein jawab do.")
+            final = f"🎨 *CREATIVE MODE*\n━━━━━━━━━━━━━━\n\n{ans}\n\n━━━━━━━━━━━━\n⚡ _{node}_"
+
+        elif mode == "build":
+            ans, node = await NeuralEngine.aget_response(uid, text, stream=stream,
+                custom_role="Expert full-stack developer. Complete code do. Production-ready.")
+            final = f"🏗️ *BUILD MODE*\n━━━━━━━━━━━━━━\n\n{ans}\n\n━━━━━━━━━━━━\n⚡ _{node}_"
+
+        elif mode == "doctor":
+            ans, node = await NeuralEngine.aget_response(uid, text, stream=stream,
+                custom_role="Medical info assistant. Helpful medical info do. Always advise to see a real doctor.")
+            final = f"🏥 *MEDICAL INFO*\n━━━━━━━━━━━━━━\n\n{ans}\n\n⚠️ _Kisi asli doctor se zaroor milein!_\n⚡ _{node}_"
+
+        elif mode == "legal":
+            ans, node = await NeuralEngine.aget_response(uid, text, stream=stream,
+                custom_role="Legal info assistant. Helpful info do. Always advise real lawyer.")
+            final = f"⚖️ *LEGAL INFO*\n━━━━━━━━━━━━━━\n\n{ans}\n\n⚠️ _Asli lawyer se zaroor milein!_\n⚡ _{node}_"
+
+        elif mode == "finance":
+            ans, node = await NeuralEngine.aget_response(uid, text, stream=stream,
+                custom_role="Financial info assistant. Helpful info do. Always advise real expert.")
+            final = f"💰 *FINANCE INFO*\n━━━━━━━━━━━━━━\n\n{ans}\n\n⚠️ _Asli financial advisor se milein!_\n⚡ _{node}_"
+
+        else:
+            ans, node = await NeuralEngine.aget_response(uid, text, stream=stream)
+            final = (
+                f"{ans}\n\n"
+                f"━━━━━━━━━━━━━━\n"
+                f"🧠 *Node:* _{node}_  |  🏢 _{ORG_NAME}_"
+            )
+
+        notice = LoadGovernor.notice_for(uid)
+        if notice:
+            final = f"{final}\n\n{notice}"
+
+        if stream is not None:
+            await AsyncRuntime.io(stream.finish, final)
+            return
 
+        mid = await anim
+        try:
+            await AsyncRuntime.io(bot.delete_message, chat_id, mid)
+        except Exception:
+            pass
+
+        if await AsyncRuntime.io(_voice_is_on, uid):
+            voice_sent = await AsyncRuntime.job(_maybe_send_voice, chat_id, uid, ans)
+            if voice_sent:
+                # Voice already carries the answer — just send a short
+                # text preview instead of the full response, so people
+                # don't get the same thing twice.
+                preview = ans.strip()
+                if len(preview) > 200:
+                    preview = preview[:200].rsplit(" ", 1)[0] + "..."
+                await AsyncRuntime.io(bot.send_message, chat_id, f"🎙️ _{preview}_\n\n⚡ _{node}_",
+                                      parse_mode="Markdown")
+            else:
+                # Voice failed — fall back to the full text so the
+                # user isn't left with nothing.
+                await AsyncRuntime.io(_send_chunks, chat_id, final)
+        else:
+            await AsyncRuntime.io(_send_chunks, chat_id, final)
+
+    except Exception as e:
+        logger.error(f"Private handler error: {e}")
+        if anim is not None:
+            mid = await anim
+        try:
+            await AsyncRuntime.io(bot.edit_message_text, f"❌ Error: {e}", chat_id, mid)
+        except Exception:
+            pass
 
 # ══════════════════════════════════════════════════════════════════════════════════
 # 🔧  SECTION 18 : UTILITIES
@@ -3229,7 +6362,7 @@ def _voice_is_on(uid):
     """Quick check: does this user have voice replies turned on?"""
     try:
         u = db.get_user(uid)
-        return bool(u.get("voice_reply", 0))
+        return bool(u.get("voice_reply", 0)) and not LoadGovernor.sheds("voice")
     except Exception:
         return False
 
@@ -3258,7 +6391,10 @@ def _maybe_send_voice(chat_id, uid, text, force=False):
         if len(speak_text) > 300:
             speak_text = speak_text[:300].rsplit(" ", 1)[0] + "..."
 
-        audio = NeuralEngine.call_groq_tts(speak_text)
+        # Chatter class: when Groq quota is short the text answer matters
+        # more, so the voice note is skipped and the caller sends text.
+        audio = NeuralEngine.quota_call("groq", partial(NeuralEngine.call_groq_tts, speak_text),
+                                        priority=ProviderLimiter.CHATTER)
         if not audio or len(audio) < 100:
             bot.send_message(chat_id, "⚠️ Voice reply generate nahi ho saka (empty audio).")
             return False
@@ -3270,6 +6406,9 @@ def _maybe_send_voice(chat_id, uid, text, force=False):
         # useful info. 15s is plenty for these short voice notes.
         bot.send_voice(chat_id, voice_file, timeout=15)
         return True
+    except QuotaExceeded as e:
+        logger.info(f"Voice reply skipped: {e}")
+        return False
     except requests.exceptions.HTTPError as e:
         detail = ""
         try:
@@ -3302,6 +6441,45 @@ def _maybe_send_voice(chat_id, uid, text, force=False):
         return False
 
 
+class BackgroundJobs:
+    """Minimal periodic scheduler: one daemon thread runs each registered
+    job every N seconds. Jobs run one at a time, so each one should do a
+    bounded amount of work per call and pick up where it left off next
+    time."""
+
+    def __init__(self):
+        self._jobs = []   # [interval, next_due, fn, name]
+        self._started = False
+
+    def every(self, seconds, fn, name=None):
+        self._jobs.append([seconds, time.monotonic() + seconds, fn, name or fn.__name__])
+
+    def start(self):
+        if self._started or not self._jobs:
+            return
+        self._started = True
+        threading.Thread(target=self._loop, name="titan-jobs", daemon=True).start()
+
+    def _loop(self):
+        while True:
+            job = min(self._jobs, key=lambda j: j[1])
+            delay = job[1] - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            t0 = time.monotonic()
+            try:
+                job[2]()
+            except Exception as e:
+                logger.error(f"Background job [{job[3]}] failed: {e}", exc_info=True)
+            took = time.monotonic() - t0
+            if took > 5:
+                logger.warning(f"Background job [{job[3]}] took {took:.1f}s")
+            job[1] = time.monotonic() + job[0]
+
+
+jobs = BackgroundJobs()
+
+
 def _send_chunks(chat_id, text, reply_to=None, chunk=4000):
     for i in range(0, len(text), chunk):
         part = text[i:i+chunk]
@@ -3324,6 +6502,22 @@ def _send_chunks(chat_id, text, reply_to=None, chunk=4000):
 # 🚀  SECTION 19 : BOOT & MAIN LOOP
 # ══════════════════════════════════════════════════════════════════════════════════
 
+# Full recount of the get_stats() counters (they are kept up to date by
+# triggers; this only corrects drift, e.g. after manual edits to the DB).
+STATS_RECONCILE_INTERVAL = int(os.environ.get("TITAN_STATS_RECONCILE_SECONDS", "21600"))
+
+
+def start_background_jobs():
+    jobs.every(STATS_RECONCILE_INTERVAL, db.reconcile_stats)
+    jobs.every(COMPACT_INTERVAL, db.compact_memory)
+    jobs.every(CHAT_COUNT_FLUSH_INTERVAL, db.flush_chat_counts)
+    jobs.every(3600, db.prune_analytics)
+    jobs.every(3600, response_cache.prune)
+    if SUMMARY_ENABLED:
+        jobs.every(SUMMARY_INTERVAL, ConversationSummarizer.run)
+    jobs.start()
+
+
 def boot_sequence():
     banner = f"""
 ╔{'═'*63}╗
@@ -3380,6 +6574,7 @@ def boot_sequence():
 
 if __name__ == "__main__":
     boot_sequence()
+    start_background_jobs()
     RESTART_DELAY = 5
 
     while True:
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+"""
+MI AI TITAN V22 — storage benchmarks.
+
+Drives TitanDB (from bot_v22.py) the way the Telegram handlers do, against a
+throwaway database in a temp directory, and prints latency percentiles so a
+change to the storage layer can be compared before/after on the same box.
+
+    python3 titan_bench.py db                  # legacy vs WAL+write-behind
+    python3 titan_bench.py db --handlers 200 --messages 50
+    python3 titan_bench.py plans               # exit 1 if a hot query full-scans
+    python3 titan_bench.py scale --workers 1,2,4 --shards 4   # multi-process
+    python3 titan_bench.py recall --rows 1000000   # FTS5 long-term recall lookups
+    python3 titan_bench.py route                   # fast/deep classifier vs labeled prompts
+    python3 titan_bench.py ai --handlers 50 --error-rate 0.05   # AI path vs titan_emulator
+
+Nothing here talks to Telegram or any AI provider — `ai` runs its answers
+against an in-process titan_emulator.
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+# bot_v22 builds its TeleBot and default TitanDB at import time — give it a
+# syntactically valid token and point its default DB/log into a temp dir so
+# the benchmark never touches the real mi_titan_v22.db.
+# Worker processes (scale) are spawned and re-import this module, so they
+# reuse the parent's temp dir instead of making their own.
+_WORKDIR = os.environ.get("TITAN_BENCH_WORKDIR") or tempfile.mkdtemp(prefix="titan_bench_")
+os.environ["TITAN_BENCH_WORKDIR"] = _WORKDIR
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ["TITAN_DB_PATH"] = os.path.join(_WORKDIR, "default.db")
+os.chdir(_WORKDIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import logging                      # noqa: E402
+import bot_v22                      # noqa: E402
+
+logging.getLogger("bot_v22").setLevel(logging.WARNING)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    k = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[k]
+
+
+def seed(db, users, turns):
+    """Give the DB a realistic amount of history so reads aren't trivial."""
+    for uid in range(1, users + 1):
+        db.sync_user(uid, f"User{uid}", f"user{uid}")
+        for t in range(turns):
+            db.add_memory(uid, "user" if t % 2 == 0 else "assistant", f"seed turn {t} " * 8)
+    db.flush()
+
+
+def private_message(db, uid, chat_id):
+    """Same DB calls, in the same order, as one private text message going
+    through handle_text -> NeuralEngine.get_response -> _voice_is_on."""
+    db.sync_user(uid, f"User{uid}", f"user{uid}")
+    db.register_chat(chat_id, "private", "")
+    db.increment_chat_msg(chat_id)
+    db.is_banned(uid)
+    db.get_user(uid)                       # handle_text
+    db.get_user(uid)                       # get_response
+    db.get_history(uid, limit=bot_v22.CONTEXT_MAX_TURNS)
+    db.increment_queries(uid)
+    db.add_memory(uid, "user", "bench prompt " * 6)
+    db.add_memory(uid, "assistant", "bench answer " * 40, "groq")
+    db.log_event(uid, "ai_query", "groq")
+    db.get_user(uid)                       # _voice_is_on
+
+
+def run_handlers(db, handlers, messages, users):
+    latencies = []
+    lat_lock = threading.Lock()
+    start_gate = threading.Event()
+
+    def worker(n):
+        rnd = random.Random(n)
+        local = []
+        start_gate.wait()
+        for _ in range(messages):
+            uid = rnd.randint(1, users)
+            t0 = time.perf_counter()
+            private_message(db, uid, uid)
+            local.append((time.perf_counter() - t0) * 1000)
+        with lat_lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(handlers)]
+    for t in threads:
+        t.start()
+    t0 = time.perf_counter()
+    start_gate.set()
+    for t in threads:
+        t.join()
+    db.flush()
+    elapsed = time.perf_counter() - t0
+    return latencies, elapsed
+
+
+def cmd_db(args):
+    configs = [
+        ("legacy (commit-per-write, shared conn)", dict(write_behind=False, wal=False)),
+        ("WAL + thread-local readers",             dict(write_behind=False, wal=True)),
+        ("WAL + readers + write-behind",           dict(write_behind=True,  wal=True)),
+    ]
+    print(f"{args.handlers} concurrent handlers x {args.messages} messages, "
+          f"{args.users} users seeded with {args.turns} turns each\n")
+    print(f"{'config':<42}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'msg/s':>10}")
+    for i, (label, kwargs) in enumerate(configs):
+        db = bot_v22.TitanDB(os.path.join(_WORKDIR, f"bench_{i}.db"), **kwargs)
+        seed(db, args.users, args.turns)
+        lat, elapsed = run_handlers(db, args.handlers, args.messages, args.users)
+        print(f"{label:<42}{percentile(lat, 50):>9.2f}{percentile(lat, 95):>9.2f}"
+              f"{percentile(lat, 99):>9.2f}{len(lat) / elapsed:>10.0f}")
+
+
+def cmd_plans(args):
+    db = bot_v22.TitanDB(os.path.join(_WORKDIR, "plans.db"))
+    seed(db, 50, 10)
+    for shard in db.shards:
+        shard.c.execute("ANALYZE")
+    bad = db.slow_query_plans()
+    for name, plan in db.explain_hot_queries().items():
+        print(f"{'FULL SCAN' if name in bad else 'ok':<10}{name:<20}{' | '.join(plan)}")
+    sys.exit(1 if bad else 0)
+
+
+def _scale_worker(path, shards, handlers, messages, users, ready, go, results):
+    db = bot_v22.TitanDB(path, shards=shards)
+    ready.put(os.getpid())
+    go.wait()
+    lat, _ = run_handlers(db, handlers, messages, users)
+    results.put(lat)
+
+
+def cmd_scale(args):
+    """Several bot processes sharing one set of shard files, each running
+    `handlers` threads of the per-message DB work. Throughput is measured
+    across all workers, from the moment they are all ready."""
+    ctx = multiprocessing.get_context("spawn")
+    workers = [int(w) for w in args.workers.split(",")]
+    print(f"{args.handlers} handlers x {args.messages} messages per worker process, "
+          f"{os.cpu_count()} CPU(s)\n")
+    print(f"{'workers':>8}{'shards':>8}{'p50 ms':>9}{'p99 ms':>9}{'msg/s':>10}")
+    for shards in sorted({1, args.shards}):
+        for n in workers:
+            path = os.path.join(_WORKDIR, f"scale_{shards}_{n}.db")
+            seed(bot_v22.TitanDB(path, shards=shards), args.users, args.turns)
+            ready, results, go = ctx.Queue(), ctx.Queue(), ctx.Event()
+            procs = [
+                ctx.Process(target=_scale_worker, args=(
+                    path, shards, args.handlers, args.messages, args.users, ready, go, results))
+                for _ in range(n)
+            ]
+            for p in procs:
+                p.start()
+            for _ in procs:
+                ready.get()
+            t0 = time.perf_counter()
+            go.set()
+            lat = []
+            for _ in procs:
+                lat.extend(results.get())
+            elapsed = time.perf_counter() - t0
+            for p in procs:
+                p.join()
+            print(f"{n:>8}{shards:>8}{percentile(lat, 50):>9.2f}{percentile(lat, 99):>9.2f}"
+                  f"{len(lat) / elapsed:>10.0f}")
+
+
+WORDS = ("python flask django api server deploy docker bug error cricket match biryani "
+         "exam physics chemistry maths shaadi cousin office salary laptop phone gaming "
+         "trip lahore karachi islamabad doctor fever diet gym workout dog cat bruno").split()
+
+
+def cmd_recall(args):
+    """Seeds `rows` memory rows over `users` users (the same statements
+    as add_memory, but straight into the shard files instead of through the
+    write queue) and times db.recall() for random users and prompts."""
+    db = bot_v22.TitanDB(os.path.join(_WORKDIR, "recall.db"))
+    rnd = random.Random(1)
+    t0 = time.perf_counter()
+    batch = 20000
+    for start in range(0, args.rows, batch):
+        rows = [(rnd.randint(1, args.users), "user" if i % 2 == 0 else "assistant",
+                 " ".join(rnd.choices(WORDS, k=rnd.randint(5, 40))))
+                for i in range(start, min(args.rows, start + batch))]
+        for shard in db.shards:
+            with shard._lock:
+                for uid, role, content in rows:
+                    if db._shard(uid) is not shard:
+                        continue
+                    shard._wc.execute("INSERT INTO memory (uid,role,content) VALUES (?,?,?)",
+                                      (uid, role, content))
+                    for sql, params in db._recall_index("memory", uid, role, content):
+                        shard._wc.execute(sql, params)
+                shard.conn.commit()
+    print(f"seeded {args.rows} rows for {args.users} users in {time.perf_counter() - t0:.1f}s")
+    lat, hits = [], 0
+    for _ in range(args.lookups):
+        uid = rnd.randint(1, args.users)
+        prompt = " ".join(rnd.choices(WORDS, k=8)) + " yaad hai?"
+        t = time.perf_counter()
+        hits += len(db.recall("user", uid, prompt, limit=bot_v22.RECALL_TOP_K))
+        lat.append((time.perf_counter() - t) * 1000)
+    print(f"{args.lookups} lookups, top-{bot_v22.RECALL_TOP_K}, {hits / args.lookups:.1f} hits each: "
+          f"p50 {percentile(lat, 50):.2f} ms  p95 {percentile(lat, 95):.2f} ms  p99 {percentile(lat, 99):.2f} ms")
+
+
+# Labeled prompts for ComplexityRouter: (prompt, mode, label). "deep" = a
+# prompt the 120B model answers clearly better; "fast" = one the 20B model
+# handles as well. Add real misroutes from the logs here before retuning.
+ROUTE_SET = [
+    ("salam", "chat", "fast"),
+    ("Assalam o alaikum bhai kaise ho?", "chat", "fast"),
+    ("hi", "chat", "fast"),
+    ("thanks yaar", "chat", "fast"),
+    ("shukriya bohot madad hui", "chat", "fast"),
+    ("ok", "chat", "fast"),
+    ("good morning!", "chat", "fast"),
+    ("haha sahi hai", "chat", "fast"),
+    ("Pakistan ka capital kya hai?", "chat", "fast"),
+    ("aaj kaunsa din hai", "chat", "fast"),
+    ("mujhe ek joke sunao", "chat", "fast"),
+    ("2+2 kitne hote hain", "chat", "fast"),
+    ("python mein list kya hoti hai?", "chat", "fast"),
+    ("best biryani kahan milti hai lahore mein", "chat", "fast"),
+    ("mera mood off hai", "chat", "fast"),
+    ("ek motivational quote do", "chat", "fast"),
+    ("kal barish hogi?", "chat", "fast"),
+    ("who is the prime minister of UK", "chat", "fast"),
+    ("tum kaun ho?", "chat", "fast"),
+    ("good night", "chat", "fast"),
+    ("ek choti si poem likho chand par", "creative", "fast"),
+    ("dosti par 2 line ka sher", "creative", "fast"),
+    ("HTML kya hai", "study", "fast"),
+    ("photosynthesis ka formula", "study", "fast"),
+    ("print hello world in python", "code", "fast"),
+    ("acha theek hai", "code", "fast"),
+    ("mashallah zabardast", "chat", "fast"),
+    ("cricket score kya hai", "search", "fast"),
+    ("iPhone 16 price in Pakistan", "search", "fast"),
+    ("lol", "chat", "fast"),
+    ("Explain the difference between TCP and UDP with examples and when to use each", "chat", "deep"),
+    ("mere Flask app mein ye error aa raha hai:\nTraceback (most recent call last):\n  File \"app.py\", line 12\n"
+     "KeyError: 'user_id'\niska fix batao", "chat", "deep"),
+    ("```python\ndef f(x):\n    return [i*i for i in range(x) if i % 2]\n```\nis code ko optimize karo aur complexity batao",
+     "code", "deep"),
+    ("Design a scalable architecture for a food delivery app with 1M users", "chat", "deep"),
+    ("quantum entanglement ko step by step samjhao jaise main 12 saal ka hoon", "study", "deep"),
+    ("Write a Python script that scrapes a website and saves results to SQLite", "code", "deep"),
+    ("React aur Vue mein kya farq hai? kab kaunsa use karein? pros and cons?", "chat", "deep"),
+    ("prove that the square root of 2 is irrational", "study", "deep"),
+    ("ek full e-commerce website bana do HTML CSS JS ke saath", "build", "deep"),
+    ("SELECT * FROM orders o JOIN users u ON o.uid = u.id WHERE total > 100; ye query slow kyun hai?", "code", "deep"),
+    ("meri business strategy plan likho ek chhoti bakery ke liye, marketing aur budget ke saath", "chat", "deep"),
+    ("Compare capitalism and socialism in a detailed essay", "chat", "deep"),
+    ("integral of x^2 * e^x dx step by step solve karo", "study", "deep"),
+    ("Implement binary search tree insert and delete in Java", "code", "deep"),
+    ("Why does my React component re-render infinitely when I call setState in useEffect?", "code", "deep"),
+    ("Explain how transformers work in machine learning, attention mechanism detail mein", "study", "deep"),
+    ("Mujhe Django REST API banani hai authentication ke saath, poora structure aur code do", "build", "deep"),
+    ("Analyze the causes of World War 1 in detail", "study", "deep"),
+    ("Refactor this:\nfunction a(b){for(var i=0;i<b.length;i++){if(b[i]){console.log(b[i])}}}", "code", "deep"),
+    ("docker compose file likho postgres redis aur node app ke liye", "code", "deep"),
+    ("Newton ke teeno laws explain karo examples ke saath aur unka derivation bhi", "study", "deep"),
+    ("mera laptop bohot slow hai, kya kya check karun? RAM, SSD, startup apps... detail mein batao", "chat", "deep"),
+    ("Translate this paragraph to formal Urdu and summarize it: The economy grew by 3% last year "
+     "driven by exports, while inflation stayed high because of energy prices and currency depreciation.",
+     "chat", "deep"),
+    ("CSS grid vs flexbox — kab kya use karna chahiye?", "code", "deep"),
+    ("machine learning seekhne ka 6 mahine ka plan banao", "study", "deep"),
+    ("How does HTTPS work? explain TLS handshake", "chat", "deep"),
+    ("Mera code kaam nahi kar raha: for i in range(10) print(i) — SyntaxError aa raha hai", "code", "deep"),
+    ("Write a cover letter for a software engineer job at Google with my 3 years Python experience", "chat", "deep"),
+    ("algorithm for detecting cycles in a directed graph, with complexity", "code", "deep"),
+    ("Ek short story likho ek robot ke baare mein jo insaan banna chahta hai, 1000 words", "creative", "deep"),
+]
+
+
+def cmd_route(args):
+    """Accuracy of ComplexityRouter on ROUTE_SET, and the latency it
+    saves against sending everything to the 120B model. Latency per
+    answer is modelled as ttft + expected answer tokens / tokens-per-
+    second, with the router's own OUTPUT_ESTIMATE for answer length."""
+    router = bot_v22.ComplexityRouter
+    confusion = {(a, b): 0 for a in ("fast", "deep") for b in ("fast", "deep")}
+    misses = []
+    t0 = time.perf_counter()
+    for prompt, mode, label in ROUTE_SET:
+        got = "deep" if router.wants_deep(prompt, mode) else "fast"
+        confusion[(label, got)] += 1
+        if got != label:
+            misses.append((label, got, round(router.score(prompt, mode)[0], 2), prompt[:70].replace("\n", " ")))
+    per_prompt_us = (time.perf_counter() - t0) / len(ROUTE_SET) * 1e6
+
+    n = len(ROUTE_SET)
+    correct = confusion[("fast", "fast")] + confusion[("deep", "deep")]
+    hard = confusion[("deep", "deep")] + confusion[("deep", "fast")]
+    routed_deep = confusion[("deep", "deep")] + confusion[("fast", "deep")]
+    print(f"{n} labeled prompts (threshold {bot_v22.DEPTH_THRESHOLD}), classifier {per_prompt_us:.0f} µs/prompt\n")
+    print(f"{'':>12}{'→ fast':>9}{'→ deep':>9}")
+    for label in ("fast", "deep"):
+        print(f"{label + ' (label)':>12}{confusion[(label, 'fast')]:>9}{confusion[(label, 'deep')]:>9}")
+    print(f"\naccuracy {correct / n:.0%} · hard prompts sent deep {confusion[('deep', 'deep')] / max(1, hard):.0%} "
+          f"· easy prompts kept fast {confusion[('fast', 'fast')] / max(1, n - hard):.0%}")
+
+    est = bot_v22.ProviderLimiter.OUTPUT_ESTIMATE
+    fast_s = args.ttft + est["fast"] / args.fast_tps
+    deep_s = args.ttft + est["deep"] / args.deep_tps
+    all_deep = deep_s
+    routed = (routed_deep * deep_s + (n - routed_deep) * fast_s) / n
+    print(f"\nmodelled answer time: fast {fast_s:.2f}s, deep {deep_s:.2f}s "
+          f"(ttft {args.ttft}s, {args.fast_tps:.0f} / {args.deep_tps:.0f} tok/s)")
+    print(f"everything on 120B: {all_deep:.2f}s avg · routed: {routed:.2f}s avg "
+          f"→ {100 * (1 - routed / all_deep):.0f}% less waiting, "
+          f"{routed_deep}/{n} prompts on 120B")
+    if misses and args.verbose:
+        print("\nmisrouted (label → got, score):")
+        for label, got, score, prompt in misses:
+            print(f"  {label} → {got} {score:>5}  {prompt}")
+
+
+def cmd_ai(args):
+    """End-to-end NeuralEngine.get_response under concurrency, answered
+    by an in-process titan_emulator: routing, quotas, hedging, circuit
+    breakers and memory writes all run for real, only the providers are
+    fake. The bot's free-tier quotas are lifted unless --quotas, so the
+    numbers measure the bot rather than the 30 RPM Groq limit."""
+    from titan_emulator import Emulator, Latency
+
+    emu = Emulator(latency=Latency(args.latency), tps=args.tps, error_rate=args.error_rate,
+                   rate_429=args.rate_429, words=args.words).start()
+    for name, url in emu.env().items():
+        setattr(bot_v22, name, url)
+    if not args.quotas:
+        bot_v22.PROVIDER_QUOTAS.clear()
+    # All four providers share the emulator's one host here, so the bot's
+    # per-host pool of 10 overflows in a way it never does in production.
+    logging.getLogger("urllib3.connectionpool").setLevel(logging.ERROR)
+    prompts = [prompt for prompt, _, _ in ROUTE_SET]
+    latencies, engines, failures = [], {}, []
+    lock = threading.Lock()
+    start_gate = threading.Event()
+
+    def handler(h):
+        rng = random.Random(h)
+        uid = 10_000 + h
+        bot_v22.db.sync_user(uid, f"User{uid}", f"user{uid}")
+        start_gate.wait()
+        for _ in range(args.messages):
+            t0 = time.perf_counter()
+            try:
+                _, engine = bot_v22.NeuralEngine.get_response(uid, rng.choice(prompts))
+            except Exception as e:
+                with lock:
+                    failures.append(repr(e))
+                continue
+            with lock:
+                latencies.append((time.perf_counter() - t0) * 1000)
+                engines[engine] = engines.get(engine, 0) + 1
+
+    threads = [threading.Thread(target=handler, args=(h,)) for h in range(args.handlers)]
+    for t in threads:
+        t.start()
+    t0 = time.perf_counter()
+    start_gate.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    bot_v22.db.flush()
+    stats = emu.snapshot()["providers"]
+    emu.stop()
+
+    print(f"{args.handlers} concurrent handlers x {args.messages} messages against {emu.url} "
+          f"(latency {args.latency}, {args.tps:g} words/s, errors {args.error_rate:.0%}, "
+          f"429s {args.rate_429:.0%}, quotas {'on' if args.quotas else 'off'})\n")
+    print(f"{'answered':>9}{'failed':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'msg/s':>9}")
+    print(f"{len(latencies):>9}{len(failures):>8}{percentile(latencies, 50):>9.0f}"
+          f"{percentile(latencies, 95):>9.0f}{percentile(latencies, 99):>9.0f}{len(latencies) / elapsed:>9.1f}")
+    print("\nanswered by: " + ", ".join(f"{e} {n}" for e, n in sorted(engines.items(), key=lambda kv: -kv[1])))
+    print(f"\n{'provider':<14}{'requests':>9}{'ok':>7}{'5xx':>6}{'429':>6}{'p50 ms':>9}{'p99 ms':>9}")
+    for name, s in stats.items():
+        if s["requests"]:
+            print(f"{name:<14}{s['requests']:>9}{s['ok']:>7}{s['errors']:>6}{s['throttled']:>6}"
+                  f"{s['p50'] * 1000:>9.0f}{s['p99'] * 1000:>9.0f}")
+    if failures:
+        print(f"\nfirst failure: {failures[0]}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("db", help="p50/p95/p99 of the per-message DB work under concurrency")
+    p.add_argument("--handlers", type=int, default=100, help="concurrent handler threads (TeleBot uses 100)")
+    p.add_argument("--messages", type=int, default=30, help="messages per handler")
+    p.add_argument("--users", type=int, default=500)
+    p.add_argument("--turns", type=int, default=40, help="history rows seeded per user")
+    p.set_defaults(func=cmd_db)
+
+    p = sub.add_parser("plans", help="EXPLAIN QUERY PLAN every hot-path query; non-zero exit on a full scan")
+    p.set_defaults(func=cmd_plans)
+
+    p = sub.add_parser("scale", help="throughput of N bot worker processes sharing sharded storage")
+    p.add_argument("--workers", default="1,2,4", help="comma-separated worker process counts")
+    p.add_argument("--shards", type=int, default=4, help="compared against a single shard")
+    p.add_argument("--handlers", type=int, default=20, help="handler threads per worker")
+    p.add_argument("--messages", type=int, default=50, help="messages per handler")
+    p.add_argument("--users", type=int, default=2000)
+    p.add_argument("--turns", type=int, default=10)
+    p.set_defaults(func=cmd_scale)
+
+    p = sub.add_parser("recall", help="latency of BM25 recall lookups over a large memory table")
+    p.add_argument("--rows", type=int, default=300000, help="memory rows to seed")
+    p.add_argument("--users", type=int, default=5000)
+    p.add_argument("--lookups", type=int, default=2000)
+    p.set_defaults(func=cmd_recall)
+
+    p = sub.add_parser("route", help="fast/deep classifier accuracy and latency saved vs all-120B")
+    p.add_argument("--ttft", type=float, default=0.3, help="seconds to first token, both models")
+    p.add_argument("--fast-tps", type=float, default=1000, help="gpt-oss-20b output tokens/second")
+    p.add_argument("--deep-tps", type=float, default=500, help="gpt-oss-120b output tokens/second")
+    p.add_argument("-v", "--verbose", action="store_true", help="list misrouted prompts")
+    p.set_defaults(func=cmd_route)
+
+    p = sub.add_parser("ai", help="get_response latency/throughput against the offline provider emulator")
+    p.add_argument("--handlers", type=int, default=20, help="concurrent handler threads")
+    p.add_argument("--messages", type=int, default=10, help="messages per handler")
+    p.add_argument("--latency", default="lognorm:0.3,0.4", help="emulated time to first byte (see titan_emulator.py)")
+    p.add_argument("--tps", type=float, default=400, help="emulated words/second after the first byte")
+    p.add_argument("--words", type=int, default=120, help="words per emulated answer")
+    p.add_argument("--error-rate", type=float, default=0.0, help="fraction of provider calls answered 503")
+    p.add_argument("--rate-429", type=float, default=0.0, help="fraction of provider calls answered 429")
+    p.add_argument("--quotas", action="store_true", help="keep the bot's client-side provider quotas")
+    p.set_defaults(func=cmd_ai)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+"""
+MI AI TITAN V22 — offline AI provider emulator.
+
+A local HTTP stand-in for every AI endpoint bot_v22.py calls, answering in
+the same request/response shapes, so the AI paths (NeuralEngine, vision,
+TTS, Whisper, ImageEngine) can be benchmarked and load-tested without
+spending real quota:
+
+    POST /v1beta/models/<model>:generateContent            Gemini (text + vision)
+    POST /v1beta/models/<model>:streamGenerateContent?alt=sse
+    POST /openai/v1/chat/completions                       Groq (text, vision, JSON mode, stream)
+    POST /openai/v1/audio/speech                           Groq TTS  -> WAV
+    POST /openai/v1/audio/transcriptions                   Groq Whisper -> {"text": ...}
+    POST /api/v1/chat/completions                          OpenRouter (text, stream)
+    GET  /prompt/<prompt>?width=&height=&seed=             Pollinations -> PNG
+    GET  /_stats                                           counters + latency per provider
+    POST /_reset                                           zero the counters
+
+One server serves all four providers — their paths don't overlap — so point
+every base URL at it:
+
+    python3 titan_emulator.py --port 8400
+    python3 titan_emulator.py --latency lognorm:0.4,0.6 --tps 300 --error-rate 0.02
+    python3 titan_emulator.py --latency groq=fixed:0.15 --rpm groq=30 --rate-429 0.01
+
+    export GEMINI_BASE_URL=http://127.0.0.1:8400 GROQ_BASE_URL=http://127.0.0.1:8400 \\
+           OPENROUTER_BASE_URL=http://127.0.0.1:8400 POLLINATIONS_BASE_URL=http://127.0.0.1:8400
+
+Latency specs: a number (fixed seconds), fixed:S, uniform:LO,HI or
+lognorm:MEDIAN,SIGMA. Every option takes either a bare value (all
+providers) or provider=value, and can be repeated. Latency is the time to
+the first byte; the rest of the answer then arrives at --tps words/second,
+streamed or not.
+
+Errors: --error-rate answers 503, --rate-429 answers a random 429, and
+--rpm enforces a per-provider requests/minute window that answers 429 with
+a Retry-After header once exceeded — the same signals the bot's circuit
+breaker and quota limiter react to.
+
+Standard library only. Import Emulator to run it in-process (titan_bench.py ai).
+"""
+
+import argparse
+import io
+import json
+import math
+import random
+import re
+import struct
+import threading
+import time
+import wave
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+PROVIDERS = ("gemini", "groq", "openrouter", "pollinations")
+
+FILLER = ("yeh emulator ka jawab hai jo asli provider ki jagah local machine se aata hai "
+          "taake latency aur throughput ko bina quota kharch kiye naapa ja sake").split()
+
+
+class Latency:
+    """Seconds-to-first-byte distribution, parsed from a CLI spec."""
+
+    def __init__(self, spec="fixed:0"):
+        self.spec = str(spec)
+        kind, _, args = self.spec.partition(":")
+        if not args:
+            kind, args = "fixed", kind
+        try:
+            self.args = [float(a) for a in args.split(",")]
+        except ValueError:
+            raise ValueError(f"bad latency spec {spec!r}") from None
+        if kind not in ("fixed", "uniform", "lognorm") or len(self.args) != {"fixed": 1}.get(kind, 2):
+            raise ValueError(f"bad latency spec {spec!r} (fixed:S, uniform:LO,HI or lognorm:MEDIAN,SIGMA)")
+        self.kind = kind
+
+    def sample(self, rng=random):
+        if self.kind == "fixed":
+            return self.args[0]
+        if self.kind == "uniform":
+            return rng.uniform(*self.args)
+        median, sigma = self.args
+        return median * math.exp(rng.gauss(0.0, sigma)) if median > 0 else 0.0
+
+    def __repr__(self):
+        return self.spec
+
+
+class Profile:
+    """How one provider behaves: latency, streaming speed, failure rates
+    and its requests/minute window (0 = unlimited)."""
+
+    def __init__(self, latency="fixed:0", tps=0.0, error_rate=0.0, rate_429=0.0, rpm=0, words=60):
+        self.latency = latency if isinstance(latency, Latency) else Latency(latency)
+        self.tps = float(tps)
+        self.error_rate = float(error_rate)
+        self.rate_429 = float(rate_429)
+        self.rpm = int(rpm)
+        self.words = int(words)
+
+    def as_dict(self):
+        return {"latency": repr(self.latency), "tps": self.tps, "error_rate": self.error_rate,
+                "rate_429": self.rate_429, "rpm": self.rpm, "words": self.words}
+
+
+class Stats:
+    """Per-provider counters, read through /_stats."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.by_provider = {p: {"requests": 0, "ok": 0, "errors": 0, "throttled": 0,
+                                    "streams": 0, "latencies": []} for p in PROVIDERS}
+            self.started = time.time()
+
+    def record(self, provider, outcome, seconds=None, stream=False):
+        with self.lock:
+            s = self.by_provider[provider]
+            s["requests"] += 1
+            s[outcome] += 1
+            s["streams"] += int(stream)
+            if seconds is not None:
+                s["latencies"].append(seconds)
+                if len(s["latencies"]) > 10000:
+                    del s["latencies"][:5000]
+
+    def snapshot(self):
+        with self.lock:
+            out = {"uptime": round(time.time() - self.started, 1), "providers": {}}
+            for name, s in self.by_provider.items():
+                lat = sorted(s["latencies"])
+                pct = lambda q: round(lat[min(len(lat) - 1, int(q * len(lat)))], 4) if lat else 0.0  # noqa: E731
+                out["providers"][name] = {k: v for k, v in s.items() if k != "latencies"}
+                out["providers"][name].update(p50=pct(0.50), p95=pct(0.95), p99=pct(0.99))
+            return out
+
+
+class _Window:
+    """Sliding one-minute request window for --rpm."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stamps = []
+
+    def admit(self, rpm):
+        """None if the request fits, else the Retry-After seconds."""
+        if rpm <= 0:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            while self.stamps and now - self.stamps[0] >= 60:
+                self.stamps.pop(0)
+            if len(self.stamps) >= rpm:
+                return max(1, math.ceil(60 - (now - self.stamps[0])))
+            self.stamps.append(now)
+            return None
+
+
+# ─── PAYLOADS ─────────────────────────────────────────────────────────────────
+
+def answer_text(prompt, words, rng):
+    """A deterministic-looking answer of about `words` words."""
+    head = re.sub(r"\s+", " ", prompt or "").strip()[:80]
+    body = [rng.choice(FILLER) for _ in range(max(0, words - 4))]
+    return f"[emulator] {head} —\n" + " ".join(body)
+
+
+def signal_json(rng):
+    """What call_groq_vision(json_mode=True) gets for a trading chart."""
+    return json.dumps({
+        "direction": rng.choice(["UP", "DOWN", "WAIT"]),
+        "confidence": rng.randint(55, 92),
+        "trend": rng.choice(["uptrend", "downtrend", "sideways"]),
+        "strategies_agreeing": rng.randint(2, 6),
+        "reasoning": "Emulated chart read: higher lows, momentum building near support.",
+        "risk_note": "Emulator output — not a real signal.",
+    })
+
+
+def wav_bytes(seconds=0.6, rate=16000):
+    """A short 440 Hz tone — enough for Telegram to accept it as voice."""
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        frames = (int(8000 * math.sin(2 * math.pi * 440 * i / rate)) for i in range(int(seconds * rate)))
+        w.writeframes(b"".join(struct.pack("<h", f) for f in frames))
+    return buf.getvalue()
+
+
+def png_bytes(width, height, seed):
+    """Seeded RGB noise as a PNG. Noise doesn't compress, so it clears
+    ImageEngine's "more than 3000 bytes" sanity check at any size."""
+    width, height = max(16, min(width, 256)), max(16, min(height, 256))
+    rng = random.Random(seed)
+    rows = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows, 1))
+            + chunk(b"IEND", b""))
+
+
+_WAV = wav_bytes()
+
+
+# ─── SERVER ───────────────────────────────────────────────────────────────────
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "TitanEmulator/1.0"
+
+    def log_message(self, fmt, *args):
+        if self.server.emulator.verbose:
+            super().log_message(fmt, *args)
+
+    # -- plumbing --
+
+    def _body(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+
+    def _json_body(self):
+        try:
+            return json.loads(self._body() or b"{}")
+        except ValueError:
+            return {}
+
+    def _send(self, status, body, ctype="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, str(v))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, provider, status, message, retry_after=None):
+        if provider == "gemini":
+            body = {"error": {"code": status, "message": message,
+                              "status": "RESOURCE_EXHAUSTED" if status == 429 else "UNAVAILABLE"}}
+        else:
+            body = {"error": {"message": message, "code": status,
+                              "type": "rate_limit_exceeded" if status == 429 else "server_error"}}
+        self._send(status, body, headers={"Retry-After": retry_after} if retry_after else None)
+
+    def _gate(self, provider):
+        """Apply latency and the failure knobs. Returns the profile and
+        the rng if the request should be answered, else None (already
+        answered with an error)."""
+        emu = self.server.emulator
+        prof = emu.profile(provider)
+        rng = random.Random()
+        retry_after = emu.windows[provider].admit(prof.rpm)
+        if retry_after is None and rng.random() < prof.rate_429:
+            retry_after = rng.randint(1, 5)
+        if retry_after is not None:
+            emu.stats.record(provider, "throttled")
+            self._error(provider, 429, "Rate limit reached (emulated)", retry_after)
+            return None
+        time.sleep(prof.latency.sample(rng))
+        if rng.random() < prof.error_rate:
+            emu.stats.record(provider, "errors")
+            self._error(provider, 503, "Service unavailable (emulated)")
+            return None
+        return prof, rng
+
+    # -- routes --
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/_stats":
+            return self._send(200, self.server.emulator.snapshot())
+        if url.path.startswith("/prompt/"):
+            return self._pollinations(url)
+        self._send(404, {"error": {"message": f"no emulated route for GET {url.path}"}})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        path = url.path
+        if path == "/_reset":
+            self._body()
+            self.server.emulator.stats.reset()
+            return self._send(200, {"ok": True})
+        m = re.fullmatch(r"/v1beta/models/([^/:]+):(generateContent|streamGenerateContent)", path)
+        if m:
+            return self._gemini(m.group(2) == "streamGenerateContent")
+        if path == "/openai/v1/chat/completions":
+            return self._chat("groq")
+        if path == "/api/v1/chat/completions":
+            return self._chat("openrouter")
+        if path == "/openai/v1/audio/speech":
+            return self._speech()
+        if path == "/openai/v1/audio/transcriptions":
+            return self._transcription()
+        self._body()
+        self._send(404, {"error": {"message": f"no emulated route for POST {path}"}})
+
+    def _stream(self, prof, pieces, frame, done=True):
+        """Server-sent events: one frame per word at --tps words/second."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        gap = 1.0 / prof.tps if prof.tps > 0 else 0.0
+        try:
+            for i, piece in enumerate(pieces):
+                if i and gap:
+                    time.sleep(gap)
+                self.wfile.write(b"data: " + json.dumps(frame(piece)).encode() + b"\n\n")
+                self.wfile.flush()
+            if done:
+                self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass        # client hung up mid-stream (hedge loser, timeout)
+
+    @staticmethod
+    def _pieces(text):
+        return re.findall(r"\S+\s*", text) or [text]
+
+    def _finish_delay(self, prof, text):
+        if prof.tps > 0:
+            time.sleep(len(text.split()) / prof.tps)
+
+    def _gemini(self, stream):
+        t0 = time.perf_counter()
+        req = self._json_body()
+        gate = self._gate("gemini")
+        if not gate:
+            return
+        prof, rng = gate
+        parts = [p for c in req.get("contents") or [] for p in c.get("parts") or []]
+        prompt = next((p["text"] for p in reversed(parts) if "text" in p), "")
+        if any("inline_data" in p for p in parts):
+            prompt = "image: " + prompt
+        words = min(prof.words, (req.get("generationConfig") or {}).get("maxOutputTokens") or prof.words)
+        text = answer_text(prompt, words, rng)
+        candidate = lambda t: {"candidates": [{"content": {"role": "model", "parts": [{"text": t}]}}]}  # noqa: E731
+        if stream:
+            self._stream(prof, self._pieces(text), candidate, done=False)
+        else:
+            self._finish_delay(prof, text)
+            body = candidate(text)
+            body["candidates"][0]["finishReason"] = "STOP"
+            self._send(200, body)
+        self.server.emulator.stats.record("gemini", "ok", time.perf_counter() - t0, stream)
+
+    def _chat(self, provider):
+        t0 = time.perf_counter()
+        req = self._json_body()
+        gate = self._gate(provider)
+        if not gate:
+            return
+        prof, rng = gate
+        last = (req.get("messages") or [{}])[-1].get("content") or ""
+        if isinstance(last, list):      # vision: [{"type": "text"}, {"type": "image_url"}]
+            last = "image: " + " ".join(p.get("text", "") for p in last if p.get("type") == "text")
+        if (req.get("response_format") or {}).get("type") == "json_object":
+            text = signal_json(rng)
+        else:
+            text = answer_text(last, min(prof.words, req.get("max_tokens") or prof.words), rng)
+        model = req.get("model", "emulated")
+        rid = f"chatcmpl-emu{rng.getrandbits(48):x}"
+        if req.get("stream"):
+            self._stream(prof, self._pieces(text), lambda t: {
+                "id": rid, "object": "chat.completion.chunk", "model": model,
+                "choices": [{"index": 0, "delta": {"content": t}, "finish_reason": None}]})
+        else:
+            self._finish_delay(prof, text)
+            self._send(200, {
+                "id": rid, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(str(req.get("messages"))) // 4,
+                          "completion_tokens": len(text) // 4,
+                          "total_tokens": (len(str(req.get("messages"))) + len(text)) // 4},
+            })
+        self.server.emulator.stats.record(provider, "ok", time.perf_counter() - t0, bool(req.get("stream")))
+
+    def _speech(self):
+        t0 = time.perf_counter()
+        self._json_body()
+        if not self._gate("groq"):
+            return
+        self._send(200, _WAV, "audio/wav")
+        self.server.emulator.stats.record("groq", "ok", time.perf_counter() - t0)
+
+    def _transcription(self):
+        t0 = time.perf_counter()
+        body = self._body()
+        gate = self._gate("groq")
+        if not gate:
+            return
+        m = re.search(rb'name="model"\r\n\r\n([^\r]+)', body)
+        model = m.group(1).decode(errors="replace") if m else "whisper"
+        self._send(200, {"text": f"[emulator] {model} transcript of {len(body)} bytes",
+                         "x_groq": {"id": f"req_emu{gate[1].getrandbits(32):x}"}})
+        self.server.emulator.stats.record("groq", "ok", time.perf_counter() - t0)
+
+    def _pollinations(self, url):
+        t0 = time.perf_counter()
+        gate = self._gate("pollinations")
+        if not gate:
+            return
+        q = {k: v[0] for k, v in parse_qs(url.query).items()}
+        try:
+            width, height = int(q.get("width", 512)), int(q.get("height", 512))
+        except ValueError:
+            width = height = 512
+        seed = q.get("seed") or unquote(url.path)
+        png = png_bytes(width, height, f"{seed}:{q.get('model', '')}")
+        self._send(200, png, "image/png")
+        self.server.emulator.stats.record("pollinations", "ok", time.perf_counter() - t0)
+
+
+class Emulator:
+    """The server, startable in-process:
+
+        emu = Emulator(latency="lognorm:0.3,0.5", tps=400).start()
+        os.environ.update(emu.env())      # or patch bot_v22.*_BASE_URL
+        ...
+        emu.stop()
+
+    Keyword arguments are the Profile fields and apply to every provider;
+    overrides={"groq": {"rpm": 30}} changes single providers."""
+
+    def __init__(self, host="127.0.0.1", port=0, overrides=None, verbose=False, **defaults):
+        self.profiles = {}
+        for p in PROVIDERS:
+            self.profiles[p] = Profile(**{**defaults, **(overrides or {}).get(p, {})})
+        self.windows = {p: _Window() for p in PROVIDERS}
+        self.stats = Stats()
+        self.verbose = verbose
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.request_queue_size = 256
+        self.httpd.emulator = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def profile(self, provider):
+        return self.profiles[provider]
+
+    def env(self):
+        """The environment variables that point bot_v22 at this server."""
+        return {name: self.url for name in
+                ("GEMINI_BASE_URL", "GROQ_BASE_URL", "OPENROUTER_BASE_URL", "POLLINATIONS_BASE_URL")}
+
+    def snapshot(self):
+        out = self.stats.snapshot()
+        for name, prof in self.profiles.items():
+            out["providers"][name]["profile"] = prof.as_dict()
+        return out
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="titan-emulator", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _per_provider(values, cast, flag):
+    """["0.3", "groq=fixed:0.1"] -> (default, {"groq": ...})."""
+    default, overrides = None, {}
+    for v in values or ():
+        name, eq, rest = v.partition("=")
+        if eq and name in PROVIDERS:
+            overrides[name] = cast(rest)
+        elif eq:
+            raise SystemExit(f"{flag}: unknown provider {name!r} (one of {', '.join(PROVIDERS)})")
+        else:
+            default = cast(v)
+    return default, overrides
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8400)
+    knobs = (
+        ("latency", Latency, "fixed:0.25", "time to first byte (fixed:S | uniform:LO,HI | lognorm:MEDIAN,SIGMA)"),
+        ("tps", float, 400.0, "words/second after the first byte, 0 = instant"),
+        ("error-rate", float, 0.0, "fraction of requests answered 503"),
+        ("rate-429", float, 0.0, "fraction of requests answered 429 at random"),
+        ("rpm", int, 0, "requests/minute before 429 + Retry-After, 0 = unlimited"),
+        ("words", int, 60, "words per text answer (capped by the request's max tokens)"),
+    )
+    for flag, _, default, help_ in knobs:
+        ap.add_argument(f"--{flag}", action="append", metavar="[PROVIDER=]VALUE",
+                        help=f"{help_} (default {default})")
+    ap.add_argument("-v", "--verbose", action="store_true", help="log every request")
+    args = ap.parse_args()
+
+    defaults, overrides = {}, {}
+    for flag, cast, default, _ in knobs:
+        field = flag.replace("-", "_")
+        value, per = _per_provider(getattr(args, field), cast, f"--{flag}")
+        defaults[field] = default if value is None else value
+        for name, v in per.items():
+            overrides.setdefault(name, {})[field] = v
+    if isinstance(defaults["latency"], str):
+        defaults["latency"] = Latency(defaults["latency"])
+
+    emu = Emulator(args.host, args.port, overrides=overrides, verbose=args.verbose, **defaults)
+    print(f"Titan provider emulator on {emu.url}")
+    for name, prof in emu.profiles.items():
+        print(f"  {name:<13}{prof.as_dict()}")
+    print("\nPoint the bot at it:")
+    for k, v in emu.env().items():
+        print(f"  export {k}={v}")
+    print(f"\nStats: curl {emu.url}/_stats")
+    try:
+        emu.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+MI AI TITAN V22 — update replay load harness.
+
+Feeds bot_v22.py a stream of Telegram updates at a target rate through the
+fake Bot API (titan_telegram.py), with the AI providers answered by
+titan_emulator.py, and reports end-to-end latency percentiles and Bot API
+calls per update:
+
+    python3 titan_replay.py                                 # mixed traffic, 5 updates/s for 40s
+    python3 titan_replay.py --scenario group --rate 20 --updates 600
+    python3 titan_replay.py --scenario photos --ai-latency lognorm:1.0,0.5
+    python3 titan_replay.py --save stream.jsonl             # keep the generated stream ...
+    python3 titan_replay.py --file stream.jsonl --speed 2   # ... and replay it, twice as fast
+
+Scenarios: private (one-to-one chats), group (busy groups, ~20% of lines
+address the bot, the rest is chatter), photos (bursts of 2-5 photos from
+one user, some captioned as trading charts), mixed (all of these plus a
+few voice notes). Users are rotated so nobody trips the bot's per-user
+rate limit by accident.
+
+--file takes JSON lines, each either a bare Update or
+{"t": seconds, "kind": label, "update": Update}; with "t" the original
+spacing is kept (divided by --speed), without it updates go out at --rate.
+
+By default the harness starts both fake servers in-process and runs the
+bot as a child process in a temp dir, pointed at them, with the bot's
+client-side provider quotas lifted (--quotas keeps them). --server URL
+drives an already running titan_telegram.py instead and starts nothing.
+
+Latency for an update is measured from when it was queued to its first
+visible reply (sendMessage/sendPhoto/edit..., not sendChatAction) and to
+the last call the bot made for it. Calls are matched to updates by the fake
+server (the replied-to message, edits of the bot's own messages, then the
+newest unanswered update in the chat), so group numbers are approximate.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from titan_emulator import Emulator, Latency
+from titan_telegram import BOT_USER, FakeTelegram
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PRIVATE_LINES = [
+    "salam kya haal hai", "aaj mausam kaisa hai?", "mujhe ek joke sunao",
+    "python mein list aur tuple mein kya farq hai?", "shukriya bhai",
+    "ek professional email likho leave ke liye", "2+2 kitne hote hain",
+    "recursion ko simple example se samjhao", "kal ka plan kya hona chahiye?",
+    "write a python function to merge two sorted lists with tests",
+    "explain the difference between TCP and UDP with examples", "ok theek hai",
+    "best laptop under 100k for programming?", "meri english improve kaise ho?",
+]
+GROUP_LINES = [
+    "haha sahi kaha", "koi aaj match dekh raha hai?", "chai peeni hai kisi ne?",
+    "kal meeting kitne baje hai", "lol", "yaar traffic bohat tha aaj", "👍",
+    "kisi ke paas notes hain?", "weekend pe chalte hain kahin", "acha theek",
+]
+MENTION_LINES = [
+    "titan is baat ka summary do", "@{bot} kal ki meeting ka time yaad hai?",
+    "titan ek acha sa naam suggest karo group ke liye", "@{bot} python ya javascript?",
+]
+PHOTO_CAPTIONS = ["", "", "ye kya hai?", "is chart ka signal do", "trading chart analysis karo"]
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    k = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[k]
+
+
+# ── synthetic traffic ─────────────────────────────────────────────────────────
+
+class Traffic:
+    """Synthetic update generator. events() yields (t, kind, update)."""
+
+    def __init__(self, scenario, rate, updates, users, groups, seed):
+        self.scenario, self.rate, self.updates = scenario, rate, updates
+        self.users, self.groups = users, groups
+        self.rng = random.Random(seed)
+        self._next_user = 0
+        self._seq = 0
+
+    def _user(self):
+        """Round-robin, so one user's messages are users/rate seconds apart."""
+        uid = 500_000 + self._next_user
+        self._next_user = (self._next_user + 1) % self.users
+        return {"id": uid, "is_bot": False, "first_name": f"User{uid % 10000}", "username": f"user{uid}"}
+
+    def _fid(self, kind):
+        self._seq += 1
+        return f"{kind}{self._seq:06d}x{self.rng.getrandbits(24):06x}"
+
+    @staticmethod
+    def _message(user, chat, **fields):
+        return {"message": {"from": user, "chat": chat, **fields}}
+
+    def private(self):
+        user = self._user()
+        chat = {"id": user["id"], "type": "private", "first_name": user["first_name"]}
+        return [(0.0, "private", self._message(user, chat, text=self.rng.choice(PRIVATE_LINES)))]
+
+    def group(self):
+        g = self.rng.randrange(self.groups)
+        chat = {"id": -1001_000_000_000 - g, "type": "supergroup", "title": f"Group {g}"}
+        if self.rng.random() < 0.2:
+            kind, text = "group_mention", self.rng.choice(MENTION_LINES).format(bot=BOT_USER["username"])
+        else:
+            kind, text = "group_chatter", self.rng.choice(GROUP_LINES)
+        return [(0.0, kind, self._message(self._user(), chat, text=text))]
+
+    def photos(self):
+        user = self._user()
+        chat = {"id": user["id"], "type": "private", "first_name": user["first_name"]}
+        album = f"album{self.rng.getrandbits(32):x}"
+        caption = self.rng.choice(PHOTO_CAPTIONS)
+        burst = []
+        for i in range(self.rng.randint(2, 5)):
+            fid = self._fid("photo")
+            sizes = [{"file_id": f"{fid}s{w}", "file_unique_id": f"{fid}s{w}"[-12:], "width": w,
+                      "height": w * 3 // 4, "file_size": w * w // 8} for w in (90, 320, 1280)]
+            fields = {"photo": sizes, "media_group_id": album}
+            if i == 0 and caption:
+                fields["caption"] = caption
+            burst.append((i * self.rng.uniform(0.05, 0.3), "photo_burst", self._message(user, chat, **fields)))
+        return burst
+
+    def voice(self):
+        user = self._user()
+        chat = {"id": user["id"], "type": "private", "first_name": user["first_name"]}
+        fid = self._fid("voice")
+        voice = {"file_id": fid, "file_unique_id": fid[-12:], "duration": self.rng.randint(2, 15),
+                 "mime_type": "audio/ogg", "file_size": 24_000}
+        return [(0.0, "voice", self._message(user, chat, voice=voice))]
+
+    def events(self):
+        mix = {
+            "private": [(1.0, self.private)],
+            "group": [(1.0, self.group)],
+            "photos": [(1.0, self.photos)],
+            "mixed": [(0.5, self.private), (0.35, self.group), (0.1, self.photos), (0.05, self.voice)],
+        }[self.scenario]
+        t, sent = 0.0, 0
+        while sent < self.updates:
+            make = self.rng.choices([f for _, f in mix], [w for w, _ in mix])[0]
+            for dt, kind, update in make():
+                if sent < self.updates:
+                    yield t + dt, kind, update
+                    sent += 1
+            t += self.rng.expovariate(self.rate)   # Poisson arrivals
+
+
+def load_stream(path, rate):
+    """(t, kind, update) from a recorded JSON-lines file."""
+    t = 0.0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            update = item["update"] if "update" in item else item
+            update.pop("update_id", None)      # the fake server numbers them
+            t = item.get("t", t)
+            yield t, item.get("kind"), update
+            t += 1.0 / rate
+
+
+# ── fake Telegram backends ────────────────────────────────────────────────────
+
+class RemoteTelegram:
+    """Same surface as FakeTelegram, over HTTP to a running titan_telegram.py."""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def _call(self, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.url + path, data=data,
+                                     headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=30) as r:
+            return json.loads(r.read())["result"]
+
+    def push(self, update, kind=None):
+        return self._call("/_updates", [{**update, "_kind": kind} if kind else update])[0]
+
+    def report(self):
+        return self._call("/_report")
+
+    def stats(self):
+        return self._call("/_stats")
+
+    def stop(self):
+        pass
+
+
+def spawn_bot(workdir, env_extra):
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": "1000001:replay",
+        "ADMIN_ID": "0",
+        "TITAN_DB_PATH": os.path.join(workdir, "replay.db"),
+    })
+    env.update(env_extra)
+    log = open(os.path.join(workdir, "bot.log"), "wb")
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, "bot_v22.py")], cwd=workdir,
+                            env=env, stdout=log, stderr=subprocess.STDOUT)
+    return proc, log
+
+
+def stop_bot(proc):
+    if proc.poll() is None:
+        proc.terminate()        # SIGINT only restarts polling (bot_v22's __main__ loop)
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+# ── report ────────────────────────────────────────────────────────────────────
+
+def print_report(records, stats, elapsed):
+    print(f"\n{len(records)} updates in {elapsed:.1f}s ({len(records) / max(elapsed, 1e-9):.1f}/s) · "
+          f"{stats['calls']} Bot API calls ({stats['calls'] / max(1, len(records)):.2f} per update) · "
+          f"{stats['throttled']} answered 429\n")
+    kinds = sorted({r["kind"] for r in records})
+    print(f"{'kind':<16}{'updates':>8}{'replied':>8}{'reply p50':>10}{'p95':>8}{'p99':>8}"
+          f"{'done p50':>10}{'p95':>8}{'p99':>8}{'calls/upd':>10}")
+    for kind in kinds + ["all"]:
+        rs = records if kind == "all" else [r for r in records if r["kind"] == kind]
+        replied = [r for r in rs if r["first_reply"] is not None]
+        first = [r["first_reply"] - r["queued"] for r in replied]
+        done = [r["last_call"] - r["queued"] for r in rs if r["last_call"] is not None]
+        calls = sum(r["calls"] for r in rs) / max(1, len(rs))
+        print(f"{kind:<16}{len(rs):>8}{len(replied):>8}{percentile(first, 50):>10.2f}{percentile(first, 95):>8.2f}"
+              f"{percentile(first, 99):>8.2f}{percentile(done, 50):>10.2f}{percentile(done, 95):>8.2f}"
+              f"{percentile(done, 99):>8.2f}{calls:>10.2f}")
+    undelivered = sum(1 for r in records if r["delivered"] is None)
+    if undelivered:
+        print(f"\n{undelivered} updates were never fetched by the bot")
+    print("\n(seconds from queued; 'replied' = first visible message, 'done' = last call made for it)")
+    print("\nBot API calls: " + ", ".join(
+        f"{m} {c['calls']}" + (f" ({c['429']}×429)" if c["429"] else "")
+        for m, c in sorted(stats["methods"].items(), key=lambda kv: -kv[1]["calls"])))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--scenario", choices=("private", "group", "photos", "mixed"), default="mixed")
+    ap.add_argument("--file", help="replay a recorded JSON-lines update stream instead")
+    ap.add_argument("--save", help="write the stream that was sent here (replayable with --file)")
+    ap.add_argument("--rate", type=float, default=5.0, help="updates/second (default 5)")
+    ap.add_argument("--speed", type=float, default=1.0, help="time compression for --file streams with \"t\"")
+    ap.add_argument("--updates", type=int, default=200)
+    ap.add_argument("--users", type=int, default=200, help="distinct synthetic users")
+    ap.add_argument("--groups", type=int, default=3, help="distinct synthetic groups")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--settle", type=float, default=8.0,
+                    help="stop once the bot has made no call for this long (default 8s, > chatter debounce)")
+    ap.add_argument("--timeout", type=float, default=300.0, help="give up waiting after this many seconds")
+    ap.add_argument("--server", metavar="URL", help="use a running titan_telegram.py; start nothing")
+    ap.add_argument("--record", metavar="FILE", help="append every Bot API call here as JSON lines")
+    ap.add_argument("--no-limits", action="store_true", help="fake Telegram never answers 429")
+    ap.add_argument("--ai-latency", default="lognorm:0.4,0.4", help="emulated AI time to first byte")
+    ap.add_argument("--ai-tps", type=float, default=300, help="emulated AI words/second")
+    ap.add_argument("--ai-error-rate", type=float, default=0.0)
+    ap.add_argument("--quotas", action="store_true", help="keep the bot's client-side provider quotas")
+    args = ap.parse_args()
+
+    if args.file:
+        stream = list(load_stream(args.file, args.rate))
+    else:
+        stream = list(Traffic(args.scenario, args.rate, args.updates, args.users, args.groups, args.seed).events())
+    stream.sort(key=lambda e: e[0])
+
+    proc = log = emu = None
+    if args.server:
+        tg = RemoteTelegram(args.server)
+    else:
+        workdir = tempfile.mkdtemp(prefix="titan_replay_")
+        tg = FakeTelegram(limits=not args.no_limits, record=args.record).start()
+        emu = Emulator(latency=Latency(args.ai_latency), tps=args.ai_tps, error_rate=args.ai_error_rate).start()
+        env = {"TELEGRAM_API_URL": tg.url, **emu.env()}
+        if not args.quotas:
+            env.update({f"TITAN_{kind}_{p}": "0" for kind in ("RPM", "TPM")
+                        for p in ("GEMINI", "GROQ", "OPENROUTER")})
+        proc, log = spawn_bot(workdir, env)
+        print(f"bot_v22.py started in {workdir} (log: bot.log) · Telegram {tg.url} · AI {emu.url}")
+
+    try:
+        deadline = time.monotonic() + 90
+        while not args.server and tg.stats()["polls"] == 0:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                raise SystemExit(f"bot did not start polling — see {os.path.join(workdir, 'bot.log')}")
+            time.sleep(0.2)
+
+        saved = open(args.save, "w", encoding="utf-8") if args.save else None
+        print(f"sending {len(stream)} updates "
+              f"({'from ' + args.file if args.file else args.scenario + f' at {args.rate:g}/s'})...")
+        first_id, t0 = None, time.monotonic()
+        for t, kind, update in stream:
+            delay = t0 + t / args.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            uid = tg.push(update, kind)
+            first_id = uid if first_id is None else first_id
+            if saved:
+                saved.write(json.dumps({"t": round(t, 3), "kind": kind, "update": update}, ensure_ascii=False) + "\n")
+        if saved:
+            saved.close()
+
+        while time.monotonic() - t0 < args.timeout:
+            s = tg.stats()
+            if s["queued"] == 0 and s["idle"] >= args.settle:
+                break
+            if proc is not None and proc.poll() is not None:
+                print(f"bot exited with {proc.returncode} — see {os.path.join(workdir, 'bot.log')}")
+                break
+            time.sleep(0.5)
+        elapsed = time.monotonic() - t0
+        records = [r for r in tg.report() if r["update_id"] >= first_id]
+        print_report(records, tg.stats(), elapsed)
+        if emu is not None:
+            ai = emu.snapshot()["providers"]
+            print("AI provider calls: " + ", ".join(f"{p} {s['requests']}" for p, s in ai.items() if s["requests"]))
+    finally:
+        if proc is not None:
+            stop_bot(proc)
+            log.close()
+        for server in (tg, emu):
+            if server is not None:
+                server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,541 @@
+#!/usr/bin/env python3
+"""
+MI AI TITAN V22 — fake Telegram Bot API server.
+
+Stands in for api.telegram.org so bot_v22.py can be driven without Telegram.
+Point the bot at it with TELEGRAM_API_URL (applied through
+telebot.apihelper.API_URL / FILE_URL) and feed it updates:
+
+    python3 titan_telegram.py --port 8401 --record calls.jsonl
+    TELEGRAM_API_URL=http://127.0.0.1:8401 BOT_TOKEN=1:fake python3 bot_v22.py
+
+Bot API methods (any token is accepted):
+
+    getMe, getUpdates (long polling, offset/limit/timeout/allowed_updates)
+    sendMessage, editMessageText, sendPhoto, sendVoice, sendDocument,
+    sendChatAction, getFile (+ GET /file/bot<token>/<path> downloads)
+
+Any other send*/edit* method answers with a message, anything else with
+`true`, so a handler using a method this file doesn't know about still runs.
+
+Control endpoints (what titan_replay.py uses):
+
+    POST /_updates     JSON Update or list of Updates to queue; update_id,
+                       message_id and date are filled in if missing.
+                       An optional "_kind" key labels the update in reports.
+    GET  /_calls       every outbound call so far (?since=N for the tail)
+    GET  /_report      per-update timeline: when it was queued, delivered,
+                       first answered and last touched, and how many calls
+    GET  /_stats       counters per method, 429s, queue depth, seconds idle
+    POST /_reset       forget updates, calls and counters
+
+Every outbound call is recorded with its timestamp (and appended to
+--record as JSON lines). Telegram-style flood limits are enforced on
+sending and editing — per private chat (--chat-rate/--chat-burst), per
+group (--group-per-minute) and overall (--global-rate) — with Telegram's
+429 "retry after N" error; --no-limits turns them off.
+
+Standard library only; titan_emulator.py provides the fake image bytes.
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from titan_emulator import png_bytes, wav_bytes
+
+BOT_USER = {"id": 777000111, "is_bot": True, "first_name": "MI AI TITAN", "username": "mi_titan_emu_bot"}
+
+# Methods that Telegram's flood control counts. sendChatAction and
+# callback answers are not limited here.
+LIMITED = re.compile(r"^(send(?!ChatAction)|edit|forward|copy)")
+
+
+class _Bucket:
+    """Token bucket: `rate` per second, up to `burst` saved up."""
+
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.at = burst, time.monotonic()
+
+    def take(self):
+        """0 if a token was taken, else whole seconds until one is free."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.at) * self.rate)
+        self.at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return max(1, math.ceil((1 - self.tokens) / self.rate))
+
+
+class FakeTelegram:
+    """The server, startable in-process:
+
+        tg = FakeTelegram(port=0).start()
+        env = {"TELEGRAM_API_URL": tg.url}
+        tg.push({"message": {"chat": {"id": 5, "type": "private"}, "text": "salam"}})
+        ...
+        print(tg.report())
+        tg.stop()
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, limits=True, chat_rate=1.0, chat_burst=5,
+                 group_per_minute=20, global_rate=30, record=None, verbose=False):
+        self.limits = limits
+        self.chat_rate, self.chat_burst = chat_rate, chat_burst
+        self.group_per_minute, self.global_rate = group_per_minute, global_rate
+        self.verbose = verbose
+        self._record = open(record, "a", encoding="utf-8") if record else None
+        self.cond = threading.Condition()
+        self.reset()
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.request_queue_size = 256
+        self.httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def reset(self):
+        with self.cond:
+            self.t0 = time.monotonic()
+            self.queue = []          # undelivered updates
+            self.updates = {}        # update_id -> timeline record
+            self.calls = []
+            self.counts = {}         # method -> [calls, 429s]
+            self.next_update = 1
+            self.next_mid = {}       # chat_id -> next message_id
+            self.owner = {}          # (chat_id, message_id) -> update_id it belongs to
+            self.files = {}          # file_id -> (kind, file_path, bytes or None)
+            self.file_owner = {}     # file_id -> update_id that carried it
+            self.chat_types = {}     # chat_id -> "private" / "group" / ...
+            self.polls = 0
+            self.buckets = {}
+            self.global_bucket = _Bucket(self.global_rate, self.global_rate)
+
+    def now(self):
+        return round(time.monotonic() - self.t0, 4)
+
+    # ── updates in ────────────────────────────────────────────────────────
+
+    def _message_id(self, chat_id):
+        mid = self.next_mid.get(chat_id, 1)
+        self.next_mid[chat_id] = mid + 1
+        return mid
+
+    def push(self, update, kind=None):
+        """Queue one update for getUpdates. Returns its update_id."""
+        update = dict(update)
+        kind = update.pop("_kind", kind)
+        with self.cond:
+            uid = update.get("update_id") or self.next_update
+            self.next_update = max(self.next_update, uid) + 1
+            update["update_id"] = uid
+            msg = update.get("message")
+            chat_id = None
+            if msg is not None:
+                msg = update["message"] = dict(msg)
+                chat_id = msg["chat"]["id"]
+                msg.setdefault("date", int(time.time()))
+                if "message_id" not in msg:
+                    msg["message_id"] = self._message_id(chat_id)
+                else:
+                    self.next_mid[chat_id] = max(self.next_mid.get(chat_id, 1), msg["message_id"] + 1)
+                self.owner[(chat_id, msg["message_id"])] = uid
+                self.chat_types[chat_id] = msg["chat"].get("type", "private")
+                for fid in self._register_files(msg):
+                    self.file_owner[fid] = uid
+            elif "callback_query" in update:
+                chat_id = ((update["callback_query"].get("message") or {}).get("chat") or {}).get("id")
+            self.updates[uid] = {"update_id": uid, "kind": kind or self._kind(update), "chat_id": chat_id,
+                                 "queued": self.now(), "delivered": None, "first_call": None,
+                                 "first_reply": None, "last_call": None, "calls": 0}
+            self.queue.append(update)
+            self.cond.notify_all()
+        return uid
+
+    @staticmethod
+    def _kind(update):
+        msg = update.get("message")
+        if msg is None:
+            return "callback" if "callback_query" in update else "other"
+        where = "private" if msg["chat"].get("type") == "private" else "group"
+        for media in ("photo", "voice", "document"):
+            if media in msg:
+                return f"{where}_{media}"
+        return where
+
+    def _register_files(self, msg):
+        """Remember the files an incoming message carries, so getFile and
+        the download can answer for them. Returns their file_ids."""
+        fids = []
+        for size in msg.get("photo") or []:
+            self.files.setdefault(size["file_id"], ("photo", f"photos/{size['file_id']}.png", None))
+            fids.append(size["file_id"])
+        for media, ext in (("voice", "oga"), ("document", "bin")):
+            if media in msg:
+                fid = msg[media]["file_id"]
+                self.files.setdefault(fid, (media, f"{media}s/{fid}.{ext}", None))
+                fids.append(fid)
+        return fids
+
+    def file_bytes(self, file_path):
+        with self.cond:
+            entry = next((v for v in self.files.values() if v[1] == file_path), None)
+        if entry is None:
+            return None
+        kind, path, data = entry
+        if data is not None:
+            return data
+        if kind == "photo":
+            return png_bytes(640, 480, path)
+        if kind == "voice":
+            return wav_bytes()
+        return b"titan emulator document\n" * 64
+
+    def get_updates(self, offset, limit, timeout):
+        """Long poll: confirms everything below `offset`, then waits up to
+        `timeout` seconds for something to deliver."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            self.polls += 1
+            if offset:
+                self.queue = [u for u in self.queue if u["update_id"] >= offset]
+            while not self.queue and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+            batch = self.queue[:limit]
+            now = self.now()
+            for u in batch:
+                rec = self.updates.get(u["update_id"])
+                if rec and rec["delivered"] is None:
+                    rec["delivered"] = now
+            return batch
+
+    # ── calls out ─────────────────────────────────────────────────────────
+
+    def throttle(self, method, chat_id, chat_type):
+        """Seconds to retry after, or 0 if this call may go through."""
+        if not self.limits or not LIMITED.match(method):
+            return 0
+        with self.cond:
+            wait = self.global_bucket.take()
+            if wait or chat_id is None:
+                return wait
+            if chat_id not in self.buckets:
+                group = chat_type != "private"
+                self.buckets[chat_id] = (_Bucket(self.group_per_minute / 60, self.group_per_minute) if group
+                                         else _Bucket(self.chat_rate, self.chat_burst))
+            return self.buckets[chat_id].take()
+
+    @staticmethod
+    def reply_to(params):
+        """message_id a call replies to — pyTelegramBotAPI 4.x sends it as
+        reply_parameters JSON, older clients as reply_to_message_id."""
+        rp = params.get("reply_parameters")
+        if isinstance(rp, str):
+            try:
+                rp = json.loads(rp)
+            except ValueError:
+                rp = None
+        mid = (rp or {}).get("message_id") if isinstance(rp, dict) else None
+        mid = mid if mid is not None else params.get("reply_to_message_id")
+        try:
+            return int(mid) if mid is not None else None
+        except (TypeError, ValueError):
+            return None
+
+    def _owner_of(self, chat_id, params):
+        """Which update a call is answering. The replied-to message wins;
+        an edit belongs to whoever the edited message belonged to;
+        otherwise the newest delivered update in that chat without a
+        visible reply yet, else the newest one. A heuristic — busy groups
+        can blur it."""
+        try:
+            edited = int(params["message_id"]) if "message_id" in params else None
+        except (TypeError, ValueError):
+            edited = None
+        for mid in (self.reply_to(params), edited):
+            owner = self.owner.get((chat_id, mid)) if mid is not None else None
+            if owner is not None:
+                return owner
+        mine = [r for r in self.updates.values() if r["chat_id"] == chat_id and r["delivered"] is not None]
+        waiting = [r for r in mine if r["first_reply"] is None]
+        newest = max(waiting or mine, key=lambda r: r["update_id"], default=None)
+        return newest["update_id"] if newest else None
+
+    def record(self, method, chat_id, params, status, result_mid=None, nbytes=0, owner=None):
+        with self.cond:
+            t = self.now()
+            entry = {"t": t, "method": method, "chat_id": chat_id, "status": status}
+            c = self.counts.setdefault(method, [0, 0])
+            c[0] += 1
+            c[1] += status == 429
+            if owner is None and chat_id is not None:
+                owner = self._owner_of(chat_id, params)
+            if owner is not None:
+                entry["update_id"] = owner
+                rec = self.updates.get(owner)
+                if rec is not None:
+                    rec["calls"] += 1
+                    rec["first_call"] = rec["first_call"] if rec["first_call"] is not None else t
+                    if status == 200 and method != "sendChatAction" and rec["first_reply"] is None:
+                        rec["first_reply"] = t
+                    rec["last_call"] = t
+                if result_mid is not None and chat_id is not None:
+                    self.owner[(chat_id, result_mid)] = owner
+            for key in ("text", "caption"):
+                if params.get(key):
+                    entry[key] = str(params[key])[:120]
+            if nbytes:
+                entry["bytes"] = nbytes
+            self.calls.append(entry)
+            if self._record:
+                self._record.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                self._record.flush()
+
+    def chat_type(self, chat_id):
+        if chat_id in self.chat_types:
+            return self.chat_types[chat_id]
+        return "private" if isinstance(chat_id, int) and chat_id > 0 else "supergroup"
+
+    def message(self, chat_id, chat_type, params, **extra):
+        with self.cond:
+            mid = int(params["message_id"]) if "message_id" in params else self._message_id(chat_id)
+        chat = {"id": chat_id, "type": chat_type}
+        msg = {"message_id": mid, "date": int(time.time()), "chat": chat, "from": BOT_USER, **extra}
+        if params.get("text") is not None:
+            msg["text"] = str(params["text"])
+        if params.get("caption") is not None:
+            msg["caption"] = str(params["caption"])
+        return msg
+
+    def new_file(self, kind, data):
+        fid = f"emu{kind}{random.getrandbits(40):x}"
+        with self.cond:
+            self.files[fid] = (kind, f"{kind}s/{fid}", data)
+        return fid
+
+    # ── reports ───────────────────────────────────────────────────────────
+
+    def stats(self):
+        with self.cond:
+            last = self.calls[-1]["t"] if self.calls else 0.0
+            return {"uptime": self.now(), "idle": round(self.now() - last, 4),
+                    "queued": len(self.queue), "updates": len(self.updates),
+                    "polls": self.polls, "calls": len(self.calls),
+                    "throttled": sum(c[1] for c in self.counts.values()),
+                    "methods": {m: {"calls": c[0], "429": c[1]} for m, c in sorted(self.counts.items())}}
+
+    def report(self):
+        with self.cond:
+            return [dict(r) for r in self.updates.values()]
+
+    def calls_since(self, since=0):
+        with self.cond:
+            return self.calls[since:]
+
+    # ── lifecycle ─────────────────────────────────────────────────────────
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="titan-telegram", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        with self.cond:
+            self.cond.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._record:
+            self._record.close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "TitanTelegram/1.0"
+
+    def log_message(self, fmt, *args):
+        if self.server.fake.verbose:
+            super().log_message(fmt, *args)
+
+    def _send(self, status, body, ctype="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _ok(self, result):
+        self._send(200, {"ok": True, "result": result})
+
+    def _fail(self, status, description, **parameters):
+        body = {"ok": False, "error_code": status, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        self._send(status, body)
+
+    def _params(self):
+        """Query string, urlencoded/JSON body and multipart fields, merged.
+        Uploaded files come back as {field: bytes}."""
+        url = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        n = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(n) if n else b""
+        ctype = self.headers.get("Content-Type", "")
+        files = {}
+        if body and (ctype.startswith("application/json") or url.path.startswith("/_")):
+            loaded = json.loads(body)
+            if not isinstance(loaded, dict):
+                return url.path, loaded, files
+            params.update(loaded)
+        elif body and ctype.startswith("application/x-www-form-urlencoded"):
+            params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+        elif body and "boundary=" in ctype:
+            boundary = ctype.split("boundary=", 1)[1].strip('"').encode()
+            for part in body.split(b"--" + boundary):
+                head, _, data = part.partition(b"\r\n\r\n")
+                m = re.search(rb'name="([^"]+)"', head)
+                if not m:
+                    continue
+                data = data[:-2] if data.endswith(b"\r\n") else data
+                if b"filename=" in head:
+                    files[m.group(1).decode()] = data
+                else:
+                    params[m.group(1).decode()] = data.decode("utf-8", "replace")
+        return url.path, params, files
+
+    def do_GET(self):
+        self._route()
+
+    def do_POST(self):
+        self._route()
+
+    def _route(self):
+        fake = self.server.fake
+        path, params, files = self._params()
+        if path == "/_updates":
+            items = params if isinstance(params, list) else params.get("updates", [params])
+            items = items if isinstance(items, list) else [items]
+            return self._ok([fake.push(u) for u in items])
+        if path == "/_calls":
+            return self._ok(fake.calls_since(int(params.get("since", 0))))
+        if path == "/_report":
+            return self._ok(fake.report())
+        if path == "/_stats":
+            return self._ok(fake.stats())
+        if path == "/_reset":
+            fake.reset()
+            return self._ok(True)
+        m = re.fullmatch(r"/file/bot[^/]+/(.+)", path)
+        if m:
+            data = fake.file_bytes(m.group(1))
+            return self._send(200, data, "application/octet-stream") if data is not None else \
+                self._fail(404, "Not Found: file not found")
+        m = re.fullmatch(r"/bot([^/]+)/(\w+)", path)
+        if not m:
+            return self._fail(404, "Not Found")
+        self._method(fake, m.group(2), params, files)
+
+    def _method(self, fake, method, params, files):
+        if method == "getMe":
+            return self._ok(BOT_USER)
+        if method == "getUpdates":
+            limit = min(100, int(params.get("limit") or 100))
+            timeout = min(50.0, float(params.get("timeout") or 0))
+            return self._ok(fake.get_updates(int(params.get("offset") or 0), limit, timeout))
+        if method == "getFile":
+            fid = params.get("file_id", "")
+            entry = fake.files.get(fid)
+            fake.record(method, None, params, 200 if entry else 400, owner=fake.file_owner.get(fid))
+            if entry is None:
+                return self._fail(400, "Bad Request: invalid file_id")
+            return self._ok({"file_id": fid, "file_unique_id": fid[-12:], "file_size": 4096,
+                             "file_path": entry[1]})
+
+        chat_id = params.get("chat_id")
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        chat_type = fake.chat_type(chat_id)
+        nbytes = sum(len(v) for v in files.values())
+        wait = fake.throttle(method, chat_id, chat_type)
+        if wait:
+            fake.record(method, chat_id, params, 429, nbytes=nbytes)
+            return self._fail(429, f"Too Many Requests: retry after {wait}", retry_after=wait)
+        if chat_id is None and method.startswith(("send", "edit")) and "inline_message_id" not in params:
+            fake.record(method, None, params, 400)
+            return self._fail(400, "Bad Request: chat_id is empty")
+
+        if method == "sendChatAction":
+            fake.record(method, chat_id, params, 200)
+            return self._ok(True)
+        if method.startswith(("send", "edit", "forward", "copy")):
+            extra = {}
+            if method == "sendPhoto":
+                fid = fake.new_file("photo", files.get("photo"))
+                extra["photo"] = [{"file_id": fid, "file_unique_id": fid[-12:], "width": 640, "height": 480}]
+            elif method in ("sendVoice", "sendDocument", "sendAudio", "sendVideo"):
+                kind = method[4:].lower()
+                fid = fake.new_file(kind, files.get(kind))
+                extra[kind] = {"file_id": fid, "file_unique_id": fid[-12:], "file_size": len(files.get(kind) or b"")}
+                if kind != "document":
+                    extra[kind]["duration"] = 1
+                if kind == "video":
+                    extra[kind].update(width=640, height=480)
+            reply_to = fake.reply_to(params)
+            if reply_to is not None:
+                extra["reply_to_message"] = {"message_id": reply_to,
+                                             "date": int(time.time()), "chat": {"id": chat_id, "type": chat_type}}
+            if method.startswith("edit"):
+                params.setdefault("message_id", 1)
+            msg = fake.message(chat_id, chat_type, params, **extra)
+            fake.record(method, chat_id, params, 200, msg["message_id"], nbytes)
+            return self._ok(msg)
+        fake.record(method, chat_id, params, 200)
+        self._ok(True)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8401)
+    ap.add_argument("--record", metavar="FILE", help="append every outbound call here as JSON lines")
+    ap.add_argument("--no-limits", action="store_true", help="never answer 429")
+    ap.add_argument("--chat-rate", type=float, default=1.0, help="messages/second per private chat (default 1)")
+    ap.add_argument("--chat-burst", type=int, default=5, help="short burst allowed per private chat (default 5)")
+    ap.add_argument("--group-per-minute", type=int, default=20, help="messages/minute per group (default 20)")
+    ap.add_argument("--global-rate", type=float, default=30, help="messages/second across all chats (default 30)")
+    ap.add_argument("-v", "--verbose", action="store_true", help="log every request")
+    args = ap.parse_args()
+
+    fake = FakeTelegram(args.host, args.port, limits=not args.no_limits, chat_rate=args.chat_rate,
+                        chat_burst=args.chat_burst, group_per_minute=args.group_per_minute,
+                        global_rate=args.global_rate, record=args.record, verbose=args.verbose)
+    print(f"Fake Telegram Bot API on {fake.url} "
+          f"(flood limits {'off' if args.no_limits else 'on'}{', recording to ' + args.record if args.record else ''})")
+    print(f"\n  export TELEGRAM_API_URL={fake.url}")
+    print(f"\nQueue updates: curl -d @update.json {fake.url}/_updates · report: {fake.url}/_report")
+    try:
+        fake.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()